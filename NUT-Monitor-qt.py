@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # 2009-12-27 David Goncalves - Version 1.2
@@ -26,869 +26,1877 @@
 #
 # 2015-02-14 Michal Fincham - Version 1.3.1
 #            Corrected unsafe permissions on ~/.nut-monitor (Debian #777706)
+#
+# 2026-10-17 Version 2.0
+#            Python 3 and Qt 5 front end, built on the nutmonitor package
+#            shared with the GTK one. The UPS vars and the favorites are
+#            displayed by Qt item models : a poll only emits dataChanged
+#            for the cells it changed, from the GUI thread, the polling
+#            threads hand their changes over through queued signals.
+
 
+import time
+
+# Used to measure the startup time (see --startup-time)
+STARTUP_TIME = time.time()
 
-import gtk, gtk.glade, gobject
 import sys
-import base64
 import os, os.path
-import stat
-import platform
-import time
-import threading
+import bisect
 import optparse
-import ConfigParser
-import locale
 import gettext
-import PyNUT
 
+from PyQt5 import QtCore, QtGui, QtWidgets
 
-# Activate threadings on glib
-gobject.threads_init()
+import nutmonitor.favorites
+import nutmonitor.fleet
+import nutmonitor.icons
+import nutmonitor.metrics
+import nutmonitor.render
+import nutmonitor.state
+import nutmonitor.status
+import nutmonitor.worker
+
+_ = gettext.gettext
 
-class interface :
 
-    DESIRED_FAVORITES_DIRECTORY_MODE = 0700
-
-    __widgets                        = {}
-    __callbacks                      = {}
-    __favorites                      = {}
-    __favorites_file                 = None
-    __favorites_path                 = ""
-    __fav_menu_items                 = list()
-    __window_visible                 = True
-    __glade_file                     = None
-    __connected                      = False
-    __ups_handler                    = None
-    __ups_commands                   = None
-    __ups_vars                       = None
-    __ups_rw_vars                    = None
-    __gui_thread                     = None
-    __current_ups                    = None
+def parse_command_line() :
+    opt_parser = optparse.OptionParser()
+    opt_parser.add_option( "-H", "--start-hidden", action="store_true", default=False, dest="hidden", help="Start iconified in tray" )
+    opt_parser.add_option( "-F", "--favorite", dest="favorite", help="Load the specified favorite and connect to UPS" )
+    opt_parser.add_option( "-A", "--all-favorites", action="store_true", default=False, dest="all_favorites", help="Monitor all favorites at once" )
+    opt_parser.add_option( "-T", "--startup-time", action="store_true", default=False, dest="startup_time", help="Print the time needed to show the window and the first UPS status" )
+    opt_parser.add_option( "--daemon-socket", dest="daemon_socket", default=None, help="Socket of the daemon (default: daemon.sock in the configuration folder)" )
+    opt_parser.add_option( "--benchmark", action="store_true", default=False, dest="benchmark", help="Run the benchmarks, GUI ones included. Benchmark options go after '--'" )
+    opt_parser.add_option( "--metrics", action="store_true", default=False, dest="metrics", help="Record latency and error metrics from the start (see File / Export metrics)" )
+    opt_parser.add_option( "--event-socket", dest="event_socket", default=None, help="Listen to upsmon events sent by nut-monitor-notify on this socket, and poll the UPS at once" )
+
+    return( opt_parser.parse_args() )
+
+#-----------------------------------------------------------------------
+# Runs the functions dispatched by other threads in the GUI thread : the
+# signal is queued, the slot is called by the Qt event loop
+class qt_dispatcher( QtCore.QObject ) :
+
+    dispatched = QtCore.pyqtSignal( object, object )
 
     def __init__( self ) :
+        QtCore.QObject.__init__( self )
+        self.dispatched.connect( self.__run, QtCore.Qt.QueuedConnection )
 
-        # Before anything, parse command line options if any present...
-        opt_parser = optparse.OptionParser()
-        opt_parser.add_option( "-H", "--start-hidden", action="store_true", default=False, dest="hidden", help="Start iconified in tray" )
-        opt_parser.add_option( "-F", "--favorite", dest="favorite", help="Load the specified favorite and connect to UPS" )
-
-        ( cmd_opts, args ) = opt_parser.parse_args()
-
-
-        self.__glade_file = os.path.join( os.path.dirname( sys.argv[0] ), "gui-1.3.glade" )
-
-        self.__widgets["interface"]                   = gtk.glade.XML( self.__glade_file, "window1", APP )
-        self.__widgets["main_window"]                 = self.__widgets["interface"].get_widget("window1")
-        self.__widgets["status_bar"]                  = self.__widgets["interface"].get_widget("statusbar2")
-        self.__widgets["ups_host_entry"]              = self.__widgets["interface"].get_widget("entry1")
-        self.__widgets["ups_port_entry"]              = self.__widgets["interface"].get_widget("spinbutton1")
-        self.__widgets["ups_refresh_button"]          = self.__widgets["interface"].get_widget("button1")
-        self.__widgets["ups_authentication_check"]    = self.__widgets["interface"].get_widget("checkbutton1")
-        self.__widgets["ups_authentication_frame"]    = self.__widgets["interface"].get_widget("hbox1")
-        self.__widgets["ups_authentication_login"]    = self.__widgets["interface"].get_widget("entry2")
-        self.__widgets["ups_authentication_password"] = self.__widgets["interface"].get_widget("entry3")
-        self.__widgets["ups_list_combo"]              = self.__widgets["interface"].get_widget("combobox1")
-        self.__widgets["ups_commands_button"]         = self.__widgets["interface"].get_widget("button8")
-        self.__widgets["ups_connect"]                 = self.__widgets["interface"].get_widget("button2")
-        self.__widgets["ups_disconnect"]              = self.__widgets["interface"].get_widget("button7")
-        self.__widgets["ups_params_box"]              = self.__widgets["interface"].get_widget("vbox6")
-        self.__widgets["ups_infos"]                   = self.__widgets["interface"].get_widget("notebook1")
-        self.__widgets["ups_vars_tree"]               = self.__widgets["interface"].get_widget("treeview1")
-        self.__widgets["ups_vars_refresh"]            = self.__widgets["interface"].get_widget("button9")
-        self.__widgets["ups_status_image"]            = self.__widgets["interface"].get_widget("image1")
-        self.__widgets["ups_status_left"]             = self.__widgets["interface"].get_widget("label10")
-        self.__widgets["ups_status_right"]            = self.__widgets["interface"].get_widget("label11")
-        self.__widgets["ups_status_time"]             = self.__widgets["interface"].get_widget("label15")
-        self.__widgets["menu_favorites_root"]         = self.__widgets["interface"].get_widget("menuitem3")
-        self.__widgets["menu_favorites"]              = self.__widgets["interface"].get_widget("menu2")
-        self.__widgets["menu_favorites_add"]          = self.__widgets["interface"].get_widget("menuitem4")
-        self.__widgets["menu_favorites_del"]          = self.__widgets["interface"].get_widget("menuitem5")
-        self.__widgets["progress_battery_charge"]     = self.__widgets["interface"].get_widget("progressbar1")
-        self.__widgets["progress_battery_load"]       = self.__widgets["interface"].get_widget("progressbar2")
-
-        # Create the tray icon and connect it to the show/hide method...
-        self.__widgets["status_icon"] = gtk.StatusIcon()
-        self.__widgets["status_icon"].set_from_file( os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", "on_line.png" ) )
-        self.__widgets["status_icon"].set_visible( True )
-        self.__widgets["status_icon"].connect( "activate", self.tray_activated )
-
-        self.__widgets["ups_status_image"].set_from_file( os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", "on_line.png" ) )
-
-        # Define interface callbacks actions
-        self.__callbacks = { "on_window1_destroy"              : self.quit,
-                             "on_imagemenuitem1_activate"      : self.gui_about_dialog,
-                             "on_imagemenuitem5_activate"      : self.quit,
-                             "on_entry1_changed"               : self.__check_gui_fields,
-                             "on_entry2_changed"               : self.__check_gui_fields,
-                             "on_entry3_changed"               : self.__check_gui_fields,
-                             "on_checkbutton1_toggled"         : self.__check_gui_fields,
-                             "on_spinbutton1_value_changed"    : self.__check_gui_fields,
-                             "on_button1_clicked"              : self.__update_ups_list,
-                             "on_button2_clicked"              : self.connect_to_ups,
-                             "on_button7_clicked"              : self.disconnect_from_ups,
-                             "on_button9_clicked"              : self.__gui_update_ups_vars_view,
-                             "on_menuitem4_activate"           : self.__gui_add_favorite,
-                             "on_menuitem5_activate"           : self.__gui_delete_favorite,
-                             "on_treeview1_button_press_event" : self.__gui_ups_vars_selected
-                           }
-
-        # Connect the callbacks
-        self.__widgets["interface"].signal_autoconnect( self.__callbacks )
-
-        # Remove the dummy combobox entry on UPS List and Commands
-        self.__widgets["ups_list_combo"].remove_text( 0 )
-
-        # Set UPS vars treeview properties -----------------------------
-        store = gtk.ListStore( gtk.gdk.Pixbuf, gobject.TYPE_STRING, gobject.TYPE_STRING )
-        self.__widgets["ups_vars_tree"].set_model( store )
-        self.__widgets["ups_vars_tree"].set_headers_visible( True )
-
-        # Column 0
-        cr = gtk.CellRendererPixbuf()
-        column = gtk.TreeViewColumn( '', cr )
-        column.add_attribute( cr, 'pixbuf', 0 )
-        self.__widgets["ups_vars_tree"].append_column( column )
-
-        # Column 1
-        cr = gtk.CellRendererText()
-        cr.set_property( 'editable', False )
-        column = gtk.TreeViewColumn( _('Var name'), cr )
-        column.set_sort_column_id( 1 )
-        column.add_attribute( cr, 'text', 1 )
-        self.__widgets["ups_vars_tree"].append_column( column )
-
-        # Column 2
-        cr = gtk.CellRendererText()
-        cr.set_property( 'editable', False )
-        column = gtk.TreeViewColumn( _('Value'), cr )
-        column.add_attribute( cr, 'text', 2 )
-        self.__widgets["ups_vars_tree"].append_column( column )
-
-        self.__widgets["ups_vars_tree"].get_model().set_sort_column_id( 1, gtk.SORT_ASCENDING )
-        self.__widgets["ups_vars_tree_store"] = store
-
-        self.__widgets["ups_vars_tree"].set_size_request( -1, 50 )
-        #---------------------------------------------------------------
-
-        # UPS Commands combo box creation ------------------------------
-        container = self.__widgets["ups_commands_button"].get_parent()
-        self.__widgets["ups_commands_button"].destroy()
-        self.__widgets["ups_commands_combo"] = gtk.ComboBox()
-
-        list_store = gtk.ListStore( gobject.TYPE_STRING )
-
-        self.__widgets["ups_commands_combo"].set_model( list_store )
-        cell_renderer = gtk.CellRendererText()
-        cell_renderer.set_property( "xalign", 0 )
-        self.__widgets["ups_commands_combo"].pack_start( cell_renderer, True )
-        self.__widgets["ups_commands_combo"].add_attribute( cell_renderer, "markup", 0 )
-
-        container.pack_start( self.__widgets["ups_commands_combo"], True )
-        self.__widgets["ups_commands_combo"].set_active( 0 )
-        self.__widgets["ups_commands_combo"].show_all()
-
-        self.__widgets["ups_commands_button"] = gtk.Button( stock=gtk.STOCK_EXECUTE )
-        container.pack_start( self.__widgets["ups_commands_button"], True )
-        self.__widgets["ups_commands_button"].show()
-        self.__widgets["ups_commands_button"].connect( "clicked", self.__gui_send_ups_command )
-
-        self.__widgets["ups_commands_combo_store"] = list_store
-        #---------------------------------------------------------------
-
-        if ( cmd_opts.hidden != True ) :
-            self.__widgets["main_window"].show()
+    def __run( self, func, args ) :
+        func( *args )
 
-        # Define favorites path and load favorites
-        if ( platform.system() == "Linux" ) :
-            self.__favorites_path = os.path.join( os.environ.get("HOME"), ".nut-monitor" )
-        elif ( platform.system() == "Windows" ) :
-            self.__favorites_path = os.path.join( os.environ.get("USERPROFILE"), "Application Data", "NUT-Monitor" )
+# Created with the QApplication, see main
+dispatcher = None
 
-        self.__favorites_file = os.path.join( self.__favorites_path, "favorites.ini" )
-        self.__parse_favorites()
+#-----------------------------------------------------------------------
+# Run func( *args ) from the Qt event loop. This is the only way other
+# threads are allowed to update the GUI.
+def idle_dispatch( func, *args ) :
+    start = nutmonitor.metrics.clock()
 
-        self.gui_status_message( _("Welcome to NUT Monitor") )
+    def run() :
+        # Time waited in the event queue
+        nutmonitor.metrics.observe_since( "gui_dispatch_delay_seconds", start )
+        func( *args )
 
-        if ( cmd_opts.favorite != None ) :
-            if ( self.__favorites.has_key( cmd_opts.favorite ) ) :
-                self.__gui_load_favorite( fav_name=cmd_opts.favorite )
-                self.connect_to_ups()
-        else :
-            # Try to scan localhost for available ups and connect to it if there is only one
-            self.__widgets["ups_host_entry"].set_text( "localhost" )
-            self.__update_ups_list()
-            if ( len( self.__widgets["ups_list_combo"].get_model() ) == 1 ) :
-                self.connect_to_ups()
+    dispatcher.dispatched.emit( run, () )
 
-    # Check if correct fields are filled to enable connection to the UPS
-    def __check_gui_fields( self, widget=None ) :
-        # If UPS list contains something, clear it
-        if self.__widgets["ups_list_combo"].get_active() != -1 :
-            self.__widgets["ups_list_combo"].get_model().clear()
-            self.__widgets["ups_connect"].set_sensitive( False )
-            self.__widgets["menu_favorites_add"].set_sensitive( False )
-
-        # Host/Port selection
-        if len( self.__widgets["ups_host_entry"].get_text() ) > 0 :
-            sensitive = True
-
-            # If authentication is selected, check that we have a login and password
-            if self.__widgets["ups_authentication_check"].get_active() :
-                if len( self.__widgets["ups_authentication_login"].get_text() ) == 0 :
-                    sensitive = False
-
-                if len( self.__widgets["ups_authentication_password"].get_text() ) == 0 :
-                    sensitive = False
-
-            self.__widgets["ups_refresh_button"].set_sensitive( sensitive )
-            if not sensitive :
-                self.__widgets["ups_connect"].set_sensitive( False )
-                self.__widgets["menu_favorites_add"].set_sensitive( False )
+#-----------------------------------------------------------------------
+# Run func() from the Qt event loop after 'delay' seconds. Timers belong
+# to the GUI thread : they are started from there.
+def timeout_dispatch( delay, func ) :
+    dispatcher.dispatched.emit( QtCore.QTimer.singleShot, ( int( delay * 1000 ), func ) )
+
+#-----------------------------------------------------------------------
+# Changes reported by a polling engine (or a daemon poller), forwarded to
+# the GUI thread. The engine thread emits changed( device_id, changes,
+# error ), the connected slots run in the event loop.
+class device_bridge( QtCore.QObject ) :
+
+    changed = QtCore.pyqtSignal( str, object, object )
+
+    def __init__( self, slot ) :
+        QtCore.QObject.__init__( self )
+        self.changed.connect( slot, QtCore.Qt.QueuedConnection )
+
+    #-------------------------------------------------------------------
+    # Callback of the engine, called from its thread
+    def engine_callback( self, device_id, changes, error ) :
+        self.changed.emit( device_id, changes, error )
+
+#-----------------------------------------------------------------------
+# Notifications shown as balloon messages of the tray icon, for the
+# notification center (see nutmonitor.notify). The tray icon only shows
+# one message at a time : a new one replaces the previous one.
+class tray_notification_backend :
+
+    def __init__( self, tray_icon, icons ) :
+        if not QtWidgets.QSystemTrayIcon.supportsMessages() :
+            raise RuntimeError( "The system tray cannot show messages" )
+
+        self.__tray_icon = tray_icon
+        self.__icons     = icons
+
+    def show( self, handle, title, message, icon ) :
+        if ( icon != None ) :
+            pixmap = self.__icons.get( os.path.splitext( icon )[0] )
+            self.__tray_icon.showMessage( title, message, QtGui.QIcon( pixmap ), 10000 )
         else :
-            self.__widgets["ups_refresh_button"].set_sensitive( False )
-            self.__widgets["ups_connect"].set_sensitive( False )
-            self.__widgets["menu_favorites_add"].set_sensitive( False )
+            self.__tray_icon.showMessage( title, message, QtWidgets.QSystemTrayIcon.Information, 10000 )
+
+        return( self.__tray_icon )
+
+#-----------------------------------------------------------------------
+# Plain text describing a ups.status parsed by nutmonitor.status, and the
+# color to display it with
+def status_text( flags ) :
+    status = nutmonitor.status
+    parts  = []
+
+    if ( flags & status.OL ) :
+        parts.append( _("Online") )
+
+    if ( flags & status.OB ) :
+        parts.append( _("On batteries") )
+
+    # Additionnal information
+    for ( flag, text ) in ( ( status.LB,     _("Low batteries") ),
+                            ( status.RB,     _("Replace batteries !") ),
+                            ( status.BYPASS, "Bypass %s" % _("(no battery protection)") ),
+                            ( status.CAL,    _("Performing runtime calibration") ),
+                            ( status.OFF,    "%s (%s)" % ( _("Offline"), _("not providing power to the load") ) ),
+                            ( status.OVER,   "%s (%s)" % ( _("Overloaded !"), _("there is too much load for device") ) ),
+                            ( status.TRIM,   _("Triming (UPS is triming incoming voltage)") ),
+                            ( status.BOOST,  _("Boost (UPS is boosting incoming voltage)") ) ) :
+        if ( flags & flag ) :
+            parts.append( text )
+
+    text = " - ".join( parts )
+
+    if ( flags & status.DISCHRG ) :
+        text += " - %s" % _("discharging")
+    elif ( flags & status.CHRG ) :
+        text += " - %s" % _("charging")
+
+    return( text )
+
+def status_color( flags ) :
+    status = nutmonitor.status
+
+    if ( flags & ( status.LB | status.RB | status.OVER | status.FSD ) ) :
+        return( "#BB0000" )
+    if ( flags & status.OB ) :
+        return( "#900000" )
+    if ( flags & status.OL ) :
+        return( "#009000" )
+    return( None )
 
-        # Use authentication fields...
-        if self.__widgets["ups_authentication_check"].get_active() :
-            self.__widgets["ups_authentication_frame"].set_sensitive( True )
+#-----------------------------------------------------------------------
+# Yield the ( first, last ) bounds of the runs of consecutive numbers in
+# a sorted list : one dataChanged per run instead of one per row
+def consecutive_runs( numbers ) :
+    first = None
+    last  = None
+
+    for number in numbers :
+        if first == None :
+            first = last = number
+        elif number == last + 1 :
+            last = number
         else :
-            self.__widgets["ups_authentication_frame"].set_sensitive( False )
+            yield( ( first, last ) )
+            first = last = number
+
+    if first != None :
+        yield( ( first, last ) )
 
-        self.gui_status_message()
+#-----------------------------------------------------------------------
+# Vars of the connected device, sorted by name. apply_changes() inserts
+# and removes the rows of the vars which appeared or disappeared, and
+# only emits dataChanged for the values which changed.
+class vars_model( QtCore.QAbstractTableModel ) :
+
+    COLUMN_NAME  = 0
+    COLUMN_VALUE = 1
+
+    def __init__( self, icons=None ) :
+        QtCore.QAbstractTableModel.__init__( self )
+        self.__names   = []
+        self.__values  = {}
+        self.__rw_vars = {}
+        self.__icons   = {}
+
+        # Icons shown in front of the RW and the RO vars
+        if ( icons != None ) :
+            for name in ( "var-rw", "var-ro" ) :
+                self.__icons[ name ] = QtGui.QIcon( icons.get( name ) )
+
+    def rowCount( self, parent=QtCore.QModelIndex() ) :
+        if parent.isValid() :
+            return( 0 )
+        return( len( self.__names ) )
+
+    def columnCount( self, parent=QtCore.QModelIndex() ) :
+        if parent.isValid() :
+            return( 0 )
+        return( 2 )
+
+    def headerData( self, section, orientation, role=QtCore.Qt.DisplayRole ) :
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole :
+            return( ( _("Var name"), _("Value") )[ section ] )
+        return( None )
+
+    def data( self, index, role=QtCore.Qt.DisplayRole ) :
+        if not index.isValid() :
+            return( None )
+
+        name = self.__names[ index.row() ]
+        if role == QtCore.Qt.DisplayRole :
+            if index.column() == self.COLUMN_NAME :
+                return( name )
+            return( self.__values[ name ] )
+
+        if role == QtCore.Qt.DecorationRole and index.column() == self.COLUMN_NAME :
+            if name in self.__rw_vars :
+                return( self.__icons.get( "var-rw" ) )
+            return( self.__icons.get( "var-ro" ) )
+
+        return( None )
+
+    def get_name( self, row ) :
+        return( self.__names[ row ] )
 
     #-------------------------------------------------------------------
-    # This method is used to show/hide the main window when user clicks on the tray icon
-    def tray_activated( self, widget=None, data=None ) :
-        if self.__window_visible :
-            self.__widgets["main_window"].hide()
+    # Replace all the vars (new device)
+    def reset( self, vars, rw_vars ) :
+        self.beginResetModel()
+        self.__names   = sorted( vars )
+        self.__values  = dict( vars )
+        self.__rw_vars = dict( rw_vars )
+        self.endResetModel()
+
+    #-------------------------------------------------------------------
+    # Apply the changes of a poll, a None value removes the var
+    def apply_changes( self, changes ) :
+        names   = self.__names
+        values  = self.__values
+        updated = []
+
+        for name in sorted( changes ) :
+            value = changes[ name ]
+            if name in values :
+                if value == None :
+                    row = bisect.bisect_left( names, name )
+                    self.beginRemoveRows( QtCore.QModelIndex(), row, row )
+                    del names[ row ]
+                    del values[ name ]
+                    self.endRemoveRows()
+                elif values[ name ] != value :
+                    values[ name ] = value
+                    updated.append( name )
+
+            elif value != None :
+                row = bisect.bisect_left( names, name )
+                self.beginInsertRows( QtCore.QModelIndex(), row, row )
+                names.insert( row, name )
+                values[ name ] = value
+                self.endInsertRows()
+
+        # Rows are looked up once the rows are inserted and removed
+        rows = [ bisect.bisect_left( names, name ) for name in updated ]
+        for ( first, last ) in consecutive_runs( rows ) :
+            self.dataChanged.emit( self.index( first, self.COLUMN_VALUE ), self.index( last, self.COLUMN_VALUE ), [ QtCore.Qt.DisplayRole ] )
+
+    #-------------------------------------------------------------------
+    # upsd accepted a new value for a RW var
+    def set_rw_var( self, name, value ) :
+        self.__rw_vars[ name ] = value
+        self.apply_changes( { name : value } )
+
+#-----------------------------------------------------------------------
+# One row per favorite in the "all favorites" window. apply_changes()
+# emits dataChanged for the cells of one row, and only for the columns
+# depending on the changed vars.
+class fleet_model( QtCore.QAbstractTableModel ) :
+
+    COLUMN_NAME    = 0
+    COLUMN_DEVICE  = 1
+    COLUMN_STATUS  = 2
+    COLUMN_CHARGE  = 3
+    COLUMN_LOAD    = 4
+    COLUMN_RUNTIME = 5
+
+    # Columns depending on each var
+    VAR_COLUMNS    = { "ups.status"      : COLUMN_STATUS,
+                       "battery.charge"  : COLUMN_CHARGE,
+                       "ups.load"        : COLUMN_LOAD,
+                       "battery.runtime" : COLUMN_RUNTIME }
+
+    def __init__( self ) :
+        QtCore.QAbstractTableModel.__init__( self )
+        self.__rows    = []
+        self.__row_ids = {}
+
+    def rowCount( self, parent=QtCore.QModelIndex() ) :
+        if parent.isValid() :
+            return( 0 )
+        return( len( self.__rows ) )
+
+    def columnCount( self, parent=QtCore.QModelIndex() ) :
+        if parent.isValid() :
+            return( 0 )
+        return( 6 )
+
+    def headerData( self, section, orientation, role=QtCore.Qt.DisplayRole ) :
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole :
+            return( ( _("Favorite"), _("Device"), _("Status"), _("Battery charge"), _("UPS load"), _("Runtime") )[ section ] )
+        return( None )
+
+    #-------------------------------------------------------------------
+    # Cells hold the displayed values : [ name, device, status, charge,
+    # load, runtime, status color, ups.status, failing ]. The progress
+    # columns hold numbers, drawn by progress_delegate.
+    def data( self, index, role=QtCore.Qt.DisplayRole ) :
+        if not index.isValid() :
+            return( None )
+
+        row = self.__rows[ index.row() ]
+        if role == QtCore.Qt.DisplayRole :
+            return( row[ index.column() ] )
+
+        if role == QtCore.Qt.ForegroundRole and index.column() == self.COLUMN_STATUS and row[6] != None :
+            return( QtGui.QBrush( QtGui.QColor( row[6] ) ) )
+
+        return( None )
+
+    #-------------------------------------------------------------------
+    # Replace the rows by the given favorites, [ ( name, device ) ]
+    def set_favorites( self, favorites ) :
+        self.beginResetModel()
+        self.__rows    = [ [ name, device, _("Connecting..."), 0, 0, "", "#707070", None, False ] for ( name, device ) in favorites ]
+        self.__row_ids = dict( ( self.__rows[ i ][0], i ) for i in range( len( self.__rows ) ) )
+        self.endResetModel()
+
+    #-------------------------------------------------------------------
+    # Update the cells depending on the changed vars of a favorite (same
+    # arguments as the callback of the polling engine)
+    def apply_changes( self, device_id, changes, error=None ) :
+        index = self.__row_ids.get( device_id )
+        if index == None :
+            return
+
+        row     = self.__rows[ index ]
+        columns = set()
+
+        if "ups.status" in changes :
+            row[7] = changes["ups.status"]
+
+        if error != None :
+            row[ self.COLUMN_STATUS ] = error
+            row[6] = "#BB0000"
+            row[8] = True
+            columns.add( self.COLUMN_STATUS )
+
+        # A device answering again gets its last status back, even if it
+        # did not change meanwhile
+        elif "ups.status" in changes or row[8] :
+            row[8] = False
+            flags  = nutmonitor.status.parse( row[7] )
+            if ( flags != 0 ) :
+                row[ self.COLUMN_STATUS ] = status_text( flags )
+                row[6] = status_color( flags )
+            else :
+                row[ self.COLUMN_STATUS ] = row[7] or ""
+                row[6] = None
+            columns.add( self.COLUMN_STATUS )
+
+        for ( name, column ) in ( ( "battery.charge", self.COLUMN_CHARGE ), ( "ups.load", self.COLUMN_LOAD ) ) :
+            if name in changes :
+                value = nutmonitor.state.parse_number( changes[ name ], int ) or 0
+                if row[ column ] != value :
+                    row[ column ] = value
+                    columns.add( column )
+
+        if "battery.runtime" in changes :
+            runtime = nutmonitor.state.parse_number( changes["battery.runtime"], int )
+            if runtime != None :
+                text = time.strftime( "%H:%M:%S", time.gmtime( runtime ) )
+            else :
+                text = ""
+            if row[ self.COLUMN_RUNTIME ] != text :
+                row[ self.COLUMN_RUNTIME ] = text
+                columns.add( self.COLUMN_RUNTIME )
+
+        for ( first, last ) in consecutive_runs( sorted( columns ) ) :
+            self.dataChanged.emit( self.index( index, first ), self.index( index, last ) )
+
+#-----------------------------------------------------------------------
+# Draws a number of a cell (0 to 100) as a progress bar
+class progress_delegate( QtWidgets.QStyledItemDelegate ) :
+
+    def paint( self, painter, option, index ) :
+        value = index.data() or 0
+
+        bar = QtWidgets.QStyleOptionProgressBar()
+        bar.rect          = option.rect.adjusted( 1, 1, -1, -1 )
+        bar.minimum       = 0
+        bar.maximum       = 100
+        bar.progress      = min( max( value, 0 ), 100 )
+        bar.text          = "%d %%" % value
+        bar.textVisible   = True
+        bar.state         = option.state
+
+        QtWidgets.QApplication.style().drawControl( QtWidgets.QStyle.CE_ProgressBar, bar, painter )
+
+#-----------------------------------------------------------------------
+# Top level window telling the interface when it is closed, iconified or
+# restored
+class notifying_window( QtWidgets.QMainWindow ) :
+
+    def __init__( self, on_close, on_state_change=None ) :
+        QtWidgets.QMainWindow.__init__( self )
+        self.__on_close        = on_close
+        self.__on_state_change = on_state_change
+
+    def closeEvent( self, event ) :
+        if self.__on_close() :
+            event.accept()
         else :
-            self.__widgets["main_window"].show()
+            event.ignore()
 
-        self.__window_visible = not self.__window_visible
+    def changeEvent( self, event ) :
+        QtWidgets.QMainWindow.changeEvent( self, event )
+        if event.type() == QtCore.QEvent.WindowStateChange and self.__on_state_change != None :
+            self.__on_state_change()
+
+#-----------------------------------------------------------------------
+# Composite the fleet overlays on a tray icon : an emblem in the lower
+# right corner, the count of devices on battery in a badge in the upper
+# right one. Called once per icon and overlays, the result is kept by the
+# icon cache.
+def composite_tray_overlay( pixmap, emblem, count ) :
+    if pixmap.isNull() :
+        return( pixmap )
+
+    size   = pixmap.width()
+    result = QtGui.QPixmap( pixmap )
+    painter = QtGui.QPainter( result )
+    painter.setRenderHint( QtGui.QPainter.Antialiasing )
+
+    if ( emblem != None and not emblem.isNull() ) :
+        half = size // 2
+        painter.drawPixmap( size - half, size - half, emblem.scaled( half, half, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation ) )
+
+    if ( count != None ) :
+        diameter = size // 2
+        badge    = QtCore.QRectF( size - diameter, 0, diameter, diameter )
+        painter.setPen( QtCore.Qt.NoPen )
+        painter.setBrush( QtGui.QColor( 204, 0, 0 ) )
+        painter.drawEllipse( badge )
+
+        font = painter.font()
+        font.setBold( True )
+        font.setPixelSize( max( 1, int( diameter * 0.7 ) ) )
+        painter.setFont( font )
+        painter.setPen( QtGui.QColor( 255, 255, 255 ) )
+        painter.drawText( badge, QtCore.Qt.AlignCenter, count )
+
+    painter.end()
+    return( result )
+
+class interface :
+
+    DESIRED_FAVORITES_DIRECTORY_MODE = 0o700
+
+    # Tray icon and emblem of each fleet state (see nutmonitor.fleet)
+    FLEET_TRAY_ICONS                 = ( ( "on_line", None ),
+                                         ( "on_line", "warning" ),
+                                         ( "on_line", "warning" ),
+                                         ( "on_battery", None ),
+                                         ( "on_battery", "warning" ) )
+
+    # Vars used by each part of the status page
+    STATUS_FRAME_VARS                = ( "ups.status", "ups.mfr", "ups.model", "ups.temperature", "battery.voltage" )
+    TOOLTIP_VARS                     = ( "ups.status", "battery.charge", "ups.load" )
+
+    # Vars polled while the vars page is hidden
+    WATCHED_VARS                     = ( "ups.status", "ups.mfr", "ups.model", "ups.temperature", "battery.voltage", "battery.charge",
+                                         "ups.load", "battery.runtime", "input.voltage", "output.voltage" )
+
+    # Above this many favorites, the menu groups them by site (or host)
+    FAVORITES_MENU_LIMIT             = 20
+
+    # Most favorites listed by the search dialog
+    FAVORITES_SEARCH_LIMIT           = 200
+
+    __state                          = None
+    __device_params                  = None
+    __device_failing                 = False
+    __all_vars                       = False
+    __engine                         = None
+    __pool                           = None
+    __daemon                         = None
+    __daemon_devices                 = frozenset()
+    __daemon_socket                  = None
+    __notifications                  = None
+    __event_listener                 = None
+    __fleet_window                   = None
+    __fleet_summary                  = None
+    __quitting                       = False
+    __startup_time                   = False
+    __startup_milestones             = None
+
+    def __init__( self, cmd_opts ) :
+        self.__startup_time       = cmd_opts.startup_time
+        self.__startup_milestones = {}
+
+        self.__widgets        = {}
+        self.__fav_actions    = []
+        self.__fav_menu_stale = True
+        self.__status_flags   = nutmonitor.status.OL
+        self.__status_icon    = "on_line"
+        self.__device_tooltip = _("Not connected")
+        self.__daemon_socket  = cmd_opts.daemon_socket
+
+        # Network calls never run on the GUI thread
+        self.__workers = nutmonitor.worker.worker_pool( idle_dispatch )
+
+        # Each pixmap is decoded once for the whole program
+        self.__icons = nutmonitor.icons.icon_cache( os.path.join( os.path.dirname( os.path.abspath( sys.argv[0] ) ), "pixmaps" ),
+                                                    QtGui.QPixmap,
+                                                    lambda pixmap, size : pixmap.scaled( size, size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation ) )
+
+        # Changes of the connected device, from the polling engine thread
+        self.__bridge       = device_bridge( self.__device_changed )
+        self.__pending      = {}
+        self.__vars_pending = {}
+
+        # Widget updates are drawn once per frame, and only in the views
+        # which are displayed
+        self.__renderer = nutmonitor.render.frame_renderer( timeout_dispatch )
+        self.__renderer.add_view( "main", self.__is_window_visible )
+        self.__renderer.add_view( "vars", self.__is_vars_page_visible )
+
+        # Define favorites path and load favorites
+        self.__favorites_path = nutmonitor.favorites.get_config_path()
+        self.__favorites      = nutmonitor.favorites.favorites_store( os.path.join( self.__favorites_path, "favorites.ini" ) )
+        self.__favorites.add_listener( self.__favorites_changed )
+
+        self.__build_main_window()
+        self.gui_startup_milestone( "main window built" )
+        self.__build_tray_icon()
+        self.gui_startup_milestone( "tray icon shown" )
+
+        nutmonitor.metrics.add_collector( "icon_cache", self.__icons.stats )
+        nutmonitor.metrics.add_collector( "notifications", lambda : self.__notifications and self.__notifications.stats() )
+        nutmonitor.metrics.add_collector( "renderer", self.__renderer.stats )
+
+        self.__favorites.load()
+
+        if not cmd_opts.hidden :
+            self.__window.show()
+
+        # The connections start once the event loop runs
+        if not cmd_opts.benchmark :
+            QtCore.QTimer.singleShot( 0, lambda : self.__startup_connections( cmd_opts ) )
 
     #-------------------------------------------------------------------
-    # Change the status icon and tray icon
-    def change_status_icon( self, icon="on_line", blink=False ) :
-        self.__widgets["status_icon"].set_from_file( os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", "%s.png" % icon ) )
-        self.__widgets["ups_status_image"].set_from_file( os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", "%s.png" % icon ) )
-        self.__widgets["status_icon"].set_blinking( blink )
+    # Build the main window : connection parameters, then the status and
+    # the vars of the connected device in two tabs
+    def __build_main_window( self ) :
+        window = notifying_window( self.__window_closing, self.__window_state_changed )
+        window.setWindowTitle( _("NUT Monitor") )
+        window.setWindowIcon( QtGui.QIcon( self.__icons.get( "on_line" ) ) )
+        self.__window = window
+
+        central = QtWidgets.QWidget()
+        layout  = QtWidgets.QVBoxLayout( central )
+        window.setCentralWidget( central )
+
+        # Connection parameters
+        params = QtWidgets.QGroupBox( _("NUT Server") )
+        grid   = QtWidgets.QGridLayout( params )
+
+        host = QtWidgets.QLineEdit( "localhost" )
+        port = QtWidgets.QSpinBox()
+        port.setRange( 1, 65535 )
+        port.setValue( 3493 )
+
+        auth     = QtWidgets.QCheckBox( _("Use authentication") )
+        login    = QtWidgets.QLineEdit()
+        password = QtWidgets.QLineEdit()
+        password.setEchoMode( QtWidgets.QLineEdit.Password )
+        login.setEnabled( False )
+        password.setEnabled( False )
+        auth.toggled.connect( login.setEnabled )
+        auth.toggled.connect( password.setEnabled )
+
+        ups_list = QtWidgets.QComboBox()
+        ups_list.setMinimumContentsLength( 16 )
+        refresh  = QtWidgets.QPushButton( _("Refresh") )
+        refresh.clicked.connect( lambda : self.__update_ups_list() )
+
+        grid.addWidget( QtWidgets.QLabel( _("Host :") ), 0, 0 )
+        grid.addWidget( host, 0, 1 )
+        grid.addWidget( QtWidgets.QLabel( _("Port :") ), 0, 2 )
+        grid.addWidget( port, 0, 3 )
+        grid.addWidget( auth, 1, 0, 1, 4 )
+        grid.addWidget( QtWidgets.QLabel( _("Login :") ), 2, 0 )
+        grid.addWidget( login, 2, 1 )
+        grid.addWidget( QtWidgets.QLabel( _("Password :") ), 2, 2 )
+        grid.addWidget( password, 2, 3 )
+        grid.addWidget( QtWidgets.QLabel( _("UPS :") ), 3, 0 )
+        grid.addWidget( ups_list, 3, 1, 1, 2 )
+        grid.addWidget( refresh, 3, 3 )
+        layout.addWidget( params )
+
+        buttons    = QtWidgets.QHBoxLayout()
+        connect    = QtWidgets.QPushButton( _("Connect") )
+        disconnect = QtWidgets.QPushButton( _("Disconnect") )
+        connect.setEnabled( False )
+        disconnect.hide()
+        connect.clicked.connect( lambda : self.connect_to_ups() )
+        disconnect.clicked.connect( lambda : self.disconnect_from_ups() )
+        buttons.addStretch()
+        buttons.addWidget( connect )
+        buttons.addWidget( disconnect )
+        layout.addLayout( buttons )
+
+        # Status page
+        status_page   = QtWidgets.QWidget()
+        status_layout = QtWidgets.QGridLayout( status_page )
+
+        status_image  = QtWidgets.QLabel()
+        status_image.setPixmap( self.__icons.get( "on_line" ) )
+        status_left   = QtWidgets.QLabel()
+        status_right  = QtWidgets.QLabel()
+        status_left.setAlignment( QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft )
+        status_right.setAlignment( QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft )
+
+        charge = QtWidgets.QProgressBar()
+        load   = QtWidgets.QProgressBar()
+        for bar in ( charge, load ) :
+            bar.setRange( 0, 100 )
+            bar.setFormat( "%p %" )
+
+        runtime = QtWidgets.QLabel( _("Not available") )
+
+        commands = QtWidgets.QComboBox()
+        execute  = QtWidgets.QPushButton( _("Execute") )
+        execute.clicked.connect( lambda : self.__send_ups_command() )
+
+        status_layout.addWidget( status_image, 0, 0, 2, 1, QtCore.Qt.AlignTop )
+        status_layout.addWidget( status_left, 0, 1 )
+        status_layout.addWidget( status_right, 0, 2 )
+        status_layout.addWidget( QtWidgets.QLabel( _("Battery charge :") ), 2, 1 )
+        status_layout.addWidget( charge, 2, 2 )
+        status_layout.addWidget( QtWidgets.QLabel( _("UPS load :") ), 3, 1 )
+        status_layout.addWidget( load, 3, 2 )
+        status_layout.addWidget( QtWidgets.QLabel( _("Remaining battery time :") ), 4, 1 )
+        status_layout.addWidget( runtime, 4, 2 )
+        status_layout.addWidget( QtWidgets.QLabel( _("Command :") ), 5, 1 )
+        status_layout.addWidget( commands, 5, 2 )
+        status_layout.addWidget( execute, 5, 3 )
+        status_layout.setRowStretch( 6, 1 )
+
+        # Vars page
+        vars_page   = QtWidgets.QWidget()
+        vars_layout = QtWidgets.QVBoxLayout( vars_page )
+
+        model = vars_model( self.__icons )
+        view  = QtWidgets.QTableView()
+        view.setModel( model )
+        view.setSelectionBehavior( QtWidgets.QAbstractItemView.SelectRows )
+        view.setSelectionMode( QtWidgets.QAbstractItemView.SingleSelection )
+        view.setEditTriggers( QtWidgets.QAbstractItemView.NoEditTriggers )
+        view.verticalHeader().hide()
+        view.horizontalHeader().setStretchLastSection( True )
+        view.doubleClicked.connect( self.__ups_var_activated )
+        vars_layout.addWidget( view )
+
+        refresh_vars = QtWidgets.QPushButton( _("Refresh") )
+        refresh_vars.clicked.connect( lambda : self.__engine and self.__engine.poll_now() )
+        vars_layout.addWidget( refresh_vars, 0, QtCore.Qt.AlignRight )
+
+        infos = QtWidgets.QTabWidget()
+        infos.addTab( status_page, _("Status") )
+        infos.addTab( vars_page, _("UPS variables") )
+        infos.hide()
+        infos.currentChanged.connect( lambda index : self.__vars_page_changed() )
+        layout.addWidget( infos )
+
+        # Menus
+        menu_file = window.menuBar().addMenu( _("&File") )
+        menu_file.addAction( _("Export metrics..."), self.__export_metrics )
+        menu_file.addSeparator()
+        menu_file.addAction( _("&Quit"), self.quit, QtGui.QKeySequence.Quit )
+
+        menu_favorites = window.menuBar().addMenu( _("F&avorites") )
+        menu_favorites.aboutToShow.connect( self.__favorites_menu_shown )
+        menu_favorites.addAction( _("Add to favorites..."), self.__add_favorite )
+        menu_favorites.addAction( _("Delete a favorite..."), self.__delete_favorite )
+        menu_favorites.addAction( _("Monitor all favorites"), self.gui_show_fleet_window )
+        menu_favorites.addSeparator()
+        menu_favorites.addAction( _("Search favorites..."), self.__search_favorites )
+        menu_favorites.addAction( _("Import favorites..."), self.__import_favorites )
+        menu_favorites.addAction( _("Export favorites..."), self.__export_favorites )
+        menu_favorites.addSeparator()
+
+        menu_help = window.menuBar().addMenu( _("&Help") )
+        menu_help.addAction( _("&About"), self.__about_dialog )
+
+        self.__widgets.update( { "ups_host_entry"              : host,
+                                 "ups_port_entry"              : port,
+                                 "ups_authentication_check"    : auth,
+                                 "ups_authentication_login"    : login,
+                                 "ups_authentication_password" : password,
+                                 "ups_list_combo"              : ups_list,
+                                 "ups_params_box"              : params,
+                                 "ups_connect"                 : connect,
+                                 "ups_disconnect"              : disconnect,
+                                 "ups_infos"                   : infos,
+                                 "ups_status_image"            : status_image,
+                                 "ups_status_left"             : status_left,
+                                 "ups_status_right"            : status_right,
+                                 "progress_battery_charge"     : charge,
+                                 "progress_battery_load"       : load,
+                                 "ups_status_time"             : runtime,
+                                 "ups_commands_combo"          : commands,
+                                 "ups_vars_tree"               : view,
+                                 "ups_vars_model"              : model,
+                                 "menu_favorites"              : menu_favorites } )
+
+    def __build_tray_icon( self ) :
+        tray = QtWidgets.QSystemTrayIcon( QtGui.QIcon( self.__icons.get( "on_line" ) ) )
+        tray.setToolTip( self.__device_tooltip )
+        tray.activated.connect( self.__tray_activated )
+        tray.show()
+        self.__widgets["status_icon"] = tray
 
     #-------------------------------------------------------------------
-    # This method connects to the NUT server and retrieve availables UPSes
-    # using connection parameters (host, port, login, pass...)
-    def __update_ups_list( self, widget=None ) :
+    # Start the connections requested on the command line, or look for a
+    # single UPS on localhost
+    def __startup_connections( self, cmd_opts ) :
+        self.gui_startup_milestone( "main loop running" )
+
+        # The "all favorites" window reads the daemon when one runs
+        if ( cmd_opts.all_favorites ) :
+            self.__find_daemon( self.gui_show_fleet_window )
+        else :
+            self.__find_daemon( lambda : None )
 
-        host     = self.__widgets["ups_host_entry"].get_text()
-        port     = int( self.__widgets["ups_port_entry"].get_value() )
-        login    = None
-        password = None
+        if ( cmd_opts.event_socket != None ) :
+            self.__start_event_listener( cmd_opts.event_socket )
+
+        if ( cmd_opts.favorite != None ) :
+            if ( cmd_opts.favorite in self.__favorites ) :
+                self.__load_favorite( cmd_opts.favorite )
+                self.connect_to_ups()
+        else :
+            self.__update_ups_list( auto_connect=True )
+
+    #-------------------------------------------------------------------
+    # Record the time elapsed since the program started the first time a
+    # startup milestone is reached, and print it if --startup-time is set
+    def gui_startup_milestone( self, name ) :
+        if name in self.__startup_milestones :
+            return
 
-        if self.__widgets["ups_authentication_check"].get_active() :
-            login    = self.__widgets["ups_authentication_login"].get_text()
-            password = self.__widgets["ups_authentication_password"].get_text()
+        elapsed = ( time.time() - STARTUP_TIME ) * 1000.0
+        self.__startup_milestones[ name ] = elapsed
 
-        try :
-            nut_handler = PyNUT.PyNUTClient( host=host, port=port, login=login, password=password )
-            upses = nut_handler.GetUPSList()
+        if self.__startup_time :
+            print( "startup: %-24s %8.1f ms" % ( name, elapsed ) )
+
+    #-------------------------------------------------------------------
+    # Return the connection pool, created on first use : PyNUT is only
+    # imported once a upsd server is contacted
+    def __get_pool( self ) :
+        if self.__pool == None :
+            import nutmonitor.pool
 
-            ups_list = upses.keys()
-            ups_list.sort()
+            self.__pool = nutmonitor.pool.connection_pool()
+            self.__pool.add_listener( lambda key, state, error : idle_dispatch( self.__pool_state_changed, key, state, error ) )
 
-            # If UPS list contains something, clear it
-            self.__widgets["ups_list_combo"].get_model().clear()
+        return( self.__pool )
 
-            for current in ups_list :
-                self.__widgets["ups_list_combo"].append_text( current )
+    def __pool_state_changed( self, key, state, error ) :
+        import nutmonitor.pool
 
-            self.__widgets["ups_list_combo"].set_active( 0 )
+        host = key[0]
+        if state == nutmonitor.pool.STATE_DOWN :
+            self.gui_status_message( _("Lost connection to '{0}' ({1})").format( host, error ) )
+            self.gui_status_notification( _("Lost connection to '{0}'\n{1}").format( host, error ), "warning.png", "%s:%s" % ( host, key[1] ), "connection" )
+        else :
+            self.gui_status_message( _("Connection to '{0}' restored").format( host ) )
+            self.gui_status_notification( _("Connection to '{0}' restored").format( host ), "on_line.png", "%s:%s" % ( host, key[1] ), "connection" )
 
-            self.__widgets["ups_connect"].set_sensitive( True )
-            self.__widgets["menu_favorites_add"].set_sensitive( True )
+    #-------------------------------------------------------------------
+    # Look for a running daemon, from a worker thread : the devices it
+    # monitors are then read from it instead of being polled again.
+    # on_done() is called from the event loop once the daemon is found,
+    # or not.
+    def __find_daemon( self, on_done ) :
+        import nutmonitor.daemon
 
-            self.gui_status_message( _("Found {0} devices on {1}").format( len( ups_list ), host ) )
+        if ( self.__daemon_socket == None ) :
+            self.__daemon_socket = nutmonitor.daemon.default_socket_path()
 
-        except :
-            error_msg = _("Error connecting to '{0}' ({1})").format( host, sys.exc_info()[1] )
-            self.gui_status_message( error_msg )
+        client = nutmonitor.daemon.daemon_client( self.__daemon_socket )
+        self.__workers.submit( self.__probe_daemon, ( client, ),
+                               on_success=lambda devices : self.__daemon_found( client, devices, on_done ),
+                               on_error=lambda error : on_done() )
 
     #-------------------------------------------------------------------
-    # Quit program
-    def quit( self, widget=None ) :
-        # If we are connected to an UPS, disconnect first...
-        if self.__connected :
-            self.gui_status_message( _("Disconnecting from device") )
-            self.disconnect_from_ups()
+    # Runs in a worker thread : return the devices monitored by the
+    # daemon, None if it does not run
+    def __probe_daemon( self, client ) :
+        if not client.is_running() :
+            return( None )
+        return( set( d["device"] for d in client.request( "devices" )["devices"].values() ) )
+
+    def __daemon_found( self, client, devices, on_done ) :
+        if ( devices != None ) :
+            self.__daemon         = client
+            self.__daemon_devices = devices
+        on_done()
+
+    def get_daemon( self ) :
+        return( self.__daemon )
 
-        gtk.main_quit()
+    #-------------------------------------------------------------------
+    # Return the daemon client if a daemon monitors 'device', None
+    # otherwise
+    def get_device_daemon( self, device ) :
+        if device in self.__daemon_devices :
+            return( self.__daemon )
+        return( None )
 
     #-------------------------------------------------------------------
-    # Method called when user wants to add a new favorite entry. It
-    # displays a dialog to enable user to select the name of the favorite
-    def __gui_add_favorite( self, widget=None ) :
-        dialog_interface = gtk.glade.XML( self.__glade_file, "dialog1" )
-        dialog = dialog_interface.get_widget( "dialog1" )
+    # Listen to the upsmon events sent by nut-monitor-notify
+    def __start_event_listener( self, socket_path ) :
+        import nutmonitor.events
 
-        self.__widgets["favorites_dialog_button_add"] = dialog_interface.get_widget("button3")
+        listener = nutmonitor.events.event_listener( socket_path, self.__power_event )
+        try :
+            listener.open()
+        except nutmonitor.events.event_error as e :
+            self.gui_status_message( str( e ) )
+            return
 
-        # Define interface callbacks actions
-        callbacks = { "on_entry4_changed" : self.__gui_add_favorite_check_gui_fields }
-        dialog_interface.signal_autoconnect( callbacks )
+        listener.start()
+        self.__event_listener = listener
 
-        self.__widgets["main_window"].set_sensitive( False )
-        rc = dialog.run()
-        if rc == 1 :
-            fav_data = {}
-            fav_data["host"] = self.__widgets["ups_host_entry"].get_text()
-            fav_data["port"] = "%d" % self.__widgets["ups_port_entry"].get_value()
-            fav_data["ups"]  = self.__widgets["ups_list_combo"].get_active_text()
-            fav_data["auth"] = self.__widgets["ups_authentication_check"].get_active()
-            if fav_data["auth"] :
-                fav_data["login"]    = self.__widgets["ups_authentication_login"].get_text()
-                fav_data["password"] = base64.b64encode( self.__widgets["ups_authentication_password"].get_text() )
+    #-------------------------------------------------------------------
+    # Called from the listener thread : poll the devices of the UPS now
+    def __power_event( self, event, ups_name ) :
+        import nutmonitor.events
 
-            fav_name = dialog_interface.get_widget("entry4").get_text()
-            self.__favorites[ fav_name ] = fav_data
-            self.__gui_refresh_favorites_menu()
+        nutmonitor.metrics.count( "power_events_total", { "event" : event } )
 
-            # Save all favorites
-            self.__save_favorites()
+        ( engine, state ) = ( self.__engine, self.__state )
+        if engine != None and state != None and len( nutmonitor.events.match_devices( ups_name, [ state.device ] ) ) > 0 :
+            engine.poll_now()
 
-        dialog.destroy()
-        self.__widgets["main_window"].set_sensitive( True )
+        fleet = self.__fleet_window
+        if fleet != None :
+            fleet.poll_now( ups_name )
 
     #-------------------------------------------------------------------
-    # Method called when user wants to delete an entry from favorites
-    def __gui_delete_favorite( self, widget=None ) :
+    # Return the connection parameters (host, port, login, pass) from the GUI
+    def __get_connection_params( self ) :
+        host     = self.__widgets["ups_host_entry"].text()
+        port     = self.__widgets["ups_port_entry"].value()
+        login    = None
+        password = None
+
+        if self.__widgets["ups_authentication_check"].isChecked() :
+            login    = self.__widgets["ups_authentication_login"].text()
+            password = self.__widgets["ups_authentication_password"].text()
+
+        return( ( host, port, login, password ) )
 
-        dialog_interface = gtk.glade.XML( self.__glade_file, "dialog2" )
-        dialog = dialog_interface.get_widget( "dialog2" )
+    #-------------------------------------------------------------------
+    # Retrieve the UPS list of the server on a worker thread. If
+    # 'auto_connect' is set and the server has only one UPS, connect to it.
+    def __update_ups_list( self, auto_connect=False ) :
+        ( host, port, login, password ) = self.__get_connection_params()
+        handler = self.__get_pool().get( host, port, login, password )
+
+        self.gui_status_message( _("Connecting to '%s'...") % host )
+        self.__workers.submit( handler.GetUPSList,
+                               on_success=lambda upses : self.__ups_list_received( host, upses, auto_connect ),
+                               on_error=lambda error : self.gui_status_message( _("Error connecting to '{0}' ({1})").format( host, error ) ) )
+
+    def __ups_list_received( self, host, upses, auto_connect ) :
+        # The user changed the host in the meantime, drop the result
+        if self.__widgets["ups_host_entry"].text() != host :
+            return
 
-        # Remove the dummy combobox entry on list
-        dialog_interface.get_widget("combobox2").remove_text( 0 )
+        combo = self.__widgets["ups_list_combo"]
+        combo.clear()
+        combo.addItems( sorted( upses ) )
 
-        favs = self.__favorites.keys()
-        favs.sort()
-        for current in favs :
-            dialog_interface.get_widget("combobox2").append_text( current )
+        self.__widgets["ups_connect"].setEnabled( len( upses ) > 0 )
+        self.gui_status_message( _("Found {0} devices on {1}").format( len( upses ), host ) )
 
-        dialog_interface.get_widget("combobox2").set_active( 0 )
+        if auto_connect and len( upses ) == 1 :
+            self.connect_to_ups()
 
-        self.__widgets["main_window"].set_sensitive( False )
-        rc = dialog.run()
-        fav_name = dialog_interface.get_widget("combobox2").get_active_text()
-        dialog.destroy()
-        self.__widgets["main_window"].set_sensitive( True )
+    #-------------------------------------------------------------------
+    # Connect to the selected UPS. Its infos are retrieved on a worker
+    # thread, then an engine polls it.
+    def connect_to_ups( self ) :
+        ( host, port, login, password ) = self.__get_connection_params()
+        ups = self.__widgets["ups_list_combo"].currentText()
 
-        if ( rc == 1 ) :
-            # Remove entry, show confirmation dialog
-            md = gtk.MessageDialog( None, gtk.DIALOG_MODAL, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO, _("Are you sure that you want to remove this favorite ?") )
-            resp = md.run()
-            md.destroy()
+        self.__widgets["ups_connect"].setEnabled( False )
+        self.gui_status_message( _("Connecting to '{0}' on {1}...").format( ups, host ) )
 
-            if ( resp == gtk.RESPONSE_YES ) :
-                del self.__favorites[ fav_name ]
-                self.__gui_refresh_favorites_menu()
-                self.__save_favorites()
-                self.gui_status_message( _("Removed favorite '%s'") % fav_name )
+        self.__workers.submit( self.__fetch_ups_infos, ( self.__get_pool().get( host, port, login, password ), ups ),
+                               on_success=lambda infos : self.__ups_connected( ( host, port, login, password ), ups, infos ),
+                               on_error=lambda error : self.__ups_connection_failed( host, error ) )
 
     #-------------------------------------------------------------------
-    # Method called when user selects a favorite from the favorites menu
-    def __gui_load_favorite( self, fav_name="" ) :
+    # Runs on a worker thread : retrieve what is needed to display the UPS
+    def __fetch_ups_infos( self, handler, ups ) :
+        if ups not in handler.GetUPSList() :
+            return( None )
+
+        return( ( handler, handler.GetUPSCommands( ups ), handler.GetUPSVars( ups ), handler.GetRWVars( ups ) ) )
 
-        if ( self.__favorites.has_key( fav_name ) ) :
-            # If auth is activated, process it before other fields to avoir weird
-            # reactions with the 'check_gui_fields' function.
-            if ( self.__favorites[fav_name].get("auth", False ) ) :
-                self.__widgets["ups_authentication_check"].set_active( True )
-                self.__widgets["ups_authentication_login"].set_text( self.__favorites[fav_name].get("login","") )
-                self.__widgets["ups_authentication_password"].set_text( self.__favorites[fav_name].get("password","") )
+    def __ups_connection_failed( self, host, error ) :
+        self.__widgets["ups_connect"].setEnabled( True )
+        self.gui_status_message( _("Error connecting to '{0}' ({1})").format( host, error ) )
+        self.gui_status_notification( _("Error connecting to '{0}'\n{1}").format( host, error ), "warning.png", host, "connection" )
+
+    def __ups_connected( self, params, ups, infos ) :
+        import nutmonitor.daemon
+        import nutmonitor.engine
+
+        ( host, port, login, password ) = params
+        self.__widgets["ups_connect"].setEnabled( True )
+
+        if infos == None :
+            self.gui_status_message( _("Device '%s' not found on server") % ups )
+            return
+
+        ( handler, commands, vars, rw_vars ) = infos
+        self.__state = nutmonitor.state.ups_state( "%s@%s:%d" % ( ups, host, port ), host, ups, handler, commands.keys(), vars, rw_vars )
+
+        self.__widgets["ups_connect"].hide()
+        self.__widgets["ups_disconnect"].show()
+        self.__widgets["ups_params_box"].hide()
+        self.__widgets["ups_infos"].show()
+        self.__widgets["menu_favorites"].setEnabled( False )
+
+        combo = self.__widgets["ups_commands_combo"]
+        combo.clear()
+        for name in self.__state.commands :
+            combo.addItem( name )
+            combo.setItemData( combo.count() - 1, commands[ name ], QtCore.Qt.ToolTipRole )
+
+        self.__widgets["ups_vars_model"].reset( vars, rw_vars )
+        self.__draw_status( vars )
+        self.__draw_tooltip()
+        self.gui_startup_milestone( "first UPS status" )
+
+        # The engine reports the changes of each poll, through the bridge.
+        # The whole LIST VAR is only polled while the vars page is displayed.
+        self.__device_params = ( host, port, ups, login, password )
+        self.__all_vars      = self.__is_vars_page_visible()
+        daemon = self.get_device_daemon( self.__state.device )
+        if daemon != None :
+            # The daemon already polls this device : read it from there
+            self.__engine = nutmonitor.daemon.daemon_poller( daemon, self.__bridge.engine_callback )
+        else :
+            self.__engine = nutmonitor.engine.polling_engine( self.__bridge.engine_callback )
+        self.__add_engine_device()
+        self.__engine.set_hidden( not self.__is_window_visible() )
+        self.__engine.start()
 
-            self.__widgets["ups_host_entry"].set_text( self.__favorites[fav_name].get("host","") )
-            self.__widgets["ups_port_entry"].set_value( float(self.__favorites[fav_name].get("port",3493.0)) )
+        self.gui_status_message( _("Connected to '{0}' on {1}").format( ups, host ) )
 
-            # Clear UPS list and add current UPS name
-            self.__widgets["ups_list_combo"].get_model().clear()
+    def __add_engine_device( self ) :
+        ( host, port, ups, login, password ) = self.__device_params
+        if self.__all_vars :
+            watch = None
+        else :
+            watch = self.WATCHED_VARS
+        self.__engine.add_device( self.__state.device, host, port, ups, login, password, watch )
 
-            self.__widgets["ups_list_combo"].append_text( self.__favorites[fav_name].get("ups","") )
-            self.__widgets["ups_list_combo"].set_active( 0 )
+    #-------------------------------------------------------------------
+    # Disconnect from the UPS
+    def disconnect_from_ups( self ) :
+        if self.__engine != None :
+            self.__engine.stop_thread()
+            self.__engine = None
+
+        for view in ( "main", "vars", "tray" ) :
+            self.__renderer.discard( view )
+        self.__pending         = {}
+        self.__vars_pending    = {}
+        self.__device_params   = None
+        self.__device_failing  = False
+        self.__all_vars        = False
 
-            # Activate the connect button
-            self.__widgets["ups_connect"].set_sensitive( True )
+        self.__widgets["ups_connect"].show()
+        self.__widgets["ups_disconnect"].hide()
+        self.__widgets["ups_infos"].hide()
+        self.__widgets["ups_params_box"].show()
+        self.__widgets["menu_favorites"].setEnabled( True )
+        self.__widgets["ups_vars_model"].reset( {}, {} )
+        self.__window.adjustSize()
 
-            self.gui_status_message( _("Loaded '%s'") % fav_name )
+        if self.__state != None :
+            self.gui_status_message( _("Disconnected from '%s'") % self.__state.ups )
+        self.__state        = None
+        self.__status_flags = nutmonitor.status.OL
+        self.gui_device_tooltip( _("Not connected") )
+        self.change_status_icon( "on_line" )
 
     #-------------------------------------------------------------------
-    # Send the selected command to the UPS
-    def __gui_send_ups_command( self, widget=None ) :
-        offset = self.__widgets["ups_commands_combo"].get_active()
-        cmd    = self.__ups_commands[ offset ]
+    # Slot of the bridge, runs in the event loop : the state and the
+    # status icon follow the changes at once, the widgets depending on the
+    # changed vars are drawn by the frame renderer
+    def __device_changed( self, device_id, changes, error ) :
+        state = self.__state
+        if state == None or device_id != state.device :
+            # Queued before the disconnection
+            return
 
-        md = gtk.MessageDialog( None, gtk.DIALOG_MODAL, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO, _("Are you sure that you want to send\n'%s' to the device ?") % cmd )
-        self.__widgets["main_window"].set_sensitive( False )
-        resp = md.run()
-        md.destroy()
-        self.__widgets["main_window"].set_sensitive( True )
+        if error != None :
+            self.__device_failing = True
+            self.gui_status_message( _("Error from '{0}' ({1})").format( state.ups, error ) )
+            self.gui_status_notification( _("Error from '{0}'\n{1}").format( state.ups, error ), "warning.png", state.device, "error" )
+            return
 
-        if ( resp == gtk.RESPONSE_YES ) :
-            try :
-                self.__ups_handler.RunUPSCommand( self.__current_ups, cmd )
-                self.gui_status_message( _("Sent '{0}' command to {1}").format( cmd, self.__current_ups ) )
+        if self.__device_failing :
+            self.__device_failing = False
+            self.gui_status_message( _("Connected to '{0}' on {1}").format( state.ups, state.host ) )
 
-            except :
-                self.gui_status_message( _("Failed to send '{0}' ({1})").format( cmd, sys.exc_info()[1] ) )
+        vars = dict( state.snapshot.vars )
+        for ( name, value ) in changes.items() :
+            if value == None :
+                vars.pop( name, None )
+            else :
+                vars[ name ] = value
+        state.publish( vars, changes )
+
+        if "ups.status" in changes :
+            self.__apply_status( state.snapshot.flags )
+
+        self.__pending.update( changes )
+        self.__vars_pending.update( changes )
+
+        renderer = self.__renderer
+        renderer.update( "main", "status", self.__draw_pending )
+        renderer.update( "vars", "ups_vars", self.__draw_vars )
+        if any( name in changes for name in self.TOOLTIP_VARS ) :
+            renderer.update( "tray", "tooltip", self.__draw_tooltip )
+
+    def __draw_pending( self ) :
+        changes        = self.__pending
+        self.__pending = {}
+        if self.__state != None :
+            start = nutmonitor.metrics.clock()
+            self.__draw_status( changes )
+            if ( start != None ) :
+                nutmonitor.metrics.observe_since( "gui_update_seconds", start, { "part" : "status" } )
+
+    def __draw_vars( self ) :
+        changes             = self.__vars_pending
+        self.__vars_pending = {}
+        if self.__state != None :
+            start = nutmonitor.metrics.clock()
+            self.__widgets["ups_vars_model"].apply_changes( changes )
+            if ( start != None ) :
+                nutmonitor.metrics.observe_since( "gui_update_seconds", start, { "part" : "vars" } )
 
     #-------------------------------------------------------------------
-    # Method called when user clicks on the UPS vars treeview. If the user
-    # performs a double click on a RW var, the GUI shows the update var dialog.
-    def __gui_ups_vars_selected( self, widget, event ) :
-        # Check if it's a double click...
-        if ( (event.button == 1) and (event.type == gtk.gdk._2BUTTON_PRESS) ) :
-            treeselection = self.__widgets["ups_vars_tree"].get_selection()
-            (model,iter)  = treeselection.get_selected()
-            try :
-                ups_var = model.get_value( iter, 1 )
-                if ( ups_var in self.__ups_rw_vars ) :
-                    # The selected var is RW, then we can show the update dialog
-                    dialog_interface = gtk.glade.XML( self.__glade_file, "dialog3" )
-                    dialog = dialog_interface.get_widget( "dialog3" )
+    # Status icon and notifications, depending on the status flags which
+    # changed
+    def __apply_status( self, flags ) :
+        device = self.__state.device
 
-                    lab = dialog_interface.get_widget( "label9" )
-                    lab.set_markup( _("Enter a new value for the variable.\n\n{0} = {1} <span color=\"#606060\"><i>(current value)</i></span>").format( ups_var, self.__ups_rw_vars.get(ups_var)) )
+        ( raised, cleared ) = nutmonitor.status.transitions( self.__status_flags, flags )
+        self.__status_flags = flags
 
-                    str = dialog_interface.get_widget( "entry5" )
-                    str.set_text( self.__ups_rw_vars.get(ups_var) )
+        if ( raised & nutmonitor.status.OB ) :
+            self.change_status_icon( "on_battery" )
+            self.gui_status_notification( _("Device is running on batteries"), "on_battery.png", device, "on_battery" )
+        elif ( cleared & nutmonitor.status.OB ) :
+            self.change_status_icon( "on_line" )
 
-                    self.__widgets["main_window"].set_sensitive( False )
-                    rc = dialog.run()
-                    new_val = str.get_text()
-                    dialog.destroy()
-                    self.__widgets["main_window"].set_sensitive( True )
+        if ( raised & nutmonitor.status.LB ) :
+            self.gui_status_notification( _("Device batteries are low"), "warning.png", device, "low_battery" )
 
-                    if ( rc == 1 ) :
-                        try :
-                            self.__ups_handler.SetRWVar( ups=self.__current_ups, var=ups_var, value=new_val )
-                            self.gui_status_message( _("Updated variable on %s") % self.__current_ups )
+        if ( raised & nutmonitor.status.RB ) :
+            self.gui_status_notification( _("Device batteries need to be replaced"), "warning.png", device, "replace_battery" )
 
-                            # Change the value on the local dict to update the GUI
-                            self.__ups_vars[ups_var]    = new_val
-                            self.__ups_rw_vars[ups_var] = new_val
-                            self.__gui_update_ups_vars_view()
+    #-------------------------------------------------------------------
+    # Status page : only the widgets depending on the changed vars are set
+    def __draw_status( self, changes ) :
+        snapshot = self.__state.snapshot
+
+        if any( name in changes for name in self.STATUS_FRAME_VARS ) :
+            text_left  = "<b>%s</b>" % _("Device status :")
+            text_right = "<span style=\"color:%s\"><b>%s</b></span>" % ( status_color( snapshot.flags ) or "#000000", status_text( snapshot.flags ).replace( "&", "&amp;" ) )
+
+            if ( snapshot.has_key( "ups.mfr" ) ) :
+                text_left  += "<br><b>%s</b><br>" % _("Model :")
+                text_right += "<br>%s<br>%s" % ( snapshot.get("ups.mfr",""), snapshot.get("ups.model","") )
+
+            if ( snapshot.temperature != None ) :
+                text_left  += "<br><b>%s</b>" % _("Temperature :")
+                text_right += "<br>%d" % snapshot.temperature
+
+            if ( snapshot.has_key( "battery.voltage" ) ) :
+                text_left  += "<br><b>%s</b>" % _("Battery voltage :")
+                text_right += "<br>%sv" % snapshot.get( "battery.voltage", 0 )
+
+            self.__widgets["ups_status_left"].setText( text_left )
+            self.__widgets["ups_status_right"].setText( text_right )
+
+        for ( name, attribute, widget ) in ( ( "battery.charge", "charge", "progress_battery_charge" ), ( "ups.load", "load", "progress_battery_load" ) ) :
+            if name in changes :
+                value = getattr( snapshot, attribute )
+                bar   = self.__widgets[ widget ]
+                if ( value != None ) :
+                    bar.setValue( int( min( max( value, 0 ), 100 ) ) )
+                    bar.setFormat( "%d %%" % value )
+                else :
+                    bar.setValue( 0 )
+                    bar.setFormat( _("Not available") )
+
+        if "battery.runtime" in changes :
+            autonomy = snapshot.runtime
+            if ( autonomy != None ) :
+                if ( autonomy >= 3600 ) :
+                    info = time.strftime( _("<b>%H hours %M minutes %S seconds</b>"), time.gmtime( autonomy ) )
+                elif ( autonomy > 300 ) :
+                    info = time.strftime( _("<b>%M minutes %S seconds</b>"), time.gmtime( autonomy ) )
+                else :
+                    info = time.strftime( _("<b><span style=\"color:#DD0000\">%M minutes %S seconds</span></b>"), time.gmtime( autonomy ) )
+            else :
+                info = _("Not available")
+            self.__widgets["ups_status_time"].setText( info )
 
-                        except :
-                            error_msg = _("Error updating variable on '{0}' ({1})").format( self.__current_ups, sys.exc_info()[1] )
-                            self.gui_status_message( error_msg )
+    def __draw_tooltip( self ) :
+        if self.__state == None :
+            return
+
+        snapshot = self.__state.snapshot
+        tooltip  = status_text( snapshot.flags )
+        if ( snapshot.charge != None ) :
+            tooltip += "\n%s %d%%" % ( _("Battery charge :"), snapshot.charge )
+        if ( snapshot.load != None ) :
+            tooltip += "\n%s %d%%" % ( _("UPS load :"), snapshot.load )
+        self.gui_device_tooltip( tooltip )
 
-                    else :
-                        # User cancelled modification...
-                        error_msg = _("No variable modified on %s - User cancelled") % self.__current_ups
-                        self.gui_status_message( error_msg )
+    #-------------------------------------------------------------------
+    # Send the selected command to the UPS
+    def __send_ups_command( self ) :
+        state = self.__state
+        cmd   = self.__widgets["ups_commands_combo"].currentText()
+        if state == None or cmd == "" :
+            return
 
-            except :
-                # Failed to get information from the treeview... skip action
-                pass
+        resp = QtWidgets.QMessageBox.question( self.__window, _("NUT Monitor"), _("Are you sure that you want to send\n'%s' to the device ?") % cmd )
+        if ( resp == QtWidgets.QMessageBox.Yes ) :
+            ups = state.ups
+            self.__workers.submit( state.handler.RunUPSCommand, ( ups, cmd ),
+                                   on_success=lambda result : self.gui_status_message( _("Sent '{0}' command to {1}").format( cmd, ups ) ),
+                                   on_error=lambda error : self.gui_status_message( _("Failed to send '{0}' ({1})").format( cmd, error ) ) )
 
     #-------------------------------------------------------------------
-    # Refresh the content of the favorites menu according to the defined favorites
-    def __gui_refresh_favorites_menu( self ) :
-        for current in self.__fav_menu_items :
-            current.destroy()
+    # Double click on a var : RW vars can be changed
+    def __ups_var_activated( self, index ) :
+        state = self.__state
+        if state == None :
+            return
 
-        self.__fav_menu_items = list()
+        ups_var = self.__widgets["ups_vars_model"].get_name( index.row() )
+        if ups_var not in state.rw_vars :
+            return
 
-        items = self.__favorites.keys()
-        items.sort()
+        ( new_val, ok ) = QtWidgets.QInputDialog.getText( self.__window, _("NUT Monitor"),
+                                                          _("Enter a new value for the variable.\n\n{0} = {1} (current value)").format( ups_var, state.rw_vars.get( ups_var ) ),
+                                                          QtWidgets.QLineEdit.Normal, state.rw_vars.get( ups_var ) )
+        if not ok :
+            self.gui_status_message( _("No variable modified on %s - User cancelled") % state.ups )
+            return
 
-        for current in items :
-            menu_item = gtk.MenuItem( current )
-            menu_item.show()
-            self.__fav_menu_items.append( menu_item )
-            self.__widgets["menu_favorites"].append( menu_item )
+        ups = state.ups
+        self.__workers.submit( lambda : state.handler.SetRWVar( ups=ups, var=ups_var, value=new_val ),
+                               on_success=lambda result : self.__rw_var_updated( state, ups_var, new_val ),
+                               on_error=lambda error : self.gui_status_message( _("Error updating variable on '{0}' ({1})").format( ups, error ) ) )
 
-            menu_item.connect_object( "activate", self.__gui_load_favorite, current )
+    #-------------------------------------------------------------------
+    # Called once the upsd server accepted the new value of a RW var
+    def __rw_var_updated( self, state, ups_var, new_val ) :
+        self.gui_status_message( _("Updated variable on %s") % state.ups )
+        state.set_var( ups_var, new_val )
+        if state is self.__state :
+            self.__widgets["ups_vars_model"].set_rw_var( ups_var, new_val )
 
-        if len( items ) > 0 :
-            self.__widgets["menu_favorites_del"].set_sensitive( True )
-        else :
-            self.__widgets["menu_favorites_del"].set_sensitive( False )
+    #-------------------------------------------------------------------
+    # Favorites menu entries follow the changes of the store. They are
+    # built again the next time the menu opens.
+    def __favorites_changed( self, name, old, new ) :
+        self.__fav_menu_stale = True
 
     #-------------------------------------------------------------------
-    # In 'add favorites' dialog, this method compares the content of the
-    # text widget representing the name of the new favorite with existing
-    # ones. If they match, the 'add' button will be set to non sensitive
-    # to avoid creating entries with the same name.
-    def __gui_add_favorite_check_gui_fields( self, widget=None ) :
-        fav_name = widget.get_text()
-        if ( len( fav_name ) > 0 ) and ( fav_name not in self.__favorites.keys() ) :
-            self.__widgets["favorites_dialog_button_add"].set_sensitive( True )
+    # Up to FAVORITES_MENU_LIMIT favorites are listed as is, above that
+    # they are grouped by site (or host) in submenus which are filled when
+    # opened
+    def __favorites_menu_shown( self ) :
+        if not self.__fav_menu_stale :
+            return
+        self.__fav_menu_stale = False
+
+        menu = self.__widgets["menu_favorites"]
+        for action in self.__fav_actions :
+            menu.removeAction( action )
+
+        self.__fav_actions = []
+        if len( self.__favorites ) > self.FAVORITES_MENU_LIMIT :
+            for group in self.__favorites.groups() :
+                submenu = menu.addMenu( group )
+                submenu.aboutToShow.connect( lambda submenu=submenu, group=group : self.__favorites_group_shown( submenu, group ) )
+                self.__fav_actions.append( submenu.menuAction() )
         else :
-            self.__widgets["favorites_dialog_button_add"].set_sensitive( False )
+            for fav_name in self.__favorites.names() :
+                self.__fav_actions.append( self.__add_favorite_action( menu, fav_name ) )
+
+    def __favorites_group_shown( self, submenu, group ) :
+        if submenu.isEmpty() :
+            for fav_name in self.__favorites.names( group ) :
+                self.__add_favorite_action( submenu, fav_name )
+
+    def __add_favorite_action( self, menu, fav_name ) :
+        action = menu.addAction( fav_name )
+        action.triggered.connect( lambda checked=False, fav_name=fav_name : self.__load_favorite( fav_name ) )
+        return( action )
 
     #-------------------------------------------------------------------
-    # Load and parse favorites
-    def __parse_favorites( self ) :
+    # Search box of the favorites : lists the favorites whose name, site,
+    # host or UPS name contain the typed text, and loads the chosen one
+    def __search_favorites( self ) :
+        if len( self.__favorites ) == 0 :
+            return
+
+        dialog = QtWidgets.QDialog( self.__window )
+        dialog.setWindowTitle( _("Search favorites") )
+        dialog.resize( 420, 320 )
+
+        entry   = QtWidgets.QLineEdit()
+        results = QtWidgets.QTreeWidget()
+        results.setHeaderLabels( [ _("Favorite"), _("Device") ] )
+        results.setRootIsDecorated( False )
+        buttons = QtWidgets.QDialogButtonBox( QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel )
+
+        def search_changed( text ) :
+            results.clear()
+            for name in self.__favorites.search( text, self.FAVORITES_SEARCH_LIMIT ) :
+                results.addTopLevelItem( QtWidgets.QTreeWidgetItem( [ name, nutmonitor.favorites.device_name( self.__favorites[ name ] ) ] ) )
+            if results.topLevelItemCount() > 0 :
+                results.setCurrentItem( results.topLevelItem( 0 ) )
+
+        entry.textChanged.connect( search_changed )
+        entry.returnPressed.connect( dialog.accept )
+        results.itemActivated.connect( lambda item, column : dialog.accept() )
+        buttons.accepted.connect( dialog.accept )
+        buttons.rejected.connect( dialog.reject )
+
+        layout = QtWidgets.QVBoxLayout( dialog )
+        layout.addWidget( entry )
+        layout.addWidget( results )
+        layout.addWidget( buttons )
+        search_changed( "" )
+
+        if dialog.exec_() == QtWidgets.QDialog.Accepted and results.currentItem() != None :
+            self.__load_favorite( results.currentItem().text( 0 ) )
 
-        if ( not os.path.exists( self.__favorites_file ) ) :
-            # There is no favorites files, do nothing
+    #-------------------------------------------------------------------
+    # Import favorites from an inventory, CSV or JSON. Favorites with the
+    # same name are replaced.
+    def __import_favorites( self ) :
+        ( filename, unused ) = QtWidgets.QFileDialog.getOpenFileName( self.__window, _("Import favorites"), "", _("CSV files (*.csv);;JSON files (*.json)") )
+        if not filename :
             return
 
         try :
-            if ( not stat.S_IMODE( os.stat( self.__favorites_path ).st_mode ) == self.DESIRED_FAVORITES_DIRECTORY_MODE ) : # unsafe pre-1.2 directory found
-                os.chmod( self.__favorites_path, self.DESIRED_FAVORITES_DIRECTORY_MODE )
-
-            conf = ConfigParser.ConfigParser()
-            conf.read( self.__favorites_file )
-            for current in conf.sections() :
-                # Check if mandatory fields are present
-                if ( conf.has_option( current, "host" ) and conf.has_option( current, "ups" ) ) :
-                    # Valid entry found, add it to the list
-                    fav_data = {}
-                    fav_data["host"] = conf.get( current, "host" )
-                    fav_data["ups"]  = conf.get( current, "ups" )
-
-                    if ( conf.has_option( current, "port" ) ) :
-                        fav_data["port"] = conf.get( current, "port" )
-                    else :
-                        fav_data["port"] = "3493"
-
-                    # If auth is defined the section must have login and pass defined
-                    if ( conf.has_option( current, "auth" ) ) :
-                        if( conf.has_option( current, "login" ) and conf.has_option( current, "password" ) ) :
-                            # Add the entry
-                            fav_data["auth"]     = conf.getboolean( current, "auth" )
-                            fav_data["login"]    = conf.get( current, "login" )
-
-                            try :
-                                fav_data["password"] = base64.decodestring( conf.get( current, "password" ) )
-
-                            except :
-                                # If the password is not in base64, let the field empty
-                                print( _("Error parsing favorites, password for '%s' is not in base64\nSkipping password for this entry") % current )
-                                fav_data["password"] = ""
-                    else :
-                        fav_data["auth"] = False
-
-                    self.__favorites[current] = fav_data
-            self.__gui_refresh_favorites_menu()
-
-        except :
-            self.gui_status_message( _("Error while parsing favorites file (%s)") % sys.exc_info()[1] )
-
-    #-------------------------------------------------------------------
-    # Save favorites to the defined favorites file using ini format
-    def __save_favorites( self ) :
+            ( added, replaced, skipped ) = self.__favorites.import_file( filename, replace=True )
+        except Exception as e :
+            self.gui_status_message( _("Error while importing favorites (%s)") % e )
+            return
+
+        self.__save_favorites()
+        self.gui_status_message( _("Imported favorites : {0} added, {1} replaced, {2} skipped").format( added, replaced, skipped ) )
+
+    #-------------------------------------------------------------------
+    # Export the favorites, without their passwords
+    def __export_favorites( self ) :
+        ( filename, unused ) = QtWidgets.QFileDialog.getSaveFileName( self.__window, _("Export favorites"), "favorites.csv", _("CSV files (*.csv);;JSON files (*.json)") )
+        if not filename :
+            return
+
+        try :
+            self.__favorites.export_file( filename )
+            self.gui_status_message( _("Exported {0} favorites to '{1}'").format( len( self.__favorites ), filename ) )
+        except Exception as e :
+            self.gui_status_message( _("Error while exporting favorites (%s)") % e )
+
+    #-------------------------------------------------------------------
+    # Fill the connection fields with the ones of a favorite
+    def __load_favorite( self, fav_name ) :
+        fav_data = self.__favorites.get( fav_name )
+        if ( fav_data == None ) :
+            return
 
+        self.__widgets["ups_authentication_check"].setChecked( bool( fav_data.get("auth", False ) ) )
+        if ( fav_data.get("auth", False ) ) :
+            self.__widgets["ups_authentication_login"].setText( fav_data.get("login","") )
+            self.__widgets["ups_authentication_password"].setText( fav_data.get("password","") )
+
+        self.__widgets["ups_host_entry"].setText( fav_data.get("host","") )
+        self.__widgets["ups_port_entry"].setValue( int( fav_data.get("port",3493) ) )
+
+        self.__widgets["ups_list_combo"].clear()
+        self.__widgets["ups_list_combo"].addItem( fav_data.get("ups","") )
+        self.__widgets["ups_connect"].setEnabled( True )
+
+        self.gui_status_message( _("Loaded '%s'") % fav_name )
+
+    def __add_favorite( self ) :
+        ( fav_name, ok ) = QtWidgets.QInputDialog.getText( self.__window, _("Add to favorites"), _("Name of the favorite :") )
+        if not ok or fav_name.strip() == "" :
+            return
+
+        fav_data = {}
+        fav_data["host"] = self.__widgets["ups_host_entry"].text()
+        fav_data["port"] = "%d" % self.__widgets["ups_port_entry"].value()
+        fav_data["ups"]  = self.__widgets["ups_list_combo"].currentText()
+        fav_data["auth"] = self.__widgets["ups_authentication_check"].isChecked()
+        if fav_data["auth"] :
+            # Encoded when saved
+            fav_data["login"]    = self.__widgets["ups_authentication_login"].text()
+            fav_data["password"] = self.__widgets["ups_authentication_password"].text()
+
+        self.__favorites.set( fav_name.strip(), fav_data )
+        self.__save_favorites()
+
+    def __delete_favorite( self ) :
+        names = self.__favorites.names()
+        if len( names ) == 0 :
+            return
+
+        ( fav_name, ok ) = QtWidgets.QInputDialog.getItem( self.__window, _("Delete a favorite"), _("Favorite :"), names, 0, False )
+        if not ok :
+            return
+
+        resp = QtWidgets.QMessageBox.question( self.__window, _("NUT Monitor"), _("Are you sure that you want to remove this favorite ?") )
+        if ( resp == QtWidgets.QMessageBox.Yes ) :
+            self.__favorites.remove( fav_name )
+            self.__save_favorites()
+            self.gui_status_message( _("Removed favorite '%s'") % fav_name )
+
+    def __save_favorites( self ) :
         # If path does not exists, try to create it
-        if ( not os.path.exists( self.__favorites_file ) ) :
+        if ( not os.path.exists( self.__favorites_path ) ) :
             try :
                 os.makedirs( self.__favorites_path, mode=self.DESIRED_FAVORITES_DIRECTORY_MODE )
-            except :
-                self.gui_status_message( _("Error while creating configuration folder (%s)") % sys.exc_info()[1] )
-
-        save_conf = ConfigParser.ConfigParser()
-        for current in self.__favorites.keys() :
-            save_conf.add_section( current )
-            for k, v in self.__favorites[ current ].iteritems() :
-                save_conf.set( current, k, v )
+            except OSError as e :
+                self.gui_status_message( _("Error while creating configuration folder (%s)") % e )
 
         try :
-            fh = open( self.__favorites_file, "w" )
-            save_conf.write( fh )
-            fh.close()
+            self.__favorites.save()
             self.gui_status_message( _("Saved favorites...") )
+        except Exception as e :
+            self.gui_status_message( _("Error while saving favorites (%s)") % e )
 
-        except :
-            self.gui_status_message( _("Error while saving favorites (%s)") % sys.exc_info()[1] )
+    def get_favorites( self ) :
+        return( self.__favorites )
 
     #-------------------------------------------------------------------
-    # Display the about dialog
-    def gui_about_dialog( self, widget=None ) :
-        dialog_interface = gtk.glade.XML( self.__glade_file, "aboutdialog1" )
-        dialog = dialog_interface.get_widget( "aboutdialog1" )
+    # Open the "all favorites" window, or bring it to front
+    def gui_show_fleet_window( self ) :
+        if ( self.__fleet_window == None ) :
+            if ( len( self.__favorites ) == 0 ) :
+                self.gui_status_message( _("No favorites to monitor") )
+                return
+            self.__fleet_window = fleet_window( self, self.__favorites )
+            # Every favorite is counted in the tray tooltip at once
+            self.gui_fleet_changed()
+
+        self.__fleet_window.get_window().show()
+        self.__fleet_window.get_window().raise_()
 
-        self.__widgets["main_window"].set_sensitive( False )
-        dialog.run()
-        dialog.destroy()
-        self.__widgets["main_window"].set_sensitive( True )
+    #-------------------------------------------------------------------
+    # Called by the fleet window once closed
+    def fleet_window_closed( self ) :
+        self.__fleet_window  = None
+        self.__fleet_summary = None
+        self.__update_tray_icon()
+        self.__widgets["status_icon"].setToolTip( self.__device_tooltip )
 
     #-------------------------------------------------------------------
-    # Display a message on the status bar. The message is also set as
-    # tooltip to enable users to see long messages.
-    def gui_status_message( self, msg="" ) :
-        context_id = self.__widgets["status_bar"].get_context_id("Infos")
-        self.__widgets["status_bar"].pop( context_id )
+    # The summary of the fleet window may have changed, redraw the tray
+    # icon if it is a new one
+    def gui_fleet_changed( self ) :
+        if ( self.__fleet_window == None ) :
+            return
 
-        if ( platform.system() == "Windows" ) :
-            text = msg.decode("cp1250").encode("utf8")
-        else :
-            text = msg
+        summary = self.__fleet_window.get_summary()
+        if ( summary is self.__fleet_summary ) :
+            return
 
-        message_id = self.__widgets["status_bar"].push( context_id, text.replace("\n", "") )
-        self.__widgets["status_bar"].set_tooltip_text( text )
+        self.__fleet_summary = summary
+        self.__update_tray_icon()
+        self.__widgets["status_icon"].setToolTip( self.__fleet_tooltip( summary ) )
 
-    #-------------------------------------------------------------------
-    # Display a notification using PyNotify with an optional icon
-    def gui_status_notification( self, message="", icon_file="" ) :
-        # Try to init pynotify
-        try :
-            import pynotify
-            pynotify.init( "NUT Monitor" )
+    def __fleet_tooltip( self, summary ) :
+        text = _("%d favorites") % summary.total
 
-            if ( icon_file != "" ) :
-                icon = "file://%s" % os.path.abspath( os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", icon_file ) )
-            else :
-                icon = None
+        if ( summary.state == nutmonitor.fleet.ONLINE ) and ( summary.waiting == 0 ) :
+            text += "\n%s" % _("All online")
+
+        for ( state, label ) in ( ( nutmonitor.fleet.LOW_BATTERY, _("Low batteries :") ),
+                                  ( nutmonitor.fleet.ON_BATTERY, _("On batteries :") ),
+                                  ( nutmonitor.fleet.UNREACHABLE, _("Unreachable :") ),
+                                  ( nutmonitor.fleet.REPLACE_BATTERY, _("Replace batteries :") ) ) :
+            if ( summary.counts[ state ] > 0 ) :
+                text += "\n%s %d" % ( label, summary.counts[ state ] )
+
+        if ( summary.waiting > 0 ) :
+            text += "\n%s %d" % ( _("Connecting :"), summary.waiting )
 
-            notif = pynotify.Notification( "NUT Monitor", message, icon )
-            notif.show()
+        if ( summary.lowest_runtime != None ) :
+            text += "\n%s %s (%s)" % ( _("Lowest runtime :"), time.strftime( "%H:%M:%S", time.gmtime( summary.lowest_runtime ) ), summary.lowest_runtime_device )
 
-        except :
-            pass
+        if ( summary.device != None ) :
+            text += "\n%s" % ( _("Click to open '%s'") % summary.device )
+
+        return( text )
 
     #-------------------------------------------------------------------
-    # Let GTK refresh GUI :)
-    def refresh_gui( self ) :
-        while gtk.events_pending() :
-            gtk.main_iteration( False )
-        return( True )
+    # Change the tray icon of the connected device
+    def change_status_icon( self, icon="on_line" ) :
+        self.__status_icon = icon
+        self.__update_tray_icon()
+        self.__widgets["ups_status_image"].setPixmap( self.__icons.get( icon ) )
 
     #-------------------------------------------------------------------
-    # Connect to the selected UPS using parameters (host,port,login,pass)
-    def connect_to_ups( self, widget=None ) :
+    # Set the tray icon : the summary of the favorites while the fleet
+    # window is open, the status of the connected device otherwise. The
+    # overlays are composited once for each state and count.
+    def __update_tray_icon( self ) :
+        summary = self.__fleet_summary
+        if ( summary == None ) :
+            pixmap = self.__icons.get( self.__status_icon )
+        else :
+            ( name, emblem ) = self.FLEET_TRAY_ICONS[ summary.state ]
 
-        host     = self.__widgets["ups_host_entry"].get_text()
-        port     = int( self.__widgets["ups_port_entry"].get_value() )
-        login    = None
-        password = None
+            count = None
+            if ( summary.on_battery > 9 ) :
+                count = "9+"
+            elif ( summary.on_battery > 0 ) :
+                count = str( summary.on_battery )
+
+            if ( emblem == None and count == None ) :
+                pixmap = self.__icons.get( name )
+            else :
+                pixmap = self.__icons.get_variant( name, None, ( emblem, count ),
+                                                   lambda icon : composite_tray_overlay( icon, emblem and self.__icons.get( emblem ), count ) )
 
-        if self.__widgets["ups_authentication_check"].get_active() :
-            login    = self.__widgets["ups_authentication_login"].get_text()
-            password = self.__widgets["ups_authentication_password"].get_text()
+        self.__widgets["status_icon"].setIcon( QtGui.QIcon( pixmap ) )
 
-        try :
-            self.__ups_handler = PyNUT.PyNUTClient( host=host, port=port, login=login, password=password )
+    #-------------------------------------------------------------------
+    # Tooltip of the tray icon for the connected device, shown while the
+    # fleet window is closed
+    def gui_device_tooltip( self, text ) :
+        self.__device_tooltip = text
+        if ( self.__fleet_summary == None ) :
+            self.__widgets["status_icon"].setToolTip( text )
+
+    #-------------------------------------------------------------------
+    # Click on the tray icon : open the favorite in the worst state while
+    # all the favorites are monitored, show / hide the window otherwise
+    def __tray_activated( self, reason ) :
+        if reason not in ( QtWidgets.QSystemTrayIcon.Trigger, QtWidgets.QSystemTrayIcon.DoubleClick ) :
+            return
 
-        except :
-            self.gui_status_message( _("Error connecting to '{0}' ({1})").format( host, sys.exc_info()[1] ) )
-            self.gui_status_notification( _("Error connecting to '{0}'\n{1}").format( host, sys.exc_info()[1] ), "warning.png" )
+        summary = self.__fleet_summary
+        if summary != None and summary.device != None and not ( self.__is_window_visible() and self.__is_favorite_connected( summary.device ) ) :
+            self.gui_open_favorite( summary.device )
             return
 
-        # Check if selected UPS exists on server...
-        srv_upses          = self.__ups_handler.GetUPSList()
-        self.__current_ups = self.__widgets["ups_list_combo"].get_active_text()
+        self.__set_window_visible( not self.__window.isVisible() )
 
-        if not srv_upses.has_key( self.__current_ups ) :
-            self.gui_status_message( _("Device '%s' not found on server") % self.__current_ups )
-            self.gui_status_notification( _("Device '%s' not found on server") % self.__current_ups, "warning.png" )
+    def __is_favorite_connected( self, fav_name ) :
+        if self.__state == None or fav_name not in self.__favorites :
+            return( False )
+        return( nutmonitor.favorites.device_name( self.__favorites[ fav_name ] ) == self.__state.device )
+
+    #-------------------------------------------------------------------
+    # Show a favorite in the main window, connecting to it unless it is
+    # already the device displayed
+    def gui_open_favorite( self, fav_name ) :
+        if ( fav_name not in self.__favorites ) :
             return
 
-        self.__connected = True
-        self.__widgets["ups_connect"].hide()
-        self.__widgets["ups_disconnect"].show()
-        self.__widgets["ups_infos"].show()
-        self.__widgets["ups_params_box"].set_sensitive( False )
-        self.__widgets["menu_favorites_root"].set_sensitive( False )
-        self.__widgets["ups_params_box"].hide()
+        self.__set_window_visible( True )
+        if self.__is_favorite_connected( fav_name ) :
+            return
+
+        if self.__state != None :
+            self.disconnect_from_ups()
 
-        commands = self.__ups_handler.GetUPSCommands( self.__current_ups )
-        self.__ups_commands = commands.keys()
-        self.__ups_commands.sort()
+        self.__load_favorite( fav_name )
+        self.connect_to_ups()
 
-        # Refresh UPS commands combo box
-        self.__widgets["ups_commands_combo_store"].clear()
-        for desc in self.__ups_commands :
-            self.__widgets["ups_commands_combo_store"].append( [ "%s\n<span color=\"#707070\">%s</span>" % ( desc, commands[desc] ) ] )
+    def __set_window_visible( self, visible ) :
+        if visible :
+            self.__window.showNormal()
+            self.__window.raise_()
+            self.__window.activateWindow()
+        else :
+            self.__window.hide()
+        self.__window_state_changed()
 
-        self.__widgets["ups_commands_combo"].set_active( 0 )
+    def __is_window_visible( self ) :
+        return( self.__window.isVisible() and not self.__window.isMinimized() )
 
-        # Update UPS vars manually before the thread
-        self.__ups_vars    = self.__ups_handler.GetUPSVars( self.__current_ups )
-        self.__ups_rw_vars = self.__ups_handler.GetRWVars( self.__current_ups )
-        self.__gui_update_ups_vars_view()
+    #-------------------------------------------------------------------
+    # Return True if the UPS vars page is displayed
+    def __is_vars_page_visible( self ) :
+        return( self.__is_window_visible() and self.__state != None and self.__widgets["ups_infos"].currentIndex() == 1 )
 
-        # Try to resize the main window...
-        self.__widgets["main_window"].resize( 1, 1 )
+    #-------------------------------------------------------------------
+    # Poll less often while the window sits in the tray
+    def __window_state_changed( self ) :
+        if self.__engine != None :
+            self.__engine.set_hidden( not self.__is_window_visible() )
+        self.__vars_page_changed()
 
-        # Start the GUI updater thread
-        self.__gui_thread = gui_updater( self )
-        self.__gui_thread.start()
+    #-------------------------------------------------------------------
+    # The vars page was shown or hidden : only poll the whole LIST VAR
+    # while it is displayed. The device is added again with its new watch
+    # list, its first poll reports all the polled vars.
+    def __vars_page_changed( self ) :
+        visible = self.__is_vars_page_visible()
 
-        self.gui_status_message( _("Connected to '{0}' on {1}").format( self.__current_ups, host ) )
+        if self.__engine != None and visible != self.__all_vars :
+            self.__all_vars = visible
+            self.__engine.remove_device( self.__state.device )
+            self.__add_engine_device()
 
+        # Draw what changed while the window or the page was hidden
+        self.__renderer.redraw()
 
     #-------------------------------------------------------------------
-    # Refresh UPS vars in the treeview
-    def __gui_update_ups_vars_view( self, widget=None ) :
-        if self.__ups_handler :
-            vars   = self.__ups_vars
-            rwvars = self.__ups_rw_vars
+    # Closing the main window sends it to the tray, when there is one
+    def __window_closing( self ) :
+        if self.__quitting or not QtWidgets.QSystemTrayIcon.isSystemTrayAvailable() :
+            self.quit()
+            return( True )
 
-            self.__widgets["ups_vars_tree_store"].clear()
+        self.__set_window_visible( False )
+        return( False )
 
-            for k,v in vars.iteritems() :
-                if ( rwvars.has_key( k ) ) :
-                    icon_file = os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", "var-rw.png" )
-                else :
-                    icon_file = os.path.join( os.path.dirname( sys.argv[0] ), "pixmaps", "var-ro.png" )
+    #-------------------------------------------------------------------
+    # Display a message on the status bar
+    def gui_status_message( self, msg="" ) :
+        self.__window.statusBar().showMessage( msg.replace( "\n", " " ) )
+        self.__window.statusBar().setToolTip( msg )
 
-                icon = gtk.gdk.pixbuf_new_from_file( icon_file )
-                self.__widgets["ups_vars_tree_store"].append( [ icon, k, v ] )
+    #-------------------------------------------------------------------
+    # Display a notification from the tray icon. Notifications are
+    # coalesced per 'source' (device, server) and 'event', see
+    # nutmonitor.notify
+    def gui_status_notification( self, message="", icon_file="", source=None, event=None ) :
+        if self.__notifications == None :
+            try :
+                backend = tray_notification_backend( self.__widgets["status_icon"], self.__icons )
+            except RuntimeError :
+                self.__notifications = False
+                return
 
+            import nutmonitor.notify
+            self.__notifications = nutmonitor.notify.notification_center( backend, timeout_dispatch )
+
+        if self.__notifications :
+            self.__notifications.notify( source, event, message, icon_file or None )
 
     #-------------------------------------------------------------------
-    # Disconnect from the UPS
-    def disconnect_from_ups( self, widget=None ) :
+    # Write the recorded metrics (see --metrics) to a file
+    def __export_metrics( self ) :
+        if not nutmonitor.metrics.is_enabled() :
+            nutmonitor.metrics.enable()
+            self.gui_status_message( _("Recording metrics from now on") )
+            return
 
-        self.__connected = False
-        self.__widgets["ups_connect"].show()
-        self.__widgets["ups_disconnect"].hide()
-        self.__widgets["ups_infos"].hide()
-        self.__widgets["ups_params_box"].set_sensitive( True )
-        self.__widgets["menu_favorites_root"].set_sensitive( True )
-        self.__widgets["status_icon"].set_tooltip_markup( _("<i>Not connected</i>") )
-        self.__widgets["ups_params_box"].show()
+        ( filename, unused ) = QtWidgets.QFileDialog.getSaveFileName( self.__window, _("Export metrics"), "nut-monitor.prom", _("Metrics (*.prom *.jsonl)") )
+        if filename :
+            try :
+                nutmonitor.metrics.export( filename )
+                self.gui_status_message( _("Metrics exported to '%s'") % filename )
+            except IOError as e :
+                self.gui_status_message( _("Error while exporting metrics (%s)") % e )
+
+    def __about_dialog( self ) :
+        QtWidgets.QMessageBox.about( self.__window, _("About NUT Monitor"),
+                                     _("<b>NUT Monitor</b> 2.0<br><br>Monitor the UPSes managed by a NUT server.<br><br>"
+                                       "Copyright (C) 2010 David Goncalves<br>Released under the GNU GPL v3") )
+
+    def quit( self ) :
+        self.__quitting = True
 
-        # Try to resize the main window...
-        self.__widgets["main_window"].resize( 1, 1 )
+        if self.__state != None :
+            self.disconnect_from_ups()
+
+        if self.__fleet_window != None :
+            self.__fleet_window.close()
 
-        # Stop the GUI updater thread
-        self.__gui_thread.stop_thread()
+        if self.__event_listener != None :
+            self.__event_listener.stop_thread()
 
-        del self.__ups_handler
-        self.gui_status_message( _("Disconnected from '%s'") % self.__current_ups )
-        self.change_status_icon( "on_line", blink=False )
-        self.__current_ups = None
+        self.__workers.stop()
+        self.__widgets["status_icon"].hide()
+        QtWidgets.QApplication.quit()
 
 #-----------------------------------------------------------------------
-# GUI Updater class
-# This class updates the main gui with data from connected UPS
-class gui_updater( threading.Thread ) :
+# "All favorites" window : one engine polls the favorites, their changes
+# reach the model through a queued signal, and each one only updates the
+# cells of its row which changed
+class fleet_window :
+
+    # Vars displayed
+    WATCHED_VARS   = ( "ups.status", "battery.charge", "ups.load", "battery.runtime" )
+
+    __engine       = None
 
-    __parent_class = None
-    __stop_thread  = False
+    def __init__( self, parent_class, favorites ) :
+        import nutmonitor.daemon
+        import nutmonitor.engine
 
-    def __init__( self, parent_class ) :
-        threading.Thread.__init__( self )
         self.__parent_class = parent_class
+        self.__devices      = {}
+        self.__flags        = {}
+        self.__pending      = {}
+
+        # Aggregated state, shown by the tray icon while the window is open
+        self.__status       = nutmonitor.fleet.fleet_status()
+        self.__bridge       = device_bridge( self.__device_changed )
+        self.__model        = fleet_model()
+
+        # Rows are drawn by the frame renderer of the interface, all the
+        # changes of a device in a frame at once
+        self.__renderer = parent_class._interface__renderer
+        self.__renderer.add_view( "fleet", self.__is_visible )
+
+        self.__window = notifying_window( self.__window_closing, self.__window_state_changed )
+        self.__window.setWindowTitle( _("NUT Monitor - All favorites") )
+        self.__window.resize( 640, 320 )
+
+        view = QtWidgets.QTableView()
+        view.setModel( self.__model )
+        view.setEditTriggers( QtWidgets.QAbstractItemView.NoEditTriggers )
+        view.setSelectionBehavior( QtWidgets.QAbstractItemView.SelectRows )
+        view.verticalHeader().hide()
+        view.horizontalHeader().setStretchLastSection( True )
+        view.doubleClicked.connect( lambda index : parent_class.gui_open_favorite( self.__model.index( index.row(), fleet_model.COLUMN_NAME ).data() ) )
+
+        self.__delegate = progress_delegate( view )
+        for column in ( fleet_model.COLUMN_CHARGE, fleet_model.COLUMN_LOAD ) :
+            view.setItemDelegateForColumn( column, self.__delegate )
+
+        self.__window.setCentralWidget( view )
+        self.__view = view
+
+        # When a daemon runs, it does the polling and this window only
+        # displays the changes it reports
+        daemon = parent_class.get_daemon()
+        if daemon != None :
+            self.__engine = nutmonitor.daemon.daemon_poller( daemon, self.__bridge.engine_callback )
+        else :
+            self.__engine = nutmonitor.engine.polling_engine( self.__bridge.engine_callback )
 
-    def run( self ) :
+        rows = []
+        for name in favorites.names() :
+            fav    = favorites[ name ]
+            device = nutmonitor.favorites.device_name( fav )
+            rows.append( ( name, device ) )
+            self.__devices[ name ] = device
 
-        ups    = self.__parent_class._interface__current_ups
-        was_online = True
+            ( login, password ) = nutmonitor.favorites.credentials( fav )
+            self.__engine.add_device( name, fav.get("host",""), fav.get("port","3493"), fav.get("ups",""), login, password, self.WATCHED_VARS )
+            self.__status.add_device( name )
 
-        # Define a dict containing different UPS status
-        status_mapper = { "LB"     : "<span color=\"#BB0000\"><b>%s</b></span>" % _("Low batteries"),
-                          "RB"     : "<span color=\"#FF0000\"><b>%s</b></span>" % _("Replace batteries !"),
-                          "BYPASS" : "<span color=\"#BB0000\">Bypass</span> <i>%s</i>" % _("(no battery protection)"),
-                          "CAL"    : _("Performing runtime calibration"),
-                          "OFF"    : "<span color=\"#000090\">%s</span> <i>(%s)</i>" % ( _("Offline"), _("not providing power to the load") ),
-                          "OVER"   : "<span color=\"#BB0000\">%s</span> <i>(%s)</i>" % ( _("Overloaded !"), _("there is too much load for device") ),
-                          "TRIM"   : _("Triming <i>(UPS is triming incoming voltage)</i>"),
-                          "BOOST"  : _("Boost <i>(UPS is boosting incoming voltage)</i>")
-                        }
+        self.__model.set_favorites( rows )
+        self.__window.show()
+        self.__engine.start()
 
-        while not self.__stop_thread :
-            try :
-                vars = self.__parent_class._interface__ups_handler.GetUPSVars( ups )
-                self.__parent_class._interface__ups_vars = vars
-
-                # Text displayed on the status frame
-                text_left   = ""
-                text_right  = ""
-                status_text = ""
-
-                text_left  += "<b>%s</b>\n" % _("Device status :")
-
-                if ( vars.get("ups.status").find("OL") != -1 ) :
-                    text_right += "<span color=\"#009000\"><b>%s</b></span>" % _("Online")
-                    if not was_online :
-                        self.__parent_class.change_status_icon( "on_line", blink=False )
-                        was_online = True
-
-                if ( vars.get("ups.status").find("OB") != -1 ) :
-                    text_right += "<span color=\"#900000\"><b>%s</b></span>" % _("On batteries")
-                    if was_online :
-                        self.__parent_class.change_status_icon( "on_battery", blink=True )
-                        self.__parent_class.gui_status_notification( _("Device is running on batteries"), "on_battery.png" )
-                        was_online = False
-
-                # Check for additionnal information
-                for k,v in status_mapper.iteritems() :
-                    if vars.get("ups.status").find(k) != -1 :
-                        if ( text_right != "" ) :
-                            text_right += " - %s" % v
-                        else :
-                            text_right += "%s" % v
-
-                # CHRG and DISCHRG cannot be trated with the previous loop ;)
-                if ( vars.get("ups.status").find("DISCHRG") != -1 ) :
-                    text_right += " - <i>%s</i>" % _("discharging")
-                elif ( vars.get("ups.status").find("CHRG") != -1 ) :
-                    text_right += " - <i>%s</i>" % _("charging")
-
-                status_text += text_right
-                text_right += "\n"
-
-                if ( vars.has_key( "ups.mfr" ) ) :
-                    text_left  += "<b>%s</b>\n\n" % _("Model :")
-                    text_right += "%s\n%s\n" % ( vars.get("ups.mfr",""), vars.get("ups.model","") )
-
-                if ( vars.has_key( "ups.temperature" ) ) :
-                    text_left  += "<b>%s</b>\n" % _("Temperature :")
-                    text_right += "%s\n" % int( float( vars.get( "ups.temperature", 0 ) ) )
-
-                if ( vars.has_key( "battery.voltage" ) ) :
-                    text_left  += "<b>%s</b>\n" % _("Battery voltage :")
-                    text_right += "%sv\n" % vars.get( "battery.voltage", 0 )
-
-                self.__parent_class._interface__widgets["ups_status_left"].set_markup( text_left[:-1] )
-                self.__parent_class._interface__widgets["ups_status_right"].set_markup( text_right[:-1] )
-
-                # UPS load and battery charge progress bars
-                if ( vars.has_key( "battery.charge" ) ) :
-                    charge = vars.get( "battery.charge", "0" )
-                    self.__parent_class._interface__widgets["progress_battery_charge"].set_fraction( float( charge ) / 100.0 )
-                    self.__parent_class._interface__widgets["progress_battery_charge"].set_text( "%s %%" % int( float( charge ) ) )
-                    status_text += "\n%s %s%%" % ( _("Battery charge :"), int( float( charge ) ) )
-                else :
-                    self.__parent_class._interface__widgets["progress_battery_charge"].set_fraction( 0.0 )
-                    self.__parent_class._interface__widgets["progress_battery_charge"].set_text( _("Not available") )
-
-                if ( vars.has_key( "ups.load" ) ) :
-                    load = vars.get( "ups.load", "0" )
-                    self.__parent_class._interface__widgets["progress_battery_load"].set_fraction( float( load ) / 100.0 )
-                    self.__parent_class._interface__widgets["progress_battery_load"].set_text( "%s %%" % int( float( load ) ) )
-                    status_text += "\n%s %s%%" % ( _("UPS load :"), int( float( load ) ) )
-                else :
-                    self.__parent_class._interface__widgets["progress_battery_load"].set_fraction( 0.0 )
-                    self.__parent_class._interface__widgets["progress_battery_load"].set_text( _("Not available") )
-
-                if ( vars.has_key( "battery.runtime" ) ) :
-                    autonomy = int( float( vars.get( "battery.runtime", 0 ) ) )
-
-                    if ( autonomy >= 3600 ) :
-                        info = time.strftime( _("<b>%H hours %M minutes %S seconds</b>"), time.gmtime( autonomy ) )
-                    elif ( autonomy > 300 ) :
-                        info = time.strftime( _("<b>%M minutes %S seconds</b>"), time.gmtime( autonomy ) )
-                    else :
-                        info = time.strftime( _("<b><span color=\"#DD0000\">%M minutes %S seconds</span></b>"), time.gmtime( autonomy ) )
-                else :
-                    info = _("Not available")
+    def get_window( self ) :
+        return( self.__window )
+
+    #-------------------------------------------------------------------
+    # Summary of the favorites (see nutmonitor.fleet)
+    def get_summary( self ) :
+        return( self.__status.summary() )
+
+    def close( self ) :
+        if self.__engine != None :
+            self.__engine.stop_thread()
+            self.__engine = None
+        self.__renderer.discard( "fleet" )
+        self.__window.close()
+
+    def __window_closing( self ) :
+        if self.__engine != None :
+            self.__engine.stop_thread()
+            self.__engine = None
+        self.__renderer.discard( "fleet" )
+        self.__parent_class.fleet_window_closed()
+        return( True )
+
+    def __is_visible( self ) :
+        return( self.__window.isVisible() and not self.__window.isMinimized() )
+
+    #-------------------------------------------------------------------
+    # Draw the rows changed while the window was iconified
+    def __window_state_changed( self ) :
+        self.__renderer.redraw()
+
+    #-------------------------------------------------------------------
+    # upsmon reported an event : poll the devices of the UPS at once. Can
+    # be called from any thread.
+    def poll_now( self, ups_name ) :
+        import nutmonitor.events
+
+        engine = self.__engine
+        if engine == None :
+            return
+
+        matched = nutmonitor.events.match_devices( ups_name, self.__devices.values() )
+        for ( name, device ) in list( self.__devices.items() ) :
+            if device in matched :
+                engine.poll_now( name )
+
+    #-------------------------------------------------------------------
+    # Slot of the bridge, runs in the event loop. Notifications and the
+    # aggregated state follow the changes at once, the row is drawn by the
+    # frame renderer.
+    def __device_changed( self, device_id, changes, error ) :
+        if self.__engine == None or device_id not in self.__devices :
+            return
+
+        if "ups.status" in changes :
+            self.__notify_transitions( device_id, nutmonitor.status.parse( changes["ups.status"] ) )
 
-                self.__parent_class._interface__widgets["ups_status_time"].set_markup( info )
+        if self.__status.update( device_id, changes, error ) :
+            self.__parent_class.gui_fleet_changed()
 
-                # Display UPS status as tooltip for tray icon
-                self.__parent_class._interface__widgets["status_icon"].set_tooltip_markup( status_text )
+        self.__pending.setdefault( device_id, {} ).update( changes )
+        self.__renderer.update( "fleet", device_id, self.__draw_row, device_id, error )
 
-            except :
-                self.__parent_class.gui_status_message( _("Error from '{0}' ({1})").format( ups, sys.exc_info()[1] ) )
-                self.__parent_class.gui_status_notification( _("Error from '{0}'\n{1}").format( ups, sys.exc_info()[1] ), "warning.png" )
+    def __draw_row( self, device_id, error ) :
+        start = nutmonitor.metrics.clock()
 
-            time.sleep( 1 )
+        self.__model.apply_changes( device_id, self.__pending.pop( device_id, {} ), error )
 
-    def stop_thread( self ) :
-        self.__stop_thread = True
+        if ( start != None ) :
+            nutmonitor.metrics.observe_since( "gui_update_seconds", start, { "part" : "fleet_window" } )
+
+    #-------------------------------------------------------------------
+    # Notify power events. When many devices change at once, the
+    # notification center merges them into a single summary.
+    def __notify_transitions( self, device_id, flags ) :
+        ( raised, cleared ) = nutmonitor.status.transitions( self.__flags.get( device_id, nutmonitor.status.OL ), flags )
+        self.__flags[ device_id ] = flags
+
+        device = self.__devices[ device_id ]
+        if ( raised & nutmonitor.status.OB ) :
+            self.__parent_class.gui_status_notification( _("'%s' is running on batteries") % device_id, "on_battery.png", device, "on_battery" )
+        if ( raised & nutmonitor.status.LB ) :
+            self.__parent_class.gui_status_notification( _("'%s' batteries are low") % device_id, "warning.png", device, "low_battery" )
+        if ( raised & nutmonitor.status.RB ) :
+            self.__parent_class.gui_status_notification( _("'%s' batteries need to be replaced") % device_id, "warning.png", device, "replace_battery" )
+
+
+#-----------------------------------------------------------------------
+# Qt benchmarks, added to the nutmonitor.bench suite by --benchmark : the
+# same changes as the view_update benchmark of the GTK front end (see
+# nutmonitor.bench.view_update_data), drawn by the models and their views,
+# and the startup milestones (see gui_startup_milestone)
+def flush_qt_events() :
+    QtWidgets.QApplication.processEvents()
+
+def benchmark_view_update( gui, options ) :
+    import nutmonitor.bench
+    import nutmonitor.fakeupsd
+
+    ( vars, vars_rounds, devices, fleet_rounds ) = nutmonitor.bench.view_update_data( options )
+    results = {}
+
+    gui._interface__window.show()
+    gui._interface__widgets["ups_infos"].show()
+    gui._interface__widgets["ups_infos"].setCurrentIndex( 1 )
+    flush_qt_events()
+
+    model = gui._interface__widgets["ups_vars_model"]
+    start = time.time()
+    model.reset( vars, {} )
+    flush_qt_events()
+    results["vars_fill_ms"] = 1000.0 * ( time.time() - start )
+
+    start = time.time()
+    for changes in vars_rounds :
+        model.apply_changes( changes )
+        flush_qt_events()
+    results["vars_update_ms"] = 1000.0 * ( time.time() - start ) / len( vars_rounds )
+    model.reset( {}, {} )
+
+    # The rows of the fleet window are filled by a first poll of the fake
+    # upsd, then changed directly
+    server = nutmonitor.fakeupsd.fake_upsd( [ nutmonitor.fakeupsd.fake_ups( device_id ) for device_id in devices ] )
+    server.start()
+
+    favorites = nutmonitor.favorites.favorites_store( os.devnull )
+    for device_id in devices :
+        favorites.set( device_id, { "host" : "127.0.0.1", "port" : str( server.get_port() ), "ups" : device_id } )
+
+    win = fleet_window( gui, favorites )
+    try :
+        deadline = time.time() + 30
+        while win.get_summary().waiting > 0 and time.time() < deadline :
+            flush_qt_events()
+            time.sleep( 0.01 )
+        flush_qt_events()
+
+        fleet = win._fleet_window__model
+        start = time.time()
+        for changes in fleet_rounds :
+            for ( device_id, values ) in changes.items() :
+                fleet.apply_changes( device_id, values )
+            flush_qt_events()
+        results["fleet_update_ms"] = 1000.0 * ( time.time() - start ) / len( fleet_rounds )
+    finally :
+        win.close()
+        server.stop()
+
+    return( results )
+
+def register_gui_benchmarks( gui ) :
+    import nutmonitor.bench
+
+    nutmonitor.bench.register( "view_update", lambda options : benchmark_view_update( gui, options ),
+                               nutmonitor.bench.VIEW_UPDATE_RESULTS )
+    nutmonitor.bench.register( "startup", lambda options : nutmonitor.bench.startup_time( [ sys.executable, os.path.abspath( sys.argv[0] ) ], options ),
+                               nutmonitor.bench.STARTUP_RESULTS )
 
 
 #-----------------------------------------------------------------------
@@ -901,12 +1909,21 @@ if __name__ == "__main__" :
 
     gettext.bindtextdomain( APP, DIR )
     gettext.textdomain( APP )
-    _ = gettext.gettext
 
-    for module in ( gettext, gtk.glade ) :
-         module.bindtextdomain( APP, DIR )
-         module.textdomain( APP )
+    ( cmd_opts, args ) = parse_command_line()
+
+    if ( cmd_opts.metrics ) :
+        nutmonitor.metrics.enable()
+
+    app = QtWidgets.QApplication( sys.argv[:1] )
+    app.setQuitOnLastWindowClosed( False )
+    dispatcher = qt_dispatcher()
 
-    gui = interface()
-    gtk.main()
+    if ( cmd_opts.benchmark ) :
+        import nutmonitor.bench
+        cmd_opts.hidden = True
+        register_gui_benchmarks( interface( cmd_opts ) )
+        sys.exit( nutmonitor.bench.main( args ) )
 
+    gui = interface( cmd_opts )
+    sys.exit( app.exec_() )
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+# Support modules shared by the NUT-Monitor front ends.
+#
+# Everything in this package is toolkit agnostic : the GUI passes its own
+# main-loop dispatch function (gobject.idle_add, Qt queued signals...) to
+# the objects that need to report back to it.
+#
+# Modules must stay compatible with both Python 2 and Python 3.
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Batch operations
+#
+# Runs an instant command, or sets a RW variable, on many UPSes at once.
+# Requests go through the connection pool (see pool.py) from up to
+# 'concurrency' threads : devices of different servers are handled in
+# parallel, the ones sharing a session one after the other, since pooled
+# sessions serialise their calls.
+#
+# In dry run mode nothing is changed on the devices : each one is only
+# checked to support the command (GetUPSCommands) or to have the variable
+# writable (GetRWVars).
+
+import sys
+import threading
+
+try :
+    import queue
+except ImportError :
+    import Queue as queue
+
+from gettext import gettext as _
+
+
+# Operations
+RUN_COMMAND = "command"
+SET_VAR     = "set_var"
+
+
+#-----------------------------------------------------------------------
+# A device does not support the operation (dry run)
+class unsupported_error( Exception ) :
+    pass
+
+#-----------------------------------------------------------------------
+# callback( done, total, device_id, result, error ) is called from the
+# batch threads after each device : 'result' describes what was done
+# (None on failure), 'error' is the exception that made it fail (None on
+# success). GUI front ends must forward it to their main loop themselves.
+class batch_operation :
+
+    def __init__( self, pool, operation, name, value=None, dry_run=False, callback=None, concurrency=16 ) :
+        self.__pool        = pool
+        self.__operation   = operation
+        self.__name        = name
+        self.__value       = value
+        self.__dry_run     = dry_run
+        self.__callback    = callback
+        self.__concurrency = max( 1, concurrency )
+        self.__devices     = []
+        self.__jobs        = queue.Queue()
+        self.__lock        = threading.Lock()
+        self.__done        = 0
+        self.__cancelled   = False
+
+    def add_device( self, device_id, host, port, ups, login=None, password=None ) :
+        self.__devices.append( ( device_id, host, int( port ), ups, login, password ) )
+
+    def get_total( self ) :
+        return( len( self.__devices ) )
+
+    #-------------------------------------------------------------------
+    # Start the threads, the call returns at once
+    def start( self ) :
+        for device in self.__devices :
+            self.__jobs.put( device )
+
+        for i in range( min( self.__concurrency, len( self.__devices ) ) ) :
+            self.__jobs.put( None )
+            thread = threading.Thread( target=self.__run )
+            thread.daemon = True
+            thread.start()
+
+    #-------------------------------------------------------------------
+    # Skip the devices not handled yet. Requests already sent are not
+    # cancelled, their results are still reported.
+    def cancel( self ) :
+        self.__cancelled = True
+
+    def __run( self ) :
+        while True :
+            device = self.__jobs.get()
+            if device == None or self.__cancelled :
+                return
+
+            ( result, error ) = ( None, None )
+            try :
+                result = self.__execute( *device )
+            except Exception :
+                error = sys.exc_info()[1]
+
+            with self.__lock :
+                self.__done += 1
+                done         = self.__done
+
+            if self.__callback != None :
+                self.__callback( done, len( self.__devices ), device[0], result, error )
+
+    def __execute( self, device_id, host, port, ups, login, password ) :
+        client = self.__pool.get( host, port, login, password )
+
+        if self.__operation == RUN_COMMAND :
+            if self.__dry_run :
+                if self.__name not in client.GetUPSCommands( ups ) :
+                    raise unsupported_error( _("Command '%s' not supported") % self.__name )
+                return( _("Command supported") )
+
+            client.RunUPSCommand( ups, self.__name )
+            return( _("Command sent") )
+
+        if self.__dry_run :
+            rw_vars = client.GetRWVars( ups )
+            if self.__name not in rw_vars :
+                raise unsupported_error( _("Variable '%s' not writable") % self.__name )
+            return( _("Variable writable, current value '%s'") % rw_vars[ self.__name ] )
+
+        client.SetRWVar( ups=ups, var=self.__name, value=self.__value )
+        return( _("Variable set to '%s'") % self.__value )
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark suite
+#
+# Runs the polling code against the fake upsd (see fakeupsd.py) and
+# measures :
+#
+#   poll_throughput     device polls per second, bytes and CPU time per
+#                       poll (full LIST VAR and watch set)
+#   memory_per_ups      memory used per monitored UPS
+#   event_latency       time from a power event on upsd to the desktop
+#                       notification
+#
+# Results can be saved as JSON and compared with a previous run, the
+# program then exits with an error when a result got worse than the
+# tolerance :
+#
+#   python -m nutmonitor.bench --save baseline.json
+#   python -m nutmonitor.bench --compare baseline.json
+#
+# Front ends add their own benchmarks (GUI update cost...) with
+# register(). The view_update benchmark of the GTK and Qt front ends
+# applies the same changes (see view_update_data()) : save the results of
+# one front end and --compare the other one with them. Their startup
+# benchmark runs the front end with --startup-time (see startup_time()).
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+import json
+import gc
+import threading
+import optparse
+import heapq
+
+from nutmonitor import engine
+from nutmonitor import fakeupsd
+from nutmonitor import favorites
+from nutmonitor import notify
+from nutmonitor import scheduler
+
+try :
+    import tracemalloc
+except ImportError :
+    tracemalloc = None
+
+try :
+    import resource
+except ImportError :
+    resource = None
+
+
+# Watch set used by the fleet window
+WATCHED_VARS = ( "ups.status", "battery.charge", "ups.load", "battery.runtime", "battery.voltage", "ups.temperature", "input.voltage", "output.voltage" )
+
+# ( name, function( options ), { result : "higher" or "lower" is better } )
+_benchmarks = []
+
+# Results of the view_update benchmark of the front ends
+VIEW_UPDATE_RESULTS = { "vars_fill_ms" : "lower", "vars_update_ms" : "lower", "fleet_update_ms" : "lower" }
+
+# Results of the startup benchmark of the front ends : the startup
+# milestones they print with --startup-time
+STARTUP_RESULTS     = { "tray_icon_shown_ms" : "lower", "main_window_built_ms" : "lower", "main_loop_running_ms" : "lower",
+                        "first_ups_status_ms" : "lower", "startup_failures" : "lower" }
+
+
+#-----------------------------------------------------------------------
+# Register a benchmark. 'function' gets the options and returns a dict
+# of results, 'better' tells for each result if higher or lower values
+# are better, for --compare.
+def register( name, function, better ) :
+    _benchmarks.append( ( name, function, better ) )
+
+def _cpu_time() :
+    if hasattr( time, "process_time" ) :
+        return( time.process_time() )
+    return( time.clock() )
+
+#-----------------------------------------------------------------------
+# Poll all the devices as fast as possible
+def _fast_policy() :
+    return( scheduler.polling_policy( fast=0.0, normal=0.0, slow=0.0, jitter=0.0 ) )
+
+def _start_server( options, scenario="steady" ) :
+    devices = fakeupsd.make_devices( options.devices, scenario, extra_vars=options.extra_vars, spread=options.spread )
+    server  = fakeupsd.fake_upsd( devices, latency=options.latency, loss=options.loss )
+    server.start()
+    return( server )
+
+def _start_engine( server, callback, policy=None, watch=None ) :
+    polling = engine.polling_engine( callback, policy )
+    for device in server.get_devices() :
+        polling.add_device( device.name, "127.0.0.1", server.get_port(), device.name, watch=watch )
+    polling.start()
+    return( polling )
+
+#-----------------------------------------------------------------------
+# Polls per second and CPU per poll, for full and watched polls
+def bench_throughput( options ) :
+    results = {}
+
+    for ( mode, watch ) in ( ( "full", None ), ( "watch", WATCHED_VARS ) ) :
+        server  = _start_server( options )
+        polling = _start_engine( server, lambda device_id, changes, error : None, _fast_policy(), watch )
+
+        # Let the connections open
+        time.sleep( 0.5 )
+        server.reset_stats()
+        start_time = time.time()
+        start_cpu  = _cpu_time()
+
+        time.sleep( options.duration )
+
+        cpu     = _cpu_time() - start_cpu
+        elapsed = time.time() - start_time
+        stats   = server.stats()
+        polling.stop_thread()
+        server.stop()
+
+        # A watched poll is one request per variable
+        polls = stats["requests"]
+        if watch != None :
+            polls = polls / float( len( watch ) )
+
+        results[ "%s_polls_per_second" % mode ]   = polls / elapsed
+        results[ "%s_bytes_per_poll" % mode ]     = stats["bytes_sent"] / max( polls, 1 )
+        # The fake server runs in this process : its CPU time is included
+        results[ "%s_cpu_ms_per_poll" % mode ]    = 1000.0 * cpu / max( polls, 1 )
+
+    return( results )
+
+#-----------------------------------------------------------------------
+# Memory used by the engine per monitored UPS, once all of them polled
+def bench_memory( options ) :
+    server = _start_server( options )
+    done   = threading.Event()
+    seen   = set()
+
+    def callback( device_id, changes, error ) :
+        seen.add( device_id )
+        if len( seen ) == options.devices :
+            done.set()
+
+    gc.collect()
+    if tracemalloc != None :
+        tracemalloc.start()
+        before = 0
+    else :
+        before = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+
+    polling = _start_engine( server, callback )
+    done.wait( 30 )
+    gc.collect()
+
+    if tracemalloc != None :
+        # The fake server runs in this process, leave its memory out
+        snapshot = tracemalloc.take_snapshot().filter_traces( [ tracemalloc.Filter( False, "*fakeupsd.py" ) ] )
+        after    = before + sum( stat.size for stat in snapshot.statistics( "filename" ) )
+        tracemalloc.stop()
+    else :
+        after = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+
+    polling.stop_thread()
+    server.stop()
+
+    return( { "bytes_per_ups" : ( after - before ) / float( options.devices ),
+              "devices_polled" : len( seen ) } )
+
+#-----------------------------------------------------------------------
+# Main loop of the event_latency benchmark, standing for the one of the
+# GUI : schedule() can be called from any thread, the functions run in
+# the thread calling run()
+class _main_loop :
+
+    def __init__( self ) :
+        self.__timers    = []
+        self.__count     = 0
+        self.__condition = threading.Condition()
+
+    def schedule( self, delay, function ) :
+        with self.__condition :
+            heapq.heappush( self.__timers, ( time.time() + delay, self.__count, function ) )
+            self.__count += 1
+            self.__condition.notify()
+
+    #-------------------------------------------------------------------
+    # Run the scheduled functions for 'duration' seconds, or until
+    # done() returns True
+    def run( self, duration, done=None ) :
+        deadline = time.time() + duration
+        while done == None or not done() :
+            with self.__condition :
+                now = time.time()
+                if now >= deadline :
+                    return
+                if len( self.__timers ) == 0 or self.__timers[0][0] > now :
+                    wake_up = deadline
+                    if len( self.__timers ) > 0 :
+                        wake_up = min( wake_up, self.__timers[0][0] )
+                    self.__condition.wait( wake_up - now )
+                    continue
+                function = heapq.heappop( self.__timers )[2]
+            function()
+
+#-----------------------------------------------------------------------
+# Time between a status change on upsd and the desktop notification, with
+# the default adaptive polling policy. The engine callback goes through
+# the main loop and the notification center as in the front ends : the
+# batch delay of the center is part of the measure. Notifications the
+# center drops as repeated are left out.
+def bench_event_latency( options ) :
+    server    = _start_server( options )
+    loop      = _main_loop()
+    lock      = threading.Lock()
+    expected  = {}
+    requested = []
+    latencies = []
+    dropped   = [ 0 ]
+
+    class backend :
+        def show( self, handle, title, message, icon ) :
+            # Everything requested so far is on the desktop now, in this
+            # notification or a summary of them
+            now = time.time()
+            for event_time in requested :
+                latencies.append( now - event_time )
+            del requested[:]
+            return( handle or object() )
+
+    center = notify.notification_center( backend(), loop.schedule )
+
+    def notify_event( device_id, status, event_time ) :
+        deduplicated = center.stats()["deduplicated"]
+        center.notify( device_id, status, "'%s' : %s" % ( device_id, status ) )
+        if center.stats()["deduplicated"] > deduplicated :
+            dropped[0] += 1
+        else :
+            requested.append( event_time )
+
+    def callback( device_id, changes, error ) :
+        status = changes.get( "ups.status" )
+        with lock :
+            if status != None and device_id in expected and status == expected[ device_id ][0] :
+                loop.schedule( 0, lambda event_time=expected.pop( device_id )[1] : notify_event( device_id, status, event_time ) )
+
+    polling = _start_engine( server, callback )
+    devices = server.get_devices()
+
+    # Let the scheduler settle into its steady interval first
+    loop.run( min( options.duration, 5.0 ) )
+
+    for index in range( options.events ) :
+        device = devices[ index % len( devices ) ]
+        status = "OB DISCHRG" if device.vars.get( "ups.status" ) != "OB DISCHRG" else "OL"
+        with lock :
+            expected[ device.name ] = ( status, server.set_var( device.name, "ups.status", status ) )
+        loop.run( options.duration / float( options.events ) )
+
+    # Wait for the last events and their notifications
+    def done() :
+        with lock :
+            return( len( expected ) == 0 and len( requested ) == 0 and len( latencies ) + dropped[0] >= options.events )
+    loop.run( 20, done )
+
+    polling.stop_thread()
+    server.stop()
+
+    latencies.sort()
+    if len( latencies ) == 0 :
+        return( { "events_missed" : options.events - dropped[0] } )
+
+    return( { "median_ms"     : 1000.0 * latencies[ len( latencies ) // 2 ],
+              "max_ms"        : 1000.0 * latencies[-1],
+              "events_missed" : options.events - dropped[0] - len( latencies ) } )
+
+register( "poll_throughput", bench_throughput, { "full_polls_per_second" : "higher", "watch_polls_per_second" : "higher",
+                                                 "full_bytes_per_poll" : "lower", "watch_bytes_per_poll" : "lower",
+                                                 "full_cpu_ms_per_poll" : "lower", "watch_cpu_ms_per_poll" : "lower" } )
+register( "memory_per_ups", bench_memory, { "bytes_per_ups" : "lower" } )
+register( "event_latency", bench_event_latency, { "median_ms" : "lower", "max_ms" : "lower", "events_missed" : "lower" } )
+
+#-----------------------------------------------------------------------
+# Changes fed to the views by the view_update benchmark of the front ends.
+# Returns ( vars, vars_rounds, devices, fleet_rounds ) : the vars of a
+# device and the changes of its vars view at each round, the names of the
+# fleet devices (the ones of the fake upsd) and the changes of each device
+# at each round.
+def view_update_data( options, rounds=20 ) :
+    vars  = dict( fakeupsd.fake_ups( "bench", extra_vars=options.extra_vars ).vars )
+    names = sorted( vars )
+
+    # A tenth of the vars change at each round
+    vars_rounds = []
+    for i in range( rounds ) :
+        vars_rounds.append( dict( ( name, "%s-%d" % ( vars[ name ], i ) ) for name in names[ i % 10 :: 10 ] ) )
+
+    # Every device reports a new charge, load and runtime at each round,
+    # a tenth of them go on battery or back online
+    devices      = [ device.name for device in fakeupsd.make_devices( options.devices ) ]
+    fleet_rounds = []
+    for i in range( rounds ) :
+        changes = {}
+        for ( index, device_id ) in enumerate( devices ) :
+            values = { "battery.charge"  : str( 100 - ( i + index ) % 50 ),
+                       "ups.load"        : str( 20 + ( i * index ) % 30 ),
+                       "battery.runtime" : str( 1200 + 10 * ( ( i + index ) % 60 ) ) }
+            if index % 10 == i % 10 :
+                values["ups.status"] = ( "OB DISCHRG", "OL CHRG" )[ ( i // 10 ) % 2 ]
+            changes[ device_id ] = values
+        fleet_rounds.append( changes )
+
+    return( ( vars, vars_rounds, devices, fleet_rounds ) )
+
+#-----------------------------------------------------------------------
+# Startup milestones of a front end : 'command' (the interpreter and the
+# script) is run --startup-time --favorite on a favorite of the fake upsd,
+# in a new home folder, until it shows the UPS status. Returns the median
+# time of each milestone, counted from the start of the program, and the
+# number of runs which did not show the status.
+def startup_time( command, options, timeout=30.0 ) :
+    server = fakeupsd.fake_upsd( [ fakeupsd.fake_ups( "bench", extra_vars=options.extra_vars ) ] )
+    server.start()
+
+    home = tempfile.mkdtemp()
+    env  = dict( os.environ )
+    env["HOME"] = env["USERPROFILE"] = home
+    # The milestones must be read as soon as they are printed
+    env["PYTHONUNBUFFERED"] = "1"
+
+    try :
+        config_path = os.path.join( home, ".nut-monitor" )
+        os.makedirs( config_path, 0o700 )
+        store = favorites.favorites_store( os.path.join( config_path, "favorites.ini" ) )
+        store.set( "bench", { "host" : "127.0.0.1", "port" : str( server.get_port() ), "ups" : "bench" } )
+        store.save()
+
+        milestones = {}
+        failures   = 0
+        for run in range( options.startup_runs ) :
+            process  = subprocess.Popen( command + [ "--startup-time", "--favorite", "bench" ], stdout=subprocess.PIPE, env=env, universal_newlines=True )
+            watchdog = threading.Timer( timeout, process.kill )
+            watchdog.start()
+            shown    = False
+            try :
+                for line in iter( process.stdout.readline, "" ) :
+                    if not line.startswith( "startup:" ) :
+                        continue
+                    ( name, value, unit ) = line[ len( "startup:" ) : ].rsplit( None, 2 )
+                    name = name.strip()
+                    milestones.setdefault( "%s_ms" % name.lower().replace( " ", "_" ), [] ).append( float( value ) )
+                    if name == "first UPS status" :
+                        shown = True
+                        break
+            finally :
+                watchdog.cancel()
+                if process.poll() == None :
+                    process.terminate()
+                process.wait()
+                process.stdout.close()
+
+            if not shown :
+                failures += 1
+    finally :
+        server.stop()
+        shutil.rmtree( home, True )
+
+    results = { "startup_failures" : failures }
+    for ( key, values ) in milestones.items() :
+        values.sort()
+        results[ key ] = values[ len( values ) // 2 ]
+    return( results )
+
+#-----------------------------------------------------------------------
+# Return the list of regressions between two runs
+def compare( baseline, results, tolerance ) :
+    regressions = []
+    for ( name, function, better ) in _benchmarks :
+        for ( key, direction ) in better.items() :
+            try :
+                old = baseline[ name ][ key ]
+                new = results[ name ][ key ]
+            except KeyError :
+                continue
+
+            if direction == "higher" :
+                worse = new < old * ( 1.0 - tolerance )
+            else :
+                worse = new > old * ( 1.0 + tolerance ) and new - old > 1e-9
+            if worse :
+                regressions.append( "%s.%s: %.3f -> %.3f" % ( name, key, old, new ) )
+
+    return( regressions )
+
+def parse_options( args=None ) :
+    opt_parser = optparse.OptionParser( usage="python -m nutmonitor.bench [options] [benchmark...]" )
+    opt_parser.add_option( "--devices", type="int", default=100, help="Number of simulated UPSes (default: %default)" )
+    opt_parser.add_option( "--duration", type="float", default=5.0, help="Duration of each measure, in seconds (default: %default)" )
+    opt_parser.add_option( "--events", type="int", default=20, help="Power events for event_latency (default: %default)" )
+    opt_parser.add_option( "--extra-vars", type="int", default=100, dest="extra_vars", help="Additional variables per device (default: %default)" )
+    opt_parser.add_option( "--startup-runs", type="int", default=5, dest="startup_runs", help="Runs of the front end by the startup benchmark (default: %default)" )
+    opt_parser.add_option( "--spread", type="float", default=0.0, help="Scenario shift between devices" )
+    opt_parser.add_option( "--latency", type="float", default=0.0, help="upsd answer latency, in seconds" )
+    opt_parser.add_option( "--loss", type="float", default=0.0, help="Probability of a lost upsd answer" )
+    opt_parser.add_option( "--save", default=None, help="Save the results to this JSON file" )
+    opt_parser.add_option( "--compare", default=None, help="Compare the results with this JSON file" )
+    opt_parser.add_option( "--tolerance", type="float", default=0.2, help="Relative change tolerated by --compare (default: %default)" )
+
+    return( opt_parser.parse_args( args ) )
+
+def main( args=None ) :
+    ( options, names ) = parse_options( args )
+
+    results = {}
+    for ( name, function, better ) in _benchmarks :
+        if len( names ) > 0 and name not in names :
+            continue
+
+        sys.stdout.write( "%-20s " % name )
+        sys.stdout.flush()
+        results[ name ] = function( options )
+        print( ", ".join( "%s=%.3f" % ( k, v ) for ( k, v ) in sorted( results[ name ].items() ) ) )
+
+    if options.save != None :
+        with open( options.save, "w" ) as fh :
+            json.dump( results, fh, indent=2, sort_keys=True )
+
+    if options.compare != None :
+        with open( options.compare ) as fh :
+            regressions = compare( json.load( fh ), results, options.tolerance )
+        for line in regressions :
+            print( "REGRESSION %s" % line )
+        if len( regressions ) > 0 :
+            return( 1 )
+
+    return( 0 )
+
+if __name__ == "__main__" :
+    sys.exit( main() )
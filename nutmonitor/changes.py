@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# Change detection on UPS variables snapshots
+#
+# Each poll returns a full snapshot of the UPS variables. Comparing it
+# with the previous snapshot lets the front ends only refresh what
+# depends on the variables that actually changed, and skip all GUI work
+# on ticks where nothing changed.
+
+
+#-----------------------------------------------------------------------
+# Return a dict of the variables that differ between the two snapshots.
+# Variables missing from the new snapshot are reported with a None value.
+def diff_vars( old_vars, new_vars ) :
+    changes = {}
+
+    for k, v in new_vars.items() :
+        if old_vars.get( k ) != v :
+            changes[k] = v
+
+    for k in old_vars :
+        if k not in new_vars :
+            changes[k] = None
+
+    return( changes )
+
+#-----------------------------------------------------------------------
+# Return True if one of the 'keys' variables is part of the changes
+def affects( changes, keys ) :
+    for k in keys :
+        if k in changes :
+            return( True )
+    return( False )
+
+#-----------------------------------------------------------------------
+# Keep the last snapshot of a device and compute the changes of the next one
+class vars_tracker :
+
+    def __init__( self ) :
+        self.vars = {}
+
+    def update( self, new_vars ) :
+        changes   = diff_vars( self.vars, new_vars )
+        self.vars = new_vars
+        return( changes )
+
+    # Forget the last snapshot, the next update reports every variable
+    def reset( self ) :
+        self.vars = {}
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+# Headless monitoring daemon and its local query API
+#
+# The daemon polls every favorite with the polling engine, records the
+# metrics history and serves the current state over a Unix socket. The
+# GUI (or several GUIs on a shared host) can then read the state from the
+# daemon instead of each one polling every device.
+#
+# The API is one JSON object per line. The client sends a request such as
+# {"command": "changes", "since": 12} and reads one JSON answer line :
+#
+#   devices                     list of the monitored devices
+#   vars     name               vars of a device (name or ups@host:port)
+#   changes  since              devices changed after the 'since' sequence
+#   history  device metric start [end]
+#                               recorded values of a metric
+#   metrics  [format]           instrumentation metrics (see metrics.py),
+#                               "prometheus" format for the text format
+#   poll     [device]           poll a device (all of them without device)
+#                               at once, after a upsmon event for instance
+
+import os
+import os.path
+import socket
+import threading
+import json
+import time
+
+try :
+    import socketserver
+except ImportError :
+    import SocketServer as socketserver
+
+from nutmonitor import engine
+from nutmonitor import events
+from nutmonitor import favorites as favorites_mod
+from nutmonitor import metrics
+from nutmonitor.changes import vars_tracker
+
+
+SOCKET_NAME = "daemon.sock"
+
+
+class daemon_error( Exception ) :
+    pass
+
+#-----------------------------------------------------------------------
+# One request per line, one answer per line
+class _request_handler( socketserver.StreamRequestHandler ) :
+
+    def handle( self ) :
+        for line in self.rfile :
+            line = line.strip()
+            if not line :
+                continue
+
+            try :
+                request = json.loads( line.decode( "utf-8" ) )
+                answer  = self.server.daemon.handle_request( request )
+            except Exception as e :
+                answer = { "error" : str( e ) }
+
+            self.wfile.write( ( json.dumps( answer ) + "\n" ).encode( "utf-8" ) )
+            self.wfile.flush()
+
+class _server( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ) :
+    daemon_threads = True
+
+#-----------------------------------------------------------------------
+# The daemon itself
+class monitor_daemon :
+
+    def __init__( self, favorites, socket_path, history=None, policy=None ) :
+        self.__socket_path = socket_path
+        self.__history     = history
+        self.__lock        = threading.Lock()
+        self.__seq         = 0
+        self.__state       = {}
+        self.__by_device   = {}
+        self.__server      = None
+
+        self.__engine = engine.polling_engine( self.__engine_callback, policy )
+
+        for ( name, fav ) in favorites.items() :
+            device = favorites_mod.device_name( fav )
+            ( login, password ) = favorites_mod.credentials( fav )
+
+            self.__state[ name ]       = { "device" : device, "vars" : {}, "error" : None, "updated" : None, "seq" : 0 }
+            self.__by_device[ device ] = name
+            self.__engine.add_device( name, fav.get("host",""), fav.get("port","3493"), fav.get("ups",""), login, password )
+
+    #-------------------------------------------------------------------
+    # Called from the engine thread
+    def __engine_callback( self, name, changes, error ) :
+        with self.__lock :
+            state = self.__state[ name ]
+            for ( k, v ) in changes.items() :
+                if v == None :
+                    state["vars"].pop( k, None )
+                else :
+                    state["vars"][k] = v
+
+            self.__seq       += 1
+            state["error"]    = error
+            state["updated"]  = time.time()
+            state["seq"]      = self.__seq
+
+        if self.__history != None :
+            if error != None :
+                self.__history.forget( state["device"] )
+            elif len( changes ) > 0 :
+                self.__history.record( state["device"], changes )
+
+    def __find( self, name ) :
+        name = self.__by_device.get( name, name )
+        if name not in self.__state :
+            raise daemon_error( "Unknown device '%s'" % name )
+        return( name )
+
+    #-------------------------------------------------------------------
+    # upsmon reported an event (see events.py) : poll the devices of the
+    # UPS at once. Called from the event listener thread.
+    def power_event( self, event, ups_name ) :
+        for device in events.match_devices( ups_name, self.__by_device.keys() ) :
+            self.__engine.poll_now( self.__by_device[ device ] )
+        metrics.count( "power_events_total", { "event" : event } )
+
+    #-------------------------------------------------------------------
+    # Answer an API request (called from the server threads)
+    def handle_request( self, request ) :
+        command = request.get( "command" )
+
+        with self.__lock :
+            if command == "devices" :
+                return( { "seq" : self.__seq, "devices" : dict( ( name, { "device" : state["device"], "error" : state["error"], "updated" : state["updated"] } ) for ( name, state ) in self.__state.items() ) } )
+
+            if command == "vars" :
+                state = self.__state[ self.__find( request.get( "device" ) ) ]
+                return( { "vars" : dict( state["vars"] ), "error" : state["error"], "updated" : state["updated"] } )
+
+            if command == "changes" :
+                since   = int( request.get( "since", 0 ) )
+                changed = dict( ( name, { "device" : state["device"], "vars" : dict( state["vars"] ), "error" : state["error"] } ) for ( name, state ) in self.__state.items() if state["seq"] > since )
+                return( { "seq" : self.__seq, "devices" : changed } )
+
+        if command == "history" :
+            if self.__history == None :
+                raise daemon_error( "History is disabled" )
+            points = self.__history.query( request["device"], request["metric"], float( request["start"] ), request.get( "end" ) )
+            return( { "points" : points } )
+
+        if command == "metrics" :
+            if not metrics.is_enabled() :
+                raise daemon_error( "Metrics are disabled" )
+            if request.get( "format" ) == "prometheus" :
+                return( { "text" : metrics.to_prometheus() } )
+            return( { "metrics" : metrics.snapshot() } )
+
+        if command == "poll" :
+            if request.get( "device" ) == None :
+                self.__engine.poll_now()
+            else :
+                with self.__lock :
+                    name = self.__find( request["device"] )
+                self.__engine.poll_now( name )
+            return( {} )
+
+        raise daemon_error( "Unknown command '%s'" % command )
+
+    #-------------------------------------------------------------------
+    # Start polling and serve requests until stop() is called
+    def serve_forever( self ) :
+        if not hasattr( socket, "AF_UNIX" ) :
+            raise daemon_error( "The daemon needs Unix sockets" )
+
+        if os.path.exists( self.__socket_path ) :
+            if daemon_client( self.__socket_path ).is_running() :
+                raise daemon_error( "A daemon is already listening on '%s'" % self.__socket_path )
+            os.remove( self.__socket_path )
+
+        # Only the user may talk to the daemon
+        old_umask = os.umask( 0o077 )
+        try :
+            self.__server = _server( self.__socket_path, _request_handler )
+        finally :
+            os.umask( old_umask )
+
+        self.__server.daemon = self
+        self.__engine.start()
+
+        try :
+            self.__server.serve_forever()
+        finally :
+            self.__engine.stop_thread()
+            self.__server.server_close()
+            if os.path.exists( self.__socket_path ) :
+                os.remove( self.__socket_path )
+            if self.__history != None :
+                self.__history.close()
+
+    def stop( self ) :
+        if self.__server != None :
+            self.__server.shutdown()
+
+#-----------------------------------------------------------------------
+# Client of the daemon API
+class daemon_client :
+
+    def __init__( self, socket_path, timeout=2.0 ) :
+        self.__socket_path = socket_path
+        self.__timeout     = timeout
+
+    def request( self, command, **arguments ) :
+        arguments["command"] = command
+
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        sock.settimeout( self.__timeout )
+        try :
+            sock.connect( self.__socket_path )
+            sock.sendall( ( json.dumps( arguments ) + "\n" ).encode( "utf-8" ) )
+
+            data = b""
+            while not data.endswith( b"\n" ) :
+                chunk = sock.recv( 65536 )
+                if not chunk :
+                    break
+                data += chunk
+        finally :
+            sock.close()
+
+        answer = json.loads( data.decode( "utf-8" ) )
+        if "error" in answer and len( answer ) == 1 :
+            raise daemon_error( answer["error"] )
+
+        return( answer )
+
+    #-------------------------------------------------------------------
+    # Return True if a daemon answers on the socket
+    def is_running( self ) :
+        if not hasattr( socket, "AF_UNIX" ) or not os.path.exists( self.__socket_path ) :
+            return( False )
+        try :
+            self.request( "devices" )
+            return( True )
+        except ( socket.error, ValueError, daemon_error ) :
+            return( False )
+
+    def get_vars( self, device ) :
+        return( self.request( "vars", device=device ) )
+
+#-----------------------------------------------------------------------
+# Reports the changes seen by the daemon with the same callback as the
+# polling engine : callback( device_id, changes, error ). It has the
+# methods of the polling engine the front ends use, so it can stand in
+# place of their own polling engine. A device is added under the name of
+# its favorite, or its ups@host:port name.
+class daemon_poller( threading.Thread ) :
+
+    # After poll_now(), the changes are asked for at this interval for a
+    # few seconds, to report the new state as soon as the daemon has it
+    __fast_interval = 0.1
+    __fast_duration = 3.0
+
+    def __init__( self, client, callback, interval=1.0 ) :
+        threading.Thread.__init__( self )
+        self.daemon = True
+
+        self.__client      = client
+        self.__callback    = callback
+        self.__interval    = interval
+        self.__trackers    = {}
+        self.__errors      = {}
+        self.__lock        = threading.Lock()
+        self.__resync      = True
+        self.__wakeup      = threading.Event()
+        self.__fast_until  = 0
+        self.__stop_thread = False
+
+    #-------------------------------------------------------------------
+    # Report the changes of a device. The connection parameters are
+    # those of polling_engine.add_device() : the daemon already knows
+    # them. Its current state is reported at the next request.
+    def add_device( self, device_id, host=None, port=None, ups=None, login=None, password=None, watch=None ) :
+        with self.__lock :
+            self.__trackers[ device_id ] = vars_tracker()
+            self.__errors.pop( device_id, None )
+            self.__resync = True
+        self.__wakeup.set()
+
+    def remove_device( self, device_id ) :
+        with self.__lock :
+            self.__trackers.pop( device_id, None )
+            self.__errors.pop( device_id, None )
+
+    #-------------------------------------------------------------------
+    # The daemon polls at its own pace
+    def set_hidden( self, hidden ) :
+        pass
+
+    #-------------------------------------------------------------------
+    # Have the daemon poll a device (all of them if device_id is None) at
+    # once. Can be called from any thread.
+    def poll_now( self, device_id=None ) :
+        try :
+            if device_id == None :
+                self.__client.request( "poll" )
+            else :
+                self.__client.request( "poll", device=device_id )
+        except Exception :
+            # Daemon gone : run() reports it
+            pass
+
+        self.__fast_until = time.time() + self.__fast_duration
+        self.__wakeup.set()
+
+    def stop_thread( self ) :
+        self.__stop_thread = True
+        self.__wakeup.set()
+
+    def run( self ) :
+        seq = 0
+        while not self.__stop_thread :
+            # Cleared before the request : a wake up coming meanwhile is
+            # not lost
+            self.__wakeup.clear()
+            with self.__lock :
+                if self.__resync :
+                    # Devices were added : ask for the state of all of them
+                    self.__resync = False
+                    seq           = 0
+
+            try :
+                answer = self.__client.request( "changes", since=seq )
+            except Exception as e :
+                answer = None
+                error  = "NUT-Monitor daemon unreachable (%s)" % e
+
+            # The callback is called outside of the lock : it may add or
+            # remove devices
+            if answer == None :
+                reports = self.__failed( error )
+                seq     = 0
+            else :
+                reports = self.__changed( answer["devices"], seq == 0 )
+                seq     = answer["seq"]
+
+            for report in reports :
+                try :
+                    self.__callback( *report )
+                except Exception :
+                    # A faulty callback must not stop the reports, nor be
+                    # taken for a daemon failure
+                    pass
+
+            interval = self.__interval
+            if time.time() < self.__fast_until :
+                interval = min( interval, self.__fast_interval )
+            self.__wakeup.wait( interval )
+
+    #-------------------------------------------------------------------
+    # Return the reports of the changes answered by the daemon. After a
+    # full answer, the devices the daemon does not monitor are reported
+    # as failing.
+    def __changed( self, changed, full ) :
+        reports = []
+        with self.__lock :
+            seen = set()
+            for ( name, state ) in changed.items() :
+                for device_id in ( name, state["device"] ) :
+                    if device_id in self.__trackers and device_id not in seen :
+                        seen.add( device_id )
+                        self.__update( device_id, state["vars"], state["error"], reports )
+
+            if full :
+                for device_id in self.__trackers :
+                    if device_id not in seen :
+                        self.__update( device_id, {}, "Not monitored by the NUT-Monitor daemon", reports )
+
+        return( reports )
+
+    def __update( self, device_id, vars, error, reports ) :
+        tracker = self.__trackers[ device_id ]
+
+        # As the engine does, report all the vars on recovery
+        if error != None :
+            tracker.reset()
+            changes = {}
+        else :
+            changes = tracker.update( vars )
+
+        # Only report the transition to the error state, and the recovery
+        # even if no var changed
+        was_failing = self.__errors.get( device_id ) != None
+        self.__errors[ device_id ] = error
+
+        if ( error != None and not was_failing ) or len( changes ) > 0 or ( was_failing and error == None ) :
+            reports.append( ( device_id, changes, error if not was_failing else None ) )
+
+    #-------------------------------------------------------------------
+    # Daemon gone : report it once for every device
+    def __failed( self, error ) :
+        reports = []
+        with self.__lock :
+            for ( device_id, tracker ) in self.__trackers.items() :
+                tracker.reset()
+                if self.__errors.get( device_id ) == None :
+                    self.__errors[ device_id ] = error
+                    reports.append( ( device_id, {}, error ) )
+
+        return( reports )
+
+#-----------------------------------------------------------------------
+# Default socket path in the user configuration directory
+def default_socket_path() :
+    return( os.path.join( favorites_mod.get_config_path(), SOCKET_NAME ) )
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+# Network discovery of upsd servers
+#
+# Probes a list of hosts and IPv4 networks (CIDR) for upsd servers and
+# lists the devices of every server answering. Probes are non-blocking
+# nut_connections (see protocol.py) multiplexed with poll() (select() where
+# poll() is not available) by a single thread : up to 'concurrency'
+# servers are probed at once, a /22 takes a few probe timeouts at most.
+#
+#   python -m nutmonitor.discovery 192.168.1.0/24 ups.example.com:3493 [::1]:3493
+#
+# Hostnames are resolved when their probe starts, with a blocking call :
+# prefer addresses for large scans.
+
+import collections
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+from nutmonitor import protocol
+
+
+# select() handles descriptors up to FD_SETSIZE (1024 on most systems),
+# and the front end has its own descriptors : without poll(), the probes
+# stay well below it
+if hasattr( select, "poll" ) :
+    MAX_CONCURRENCY = 512
+else :
+    MAX_CONCURRENCY = 256
+
+# Largest number of hosts expand_targets() accepts (a /16)
+MAX_TARGETS     = 65536
+
+
+#-----------------------------------------------------------------------
+# Return the ( host, port ) to probe for each target. A target is a host
+# name or address, or an IPv4 network 'address/bits', optionally followed
+# by ':port'. IPv6 addresses are given as is, or between brackets to be
+# followed by a port : '[::1]:3493'. The network and broadcast addresses
+# of networks are left out. Raises ValueError on invalid targets.
+def expand_targets( specs, port=3493, limit=MAX_TARGETS ) :
+    targets = []
+    seen    = set()
+
+    for spec in specs :
+        spec        = spec.strip()
+        target_port = port
+        if spec == "" :
+            continue
+
+        # [address]:port, host:port, IPv6 addresses are taken as is
+        if spec.startswith( "[" ) :
+            end = spec.find( "]" )
+            if end == -1 or ( end + 1 < len( spec ) and spec[end+1] != ":" ) :
+                raise ValueError( "Invalid address in '%s'" % spec )
+            if end + 1 < len( spec ) :
+                target_port = _parse_port( spec, spec[end+2:] )
+            spec = spec[1:end]
+        elif spec.count( ":" ) == 1 :
+            ( spec, target_port ) = spec.split( ":" )
+            target_port = _parse_port( spec, target_port )
+
+        if "/" in spec :
+            hosts = _network_hosts( spec, limit )
+        else :
+            hosts = [ spec ]
+
+        for host in hosts :
+            if ( host, target_port ) not in seen :
+                seen.add( ( host, target_port ) )
+                targets.append( ( host, target_port ) )
+
+        if len( targets ) > limit :
+            raise ValueError( "Too many hosts to scan (more than %d)" % limit )
+
+    return( targets )
+
+def _parse_port( spec, port ) :
+    if not port.isdigit() or not 0 < int( port ) < 65536 :
+        raise ValueError( "Invalid port in '%s'" % spec )
+    return( int( port ) )
+
+#-----------------------------------------------------------------------
+# Addresses of the hosts of an IPv4 network, e.g. 10.0.0.0/22
+def _network_hosts( spec, limit ) :
+    ( address, bits ) = spec.split( "/", 1 )
+    try :
+        base = struct.unpack( "!I", socket.inet_aton( address ) )[0]
+        bits = int( bits )
+    except ( socket.error, ValueError ) :
+        raise ValueError( "Invalid network '%s'" % spec )
+
+    if not 0 <= bits <= 32 :
+        raise ValueError( "Invalid network '%s'" % spec )
+
+    mask  = ( 0xFFFFFFFF << ( 32 - bits ) ) & 0xFFFFFFFF
+    first = base & mask
+    last  = first | ( ~mask & 0xFFFFFFFF )
+    if bits < 31 :
+        first += 1
+        last  -= 1
+
+    if last - first + 1 > limit :
+        raise ValueError( "Too many hosts to scan (more than %d)" % limit )
+
+    return( [ socket.inet_ntoa( struct.pack( "!I", address ) ) for address in range( first, last + 1 ) ] )
+
+#-----------------------------------------------------------------------
+# Scanner thread.
+# callback( done, total, found ) is called from the scanner thread after
+# each probe : 'found' is None when nothing answered, or a
+# ( host, port, upses, error ) tuple for a upsd server, 'upses' mapping
+# each device name to its description, 'error' being the error upsd
+# answered to LIST UPS (None if none). GUI front ends must forward it to
+# their main loop themselves.
+class network_scanner( threading.Thread ) :
+
+    __select_timeout = 0.2
+
+    def __init__( self, targets, callback, concurrency=256, timeout=2.0 ) :
+        threading.Thread.__init__( self )
+        self.daemon = True
+
+        self.__targets     = list( targets )
+        self.__callback    = callback
+        self.__concurrency = max( 1, min( concurrency, MAX_CONCURRENCY ) )
+        self.__timeout     = timeout
+        self.__stop_thread = False
+        self.__done        = 0
+
+    def stop_thread( self ) :
+        self.__stop_thread = True
+
+    #-------------------------------------------------------------------
+    # Start probing a server : connect and ask for its devices
+    def __probe( self, host, port ) :
+        conn = protocol.nut_connection( host, port, timeout=self.__timeout )
+
+        def answered( upses, error ) :
+            # Errors sent by upsd arrive while the connection is open,
+            # network errors once it is closed
+            if conn.is_open() :
+                self.__finished( ( host, port, upses or {}, error ) )
+                conn.close()
+            else :
+                self.__finished( None )
+
+        try :
+            conn.open()
+        except ( socket.error, socket.gaierror ) :
+            self.__finished( None )
+            return( None )
+
+        conn.list_upses( answered )
+        return( conn )
+
+    def __finished( self, found ) :
+        self.__done += 1
+        try :
+            self.__callback( self.__done, len( self.__targets ), found )
+        except Exception :
+            # A faulty callback must not kill the scan
+            pass
+
+    def run( self ) :
+        waiting = collections.deque( self.__targets )
+        probes  = []
+
+        while not self.__stop_thread and ( len( waiting ) > 0 or len( probes ) > 0 ) :
+            while len( waiting ) > 0 and len( probes ) < self.__concurrency :
+                conn = self.__probe( *waiting.popleft() )
+                if conn != None and conn.is_open() :
+                    probes.append( conn )
+
+            if len( probes ) == 0 :
+                continue
+
+            ( readable, writable ) = _wait( probes, self.__select_timeout )
+
+            for conn in writable :
+                if conn.is_open() :
+                    conn.handle_write()
+
+            for conn in readable :
+                if conn.is_open() :
+                    conn.handle_read()
+
+            now = time.time()
+            for conn in probes :
+                if conn.is_open() :
+                    conn.check_timeout( now )
+
+            probes = [ conn for conn in probes if conn.is_open() ]
+
+        for conn in probes :
+            conn.close( "Scan stopped" )
+
+#-----------------------------------------------------------------------
+# Wait until connections are readable or writable, return the lists of
+# both. poll() has no limit on the descriptor numbers, select() is the
+# fallback.
+def _wait( connections, timeout ) :
+    if hasattr( select, "poll" ) :
+        poller = select.poll()
+        by_fd  = {}
+        for conn in connections :
+            by_fd[ conn.fileno() ] = conn
+            if conn.wants_write() :
+                poller.register( conn.fileno(), select.POLLIN | select.POLLOUT )
+            else :
+                poller.register( conn.fileno(), select.POLLIN )
+
+        try :
+            events = poller.poll( timeout * 1000 )
+        except ( select.error, socket.error ) :
+            return( ( [], [] ) )
+
+        # Errors are reported to both handlers, which close the connection
+        readable = [ by_fd[ fd ] for ( fd, event ) in events if event & ( select.POLLIN | select.POLLERR | select.POLLHUP ) ]
+        writable = [ by_fd[ fd ] for ( fd, event ) in events if event & ( select.POLLOUT | select.POLLERR | select.POLLHUP ) ]
+        return( ( readable, writable ) )
+
+    writers = [ conn for conn in connections if conn.wants_write() ]
+    try :
+        ( readable, writable, unused ) = select.select( connections, writers, [], timeout )
+    except ( select.error, socket.error, ValueError ) :
+        return( ( [], [] ) )
+    return( ( readable, writable ) )
+
+#-----------------------------------------------------------------------
+# Scan and return the sorted list of the ( host, port, upses, error )
+# of the servers found. Blocks until the scan is over.
+def scan( specs, port=3493, concurrency=256, timeout=2.0 ) :
+    found = []
+
+    def callback( done, total, server ) :
+        if server != None :
+            found.append( server )
+
+    network_scanner( expand_targets( specs, port ), callback, concurrency, timeout ).run()
+    return( sorted( found ) )
+
+def main( args=None ) :
+    import optparse
+
+    opt_parser = optparse.OptionParser( usage="python -m nutmonitor.discovery [options] HOST|NETWORK[:PORT]..." )
+    opt_parser.add_option( "--port", type="int", default=3493, help="Port of upsd (default: %default)" )
+    opt_parser.add_option( "--concurrency", type="int", default=256, help="Servers probed at once (default: %default)" )
+    opt_parser.add_option( "--timeout", type="float", default=2.0, help="Probe timeout, in seconds (default: %default)" )
+
+    ( opts, args ) = opt_parser.parse_args( args )
+    if len( args ) == 0 :
+        opt_parser.error( "no host or network to scan" )
+
+    try :
+        servers = scan( args, opts.port, opts.concurrency, opts.timeout )
+    except ValueError :
+        opt_parser.error( str( sys.exc_info()[1] ) )
+
+    for ( host, port, upses, error ) in servers :
+        if error != None :
+            print( "%s:%d  (%s)" % ( host, port, error ) )
+        for name in sorted( upses.keys() ) :
+            print( "%s@%s:%d  %s" % ( name, host, port, upses[ name ] ) )
+
+    return( 0 )
+
+if __name__ == "__main__" :
+    sys.exit( main() )
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+# Multi-UPS polling engine
+#
+# A single thread multiplexes the connections to every upsd server with
+# select(). Devices hosted on the same server (same host, port and login)
+# share one connection. After each poll the engine compares the new
+# variables with the previous ones and only reports what changed, so the
+# GUI work per tick depends on the number of changed values and not on
+# the number of monitored devices.
+#
+# When each device is polled is decided by the adaptive scheduler (see
+# nutmonitor/scheduler.py) : steady devices are polled less and less
+# often, devices on battery every second.
+#
+# A device can be given a watch set : only these variables are polled,
+# with pipelined GET VAR requests, instead of the whole LIST VAR.
+#
+# Host names are resolved by short lived helper threads, a slow DNS
+# server only delays the devices of the hosts being resolved.
+
+import threading
+import select
+import socket
+import time
+
+from nutmonitor import metrics
+from nutmonitor import protocol
+from nutmonitor import scheduler
+from nutmonitor.changes import diff_vars
+
+
+#-----------------------------------------------------------------------
+# A device monitored by the engine. Slots keep the memory used per device
+# small and fixed, the engine may monitor hundreds of them.
+class monitored_device( object ) :
+
+    __slots__ = ( "device_id", "host", "port", "ups", "login", "password", "watch", "vars", "error", "in_flight" )
+
+    def __init__( self, device_id, host, port, ups, login=None, password=None, watch=None ) :
+        self.device_id = device_id
+        self.host      = host
+        self.port      = int( port )
+        self.ups       = ups
+        self.login     = login
+        self.password  = password
+        self.watch     = watch
+        self.vars      = {}
+        self.error     = None
+        self.in_flight = False
+
+    def connection_key( self ) :
+        return( ( self.host, self.port, self.login ) )
+
+#-----------------------------------------------------------------------
+# Polling engine thread.
+# The callback is called from the engine thread with
+# ( device_id, changes, error ) where 'changes' maps each changed
+# variable to its new value (None when the variable disappeared) and
+# 'error' is an error message when the device becomes unreachable.
+# GUI front ends must forward it to their main loop themselves.
+class polling_engine( threading.Thread ) :
+
+    __select_timeout = 0.2
+
+    # Resolved addresses are used for new connections during this delay
+    __address_ttl    = 300.0
+
+    def __init__( self, callback, policy=None ) :
+        threading.Thread.__init__( self )
+        self.daemon = True
+
+        self.__callback    = callback
+        self.__scheduler   = scheduler.poll_scheduler( policy )
+        self.__devices     = {}
+        self.__connections = {}
+        self.__addresses   = {}
+        self.__resolving   = set()
+        self.__prune       = False
+        self.__lock        = threading.Lock()
+        self.__stop_thread = False
+
+        # poll_now() writes to it to wake the select() up, otherwise a
+        # poll asked for waits for the end of the select() timeout
+        self.__wakeup      = None
+        if hasattr( socket, "socketpair" ) :
+            try :
+                self.__wakeup = socket.socketpair()
+                for sock in self.__wakeup :
+                    sock.setblocking( False )
+            except socket.error :
+                self.__wakeup = None
+
+    #-------------------------------------------------------------------
+    # Add a device to monitor. Can be called from any thread. 'watch' is
+    # the list of the variables to poll, None to poll all of them.
+    def add_device( self, device_id, host, port, ups, login=None, password=None, watch=None ) :
+        device = monitored_device( device_id, host, port, ups, login, password, watch )
+        with self.__lock :
+            self.__devices[ device_id ] = device
+        self.__scheduler.add( device_id, time.time() )
+
+    #-------------------------------------------------------------------
+    # Stop monitoring a device. Can be called from any thread. The engine
+    # thread closes the connections no other device uses.
+    def remove_device( self, device_id ) :
+        with self.__lock :
+            self.__devices.pop( device_id, None )
+            self.__prune = True
+        self.__scheduler.remove( device_id )
+        self.__wake_up()
+
+    #-------------------------------------------------------------------
+    # Poll a device (or all of them if device_id is None) right now,
+    # after a power event reported by upsmon for instance
+    def poll_now( self, device_id=None ) :
+        self.__scheduler.poll_now( device_id, time.time() )
+        self.__wake_up()
+
+    #-------------------------------------------------------------------
+    # Tell the engine the front end is hidden, so steady devices are
+    # polled less often
+    def set_hidden( self, hidden ) :
+        self.__scheduler.set_hidden( hidden, time.time() )
+
+    def stop_thread( self ) :
+        self.__stop_thread = True
+        self.__wake_up()
+
+    def __wake_up( self ) :
+        if self.__wakeup != None :
+            try :
+                self.__wakeup[1].send( b"x" )
+            except socket.error :
+                # Full : the engine has not woken up yet anyway
+                pass
+
+    #-------------------------------------------------------------------
+    # Close the connections of the removed devices
+    def __close_unused( self ) :
+        with self.__lock :
+            self.__prune = False
+            keys         = set( device.connection_key() for device in self.__devices.values() )
+            hosts        = set( key[:2] for key in keys )
+            for host in list( self.__addresses.keys() ) :
+                if host not in hosts :
+                    del self.__addresses[ host ]
+
+        for key in list( self.__connections.keys() ) :
+            if key not in keys :
+                self.__connections.pop( key ).close( "Device removed" )
+
+    #-------------------------------------------------------------------
+    # Tell if the device can be polled without blocking : its connection
+    # is open or the address of its host is known. Otherwise start the
+    # resolution of the host name in a helper thread.
+    def __address_ready( self, device, now ) :
+        conn = self.__connections.get( device.connection_key() )
+        if conn != None and conn.is_open() :
+            return( True )
+
+        host = ( device.host, device.port )
+        with self.__lock :
+            entry = self.__addresses.get( host )
+            if entry != None and now - entry[0] < self.__address_ttl :
+                return( True )
+            if host in self.__resolving :
+                return( False )
+
+        try :
+            # Numeric addresses do not need a DNS lookup
+            address = protocol.resolve( device.host, device.port, True )
+        except ( socket.error, socket.gaierror ) :
+            address = None
+
+        with self.__lock :
+            if address != None :
+                self.__addresses[ host ] = ( now, address, None )
+                return( True )
+            self.__resolving.add( host )
+
+        resolver = threading.Thread( target=self.__resolve, args=host )
+        resolver.daemon = True
+        resolver.start()
+        return( False )
+
+    def __resolve( self, host, port ) :
+        address, error = None, None
+        try :
+            address = protocol.resolve( host, port )
+        except ( socket.error, socket.gaierror ) as e :
+            error = e
+
+        with self.__lock :
+            self.__addresses[ ( host, port ) ] = ( time.time(), address, error )
+            self.__resolving.discard( ( host, port ) )
+        self.__wake_up()
+
+    #-------------------------------------------------------------------
+    # Return the connection used for a device, opening it if needed
+    def __get_connection( self, device ) :
+        key  = device.connection_key()
+        conn = self.__connections.get( key )
+
+        if conn == None or not conn.is_open() :
+            if conn != None :
+                metrics.count( "upsd_reconnects_total" )
+
+            host = ( device.host, device.port )
+            with self.__lock :
+                entry = self.__addresses.get( host )
+                if entry != None and entry[2] != None :
+                    # Resolve the host again at the next poll
+                    del self.__addresses[ host ]
+
+            if entry == None :
+                address = protocol.resolve( device.host, device.port )
+            elif entry[2] != None :
+                raise entry[2]
+            else :
+                address = entry[1]
+
+            conn = protocol.nut_connection( device.host, device.port, device.login, device.password )
+            conn.open( address )
+            self.__connections[ key ] = conn
+
+        return( conn )
+
+    #-------------------------------------------------------------------
+    # Send a LIST VAR request for the device, or GET VAR requests for the
+    # variables of its watch set
+    def __poll( self, device, now ) :
+        device.in_flight = True
+        self.__scheduler.started( device.device_id, now )
+        start = metrics.clock()
+
+        def poll_done( new_vars, error ) :
+            device.in_flight = False
+            if start != None :
+                call = "GET VAR" if device.watch != None else "LIST VAR"
+                metrics.observe_since( "upsd_call_seconds", start, { "call" : call } )
+                if error != None :
+                    metrics.count( "upsd_call_errors_total", { "call" : call } )
+            self.__update_device( device, new_vars, error )
+
+        try :
+            conn = self.__get_connection( device )
+        except ( socket.error, socket.gaierror ) as e :
+            poll_done( None, "Error connecting to '%s' (%s)" % ( device.host, e ) )
+            return
+
+        if device.watch != None :
+            conn.get_vars( device.ups, device.watch, poll_done )
+        else :
+            conn.list_vars( device.ups, poll_done )
+
+    #-------------------------------------------------------------------
+    # Compare the polled variables with the previous ones and report changes
+    def __update_device( self, device, new_vars, error ) :
+        with self.__lock :
+            if self.__devices.get( device.device_id ) is not device :
+                # Removed, maybe added again under the same id : the
+                # answer belongs to the old device
+                return
+
+        if error != None :
+            # Only report the transition to the error state. The vars are
+            # forgotten : the first poll after the error reports all of
+            # them, so the front end redraws the whole device.
+            was_failing  = device.error != None
+            device.error = error
+            device.vars  = {}
+            self.__scheduler.failed( device.device_id, time.time() )
+            if not was_failing :
+                self.__notify( device, {}, error )
+            return
+
+        changes     = diff_vars( device.vars, new_vars )
+        device.vars = new_vars
+        self.__scheduler.polled( device.device_id, new_vars, changes, time.time() )
+
+        if device.error != None or len( changes ) > 0 :
+            device.error = None
+            self.__notify( device, changes, None )
+
+    def __notify( self, device, changes, error ) :
+        try :
+            self.__callback( device.device_id, changes, error )
+        except Exception :
+            # A faulty callback must not kill the engine
+            pass
+
+    def run( self ) :
+        while not self.__stop_thread :
+            now = time.time()
+
+            if self.__prune :
+                self.__close_unused()
+
+            with self.__lock :
+                devices = list( self.__devices.values() )
+
+            resolving = False
+            for device in devices :
+                if not device.in_flight and self.__scheduler.is_due( device.device_id, now ) :
+                    if self.__address_ready( device, now ) :
+                        self.__poll( device, now )
+                    else :
+                        resolving = True
+
+            # Devices waiting for their host to be resolved stay due, the
+            # resolver wakes the engine up when it is done
+            next_poll = self.__scheduler.next_poll()
+            if next_poll == None or ( resolving and next_poll <= now ) :
+                next_poll = now + self.__select_timeout
+
+            connections = [ conn for conn in self.__connections.values() if conn.is_open() ]
+            timeout     = max( 0.0, min( self.__select_timeout, next_poll - time.time() ) )
+
+            if len( connections ) == 0 and self.__wakeup == None :
+                time.sleep( timeout )
+                continue
+
+            readers = list( connections )
+            if self.__wakeup != None :
+                readers.append( self.__wakeup[0] )
+
+            writers = [ conn for conn in connections if conn.wants_write() ]
+            try :
+                readable, writable, unused = select.select( readers, writers, [], timeout )
+            except ( select.error, socket.error, ValueError ) :
+                # A socket was closed under our feet, drop closed connections
+                readable, writable = [], []
+
+            if self.__wakeup != None and self.__wakeup[0] in readable :
+                readable.remove( self.__wakeup[0] )
+                try :
+                    self.__wakeup[0].recv( 4096 )
+                except socket.error :
+                    pass
+
+            for conn in writable :
+                if conn.is_open() :
+                    conn.handle_write()
+
+            for conn in readable :
+                if conn.is_open() :
+                    conn.handle_read()
+
+            now = time.time()
+            for conn in connections :
+                if conn.is_open() :
+                    conn.check_timeout( now )
+
+        for conn in self.__connections.values() :
+            conn.close( "Engine stopped" )
+
+        if self.__wakeup != None :
+            for sock in self.__wakeup :
+                sock.close()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# upsmon / upssched events
+#
+# upsmon runs its NOTIFYCMD on each power event, with the event in the
+# NOTIFYTYPE environment variable and the UPS in UPSNAME (upssched passes
+# them on to its CMDSCRIPT). The bundled 'nut-monitor-notify' hook sends
+# them as datagrams to a Unix socket where NUT-Monitor listens : each event
+# makes the front end poll the device at once, instead of waiting for its
+# next poll. Steady devices can then be polled slowly without delaying
+# the display of power events.
+#
+#   upsmon.conf :  NOTIFYCMD "/path/to/nut-monitor-notify --socket /tmp/nut-monitor-events.sock"
+#                  NOTIFYFLAG ONBATT SYSLOG+WALL+EXEC
+#
+# A datagram is "<event> [<ups>]", e.g. "ONBATT myups@localhost".
+#
+#   python -m nutmonitor.events listen --socket PATH
+#   python -m nutmonitor.events send --socket PATH ONBATT myups@localhost
+
+import os
+import os.path
+import socket
+import sys
+import threading
+
+
+# Events forwarded by the hook
+EVENTS      = ( "ONLINE", "ONBATT", "LOWBATT", "FSD", "COMMOK", "COMMBAD", "SHUTDOWN", "REPLBATT", "NOCOMM", "NOPARENT" )
+
+SOCKET_NAME = "events.sock"
+
+
+class event_error( Exception ) :
+    pass
+
+#-----------------------------------------------------------------------
+# Parse a datagram, return ( event, ups ) or None if it is not an event.
+# 'ups' is None when the hook did not know the UPS.
+def parse_event( data ) :
+    if not isinstance( data, str ) :
+        data = data.decode( "utf-8", "replace" )
+
+    tokens = data.split()
+    if len( tokens ) == 0 or tokens[0].upper() not in EVENTS :
+        return( None )
+
+    if len( tokens ) > 1 :
+        return( ( tokens[0].upper(), tokens[1] ) )
+    return( ( tokens[0].upper(), None ) )
+
+#-----------------------------------------------------------------------
+# Split a upsmon UPS name, ups[@host[:port]], into ( ups, host, port )
+def parse_device( name ) :
+    ( ups, host, port ) = ( name, "localhost", 3493 )
+
+    if "@" in name :
+        ( ups, host ) = name.split( "@", 1 )
+        if host.count( ":" ) == 1 :
+            ( host, port ) = host.split( ":" )
+
+    try :
+        port = int( port )
+    except ValueError :
+        port = 3493
+
+    return( ( ups, host.lower(), port ) )
+
+#-----------------------------------------------------------------------
+# Return the devices (ups@host:port names) an event of 'ups_name' is
+# about. upsmon may name the host differently than the front end does
+# (localhost / address...) : when no device matches exactly, the ones
+# with the same UPS name are returned. Without UPS name, all of them.
+def match_devices( ups_name, devices ) :
+    devices = list( devices )
+    if not ups_name :
+        return( devices )
+
+    wanted = parse_device( ups_name )
+    parsed = [ ( device, parse_device( device ) ) for device in devices ]
+
+    exact = [ device for ( device, fields ) in parsed if fields == wanted ]
+    if len( exact ) > 0 :
+        return( exact )
+
+    return( [ device for ( device, fields ) in parsed if fields[0] == wanted[0] ] )
+
+#-----------------------------------------------------------------------
+# Return True if a listener is bound to the socket at 'socket_path'
+def is_listening( socket_path ) :
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+    try :
+        sock.connect( socket_path )
+        return( True )
+    except socket.error :
+        return( False )
+    finally :
+        sock.close()
+
+#-----------------------------------------------------------------------
+# Listener thread : callback( event, ups ) is called from this thread for
+# each event received.
+class event_listener( threading.Thread ) :
+
+    __recv_timeout = 0.5
+
+    def __init__( self, socket_path, callback ) :
+        threading.Thread.__init__( self )
+        self.daemon = True
+
+        self.__socket_path = socket_path
+        self.__callback    = callback
+        self.__socket      = None
+        self.__stop_thread = False
+
+    #-------------------------------------------------------------------
+    # Create the socket. upsmon runs as another user : anybody may send
+    # events, they only trigger polls.
+    def open( self ) :
+        if not hasattr( socket, "AF_UNIX" ) :
+            raise event_error( "Events need Unix sockets" )
+
+        # A socket left by a program which stopped is replaced, not the one
+        # of a running listener (another instance, another user...)
+        if os.path.exists( self.__socket_path ) :
+            if is_listening( self.__socket_path ) :
+                raise event_error( "Another program already listens on '%s'" % self.__socket_path )
+            try :
+                os.remove( self.__socket_path )
+            except OSError as e :
+                raise event_error( "Cannot remove '%s' (%s)" % ( self.__socket_path, e ) )
+
+        self.__socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        old_umask = os.umask( 0o111 )
+        try :
+            self.__socket.bind( self.__socket_path )
+        except socket.error as e :
+            self.__socket.close()
+            self.__socket = None
+            raise event_error( "Cannot listen on '%s' (%s)" % ( self.__socket_path, e ) )
+        finally :
+            os.umask( old_umask )
+
+        self.__socket.settimeout( self.__recv_timeout )
+
+    def stop_thread( self ) :
+        self.__stop_thread = True
+
+    def run( self ) :
+        if self.__socket == None :
+            self.open()
+
+        try :
+            while not self.__stop_thread :
+                try :
+                    data = self.__socket.recv( 1024 )
+                except socket.timeout :
+                    continue
+                except socket.error :
+                    break
+
+                event = parse_event( data )
+                if event == None :
+                    continue
+
+                try :
+                    self.__callback( *event )
+                except Exception :
+                    # A faulty callback must not stop the listener
+                    pass
+        finally :
+            self.__socket.close()
+            if os.path.exists( self.__socket_path ) :
+                os.remove( self.__socket_path )
+
+#-----------------------------------------------------------------------
+# Send an event to a listener
+def send_event( socket_path, event, ups=None ) :
+    data = event.upper()
+    if ups :
+        data += " " + ups
+
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+    try :
+        sock.sendto( data.encode( "utf-8" ), socket_path )
+    finally :
+        sock.close()
+
+def default_socket_path() :
+    from nutmonitor import favorites
+    return( os.path.join( favorites.get_config_path(), SOCKET_NAME ) )
+
+def main( args=None ) :
+    import optparse
+
+    opt_parser = optparse.OptionParser( usage="python -m nutmonitor.events [--socket PATH] [--ups UPS] listen | send [EVENT] [MESSAGE...]" )
+    opt_parser.add_option( "--socket", default=None, help="Socket of the listener (default: %s in the configuration folder)" % SOCKET_NAME )
+    opt_parser.add_option( "--ups", default=None, help="UPS of the event (default: $UPSNAME)" )
+
+    ( opts, args ) = opt_parser.parse_args( args )
+    if len( args ) == 0 or args[0] not in ( "listen", "send" ) :
+        opt_parser.error( "listen or send expected" )
+
+    socket_path = opts.socket or default_socket_path()
+
+    if args[0] == "listen" :
+        def show( event, ups ) :
+            print( "%s %s" % ( event, ups or "" ) )
+            sys.stdout.flush()
+
+        listener = event_listener( socket_path, show )
+        try :
+            listener.open()
+            listener.run()
+        except event_error as e :
+            print( e )
+            return( 1 )
+        except KeyboardInterrupt :
+            pass
+        return( 0 )
+
+    # upsmon gives the event in NOTIFYTYPE, and its message as argument ;
+    # upssched gives the timer name, which may be named after the event
+    event = os.environ.get( "NOTIFYTYPE" )
+    for arg in args[1:] :
+        if event == None and arg.upper() in EVENTS :
+            event = arg.upper()
+    if event == None or event.upper() not in EVENTS :
+        opt_parser.error( "no event given (NOTIFYTYPE is not set)" )
+
+    try :
+        send_event( socket_path, event, opts.ups or os.environ.get( "UPSNAME" ) )
+    except socket.error as e :
+        # Nobody listening : not an error for upsmon
+        sys.stderr.write( "Cannot send the event to '%s' (%s)\n" % ( socket_path, e ) )
+    return( 0 )
+
+if __name__ == "__main__" :
+    sys.exit( main() )
@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+
+# Fake upsd server, for development and benchmarks
+#
+# Speaks the NUT network protocol (LIST UPS / VAR / RW / CMD, GET VAR,
+# GET UPSDESC / CMDDESC, SET VAR, INSTCMD, USERNAME, PASSWORD, LOGIN,
+# LOGOUT, VER) for any number of simulated devices. Each device can play
+# a power event scenario, and the server can delay or drop its answers
+# to simulate slow or lossy links.
+#
+# It runs in a single thread multiplexing all the clients with select(),
+# either in the background of a program (start() / stop()) or standalone :
+#
+#   python -m nutmonitor.fakeupsd --port 3493 --devices 200 --scenario outage
+
+import socket
+import select
+import threading
+import random
+import errno
+import time
+import optparse
+
+from nutmonitor import protocol
+
+
+# Python 2 sockets use str, Python 3 sockets use bytes
+if bytes is str :
+    def _decode( data ) :
+        return( data )
+
+    def _encode( text ) :
+        return( text )
+else :
+    def _decode( data ) :
+        return( data.decode( "utf-8", "replace" ) )
+
+    def _encode( text ) :
+        return( text.encode( "utf-8" ) )
+
+
+#-----------------------------------------------------------------------
+# Power event scenarios : lists of ( seconds from the start, function
+# applied to the device ). Scenarios loop once their last step is played.
+def _set_status( status ) :
+    def apply( device ) :
+        device.set_var( "ups.status", status )
+    return( apply )
+
+def _discharge( charge, runtime ) :
+    def apply( device ) :
+        device.set_var( "battery.charge", str( charge ) )
+        device.set_var( "battery.runtime", str( runtime ) )
+    return( apply )
+
+SCENARIOS = {
+    "steady"   : [],
+
+    # Mains failure : on battery, battery running down, low battery, back
+    "outage"   : [ ( 0,  _set_status( "OL" ) ),
+                   ( 10, _set_status( "OB DISCHRG" ) ),
+                   ( 15, _discharge( 80, 1200 ) ),
+                   ( 20, _discharge( 60, 900 ) ),
+                   ( 25, _discharge( 40, 600 ) ),
+                   ( 30, _discharge( 20, 300 ) ),
+                   ( 30, _set_status( "OB DISCHRG LB" ) ),
+                   ( 35, _set_status( "OL CHRG" ) ),
+                   ( 40, _discharge( 60, 900 ) ),
+                   ( 50, _discharge( 100, 1800 ) ),
+                   ( 50, _set_status( "OL" ) ),
+                   ( 60, None ) ],
+
+    # Unstable mains switching between line and battery
+    "flapping" : [ ( 0, _set_status( "OL" ) ),
+                   ( 2, _set_status( "OB DISCHRG" ) ),
+                   ( 4, None ) ],
+
+    # Battery to replace
+    "replace"  : [ ( 0,  _set_status( "OL" ) ),
+                   ( 20, _set_status( "OL RB" ) ),
+                   ( 40, None ) ]
+}
+
+#-----------------------------------------------------------------------
+# A simulated UPS
+class fake_ups :
+
+    def __init__( self, name, description="Fake UPS", extra_vars=0 ) :
+        self.name        = name
+        self.description = description
+        self.vars        = { "ups.status"      : "OL",
+                             "ups.mfr"         : "NUT-Monitor",
+                             "ups.model"       : "Fake UPS 1500",
+                             "ups.load"        : "25",
+                             "ups.temperature" : "30.5",
+                             "ups.serial"      : "FAKE%s" % name,
+                             "ups.firmware"    : "1.0",
+                             "ups.beeper.status" : "enabled",
+                             "battery.charge"  : "100",
+                             "battery.charge.low" : "20",
+                             "battery.runtime" : "1800",
+                             "battery.runtime.low" : "120",
+                             "battery.voltage" : "27.2",
+                             "battery.type"    : "PbAc",
+                             "input.voltage"   : "230.0",
+                             "input.frequency" : "50.0",
+                             "output.voltage"  : "230.0",
+                             "driver.name"     : "dummy-ups",
+                             "driver.version"  : "2.7.4",
+                             "device.type"     : "ups" }
+        self.rw          = { "battery.charge.low" : "Remaining battery level when UPS switches to LB (percent)",
+                             "battery.runtime.low" : "Remaining battery runtime when UPS switches to LB (seconds)",
+                             "ups.beeper.status" : "UPS beeper status" }
+        self.commands    = { "beeper.disable"     : "Disable the UPS beeper",
+                             "beeper.enable"      : "Enable the UPS beeper",
+                             "test.battery.start" : "Start a battery test",
+                             "test.battery.stop"  : "Stop the battery test" }
+
+        # Some drivers report 100-200 vars
+        for i in range( extra_vars ) :
+            self.vars[ "driver.parameter.extra%03d" % i ] = str( i )
+
+        self.scenario    = []
+        self.offset      = 0.0
+        self.step        = 0
+        self.loop_start  = None
+        self.last_change = None
+
+    def set_var( self, name, value ) :
+        if self.vars.get( name ) != value :
+            self.vars[ name ] = value
+            self.last_change  = time.time()
+
+    #-------------------------------------------------------------------
+    # Play the scenario steps due at 'now'
+    def play( self, now ) :
+        if len( self.scenario ) == 0 :
+            return
+
+        if self.loop_start == None :
+            self.loop_start = now - self.offset
+
+        while True :
+            ( at, action ) = self.scenario[ self.step ]
+            if now - self.loop_start < at :
+                return
+
+            if action == None :
+                # End of the scenario, loop
+                self.loop_start += at
+                self.step        = 0
+                continue
+
+            action( self )
+            self.step += 1
+            if self.step >= len( self.scenario ) :
+                self.loop_start = now
+                self.step       = 0
+                return
+
+#-----------------------------------------------------------------------
+# Create 'count' devices named prefix001, prefix002... playing 'scenario'.
+# The scenarios of the devices are shifted by 'spread' seconds at most,
+# so that they do not all change state at the same time.
+def make_devices( count, scenario="steady", prefix="ups", extra_vars=0, spread=0.0, seed=None ) :
+    rng     = random.Random( seed )
+    devices = []
+    for i in range( count ) :
+        device = fake_ups( "%s%03d" % ( prefix, i + 1 ), "Fake UPS #%d" % ( i + 1 ), extra_vars )
+        device.scenario = SCENARIOS[ scenario ]
+        device.offset   = rng.uniform( 0, spread )
+        devices.append( device )
+
+    return( devices )
+
+#-----------------------------------------------------------------------
+# Connected client
+class _client :
+
+    def __init__( self, sock ) :
+        self.sock       = sock
+        self.in_buffer  = b""
+        self.out_buffer = b""
+        self.replies    = []
+        self.login     = None
+        self.password  = None
+        self.closing   = False
+
+#-----------------------------------------------------------------------
+# The server
+class fake_upsd :
+
+    def __init__( self, devices, host="127.0.0.1", port=0, latency=0.0, loss=0.0, login=None, password=None, seed=None ) :
+        self.__devices     = dict( ( device.name, device ) for device in devices )
+        self.__latency     = latency
+        self.__loss        = loss
+        self.__login       = login
+        self.__password    = password
+        self.__random      = random.Random( seed )
+        self.__clients     = {}
+        self.__lock        = threading.Lock()
+        self.__thread      = None
+        self.__stop_thread = False
+        self.__stats       = { "connections" : 0, "requests" : 0, "bytes_sent" : 0, "dropped" : 0 }
+
+        self.__socket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.__socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self.__socket.bind( ( host, port ) )
+        self.__socket.listen( 128 )
+        self.__socket.setblocking( False )
+
+    def get_port( self ) :
+        return( self.__socket.getsockname()[1] )
+
+    def get_device( self, name ) :
+        return( self.__devices[ name ] )
+
+    def get_devices( self ) :
+        return( list( self.__devices.values() ) )
+
+    #-------------------------------------------------------------------
+    # Counters : connections, requests, bytes_sent, dropped answers
+    def stats( self ) :
+        with self.__lock :
+            return( dict( self.__stats ) )
+
+    def reset_stats( self ) :
+        with self.__lock :
+            for k in self.__stats :
+                self.__stats[k] = 0
+
+    #-------------------------------------------------------------------
+    # Change a variable of a device from another thread. Returns the time
+    # of the change, to measure how long the clients take to notice it.
+    def set_var( self, name, var, value ) :
+        with self.__lock :
+            self.__devices[ name ].set_var( var, value )
+            return( self.__devices[ name ].last_change )
+
+    #-------------------------------------------------------------------
+    # Serve in a background thread
+    def start( self ) :
+        self.__thread = threading.Thread( target=self.serve_forever )
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop( self ) :
+        self.__stop_thread = True
+        if self.__thread != None :
+            self.__thread.join()
+
+    def serve_forever( self ) :
+        try :
+            while not self.__stop_thread :
+                self.__loop_once()
+        finally :
+            for client in list( self.__clients.values() ) :
+                client.sock.close()
+            self.__clients = {}
+            self.__socket.close()
+
+    def __loop_once( self ) :
+        now = time.time()
+        with self.__lock :
+            for device in self.__devices.values() :
+                device.play( now )
+
+        # Send the answers whose latency is over. All the answers ready
+        # for a client go out in a single write : pipelined requests are
+        # answered as one packet, as upsd does.
+        timeout = 0.05
+        for client in list( self.__clients.values() ) :
+            ready = []
+            while len( client.replies ) > 0 and client.replies[0][0] <= now :
+                ready.append( client.replies.pop( 0 )[1] )
+            if len( ready ) > 0 :
+                client.out_buffer += b"".join( ready )
+                self.__send( client )
+            if len( client.replies ) > 0 :
+                timeout = min( timeout, client.replies[0][0] - now )
+            if client.closing and len( client.replies ) == 0 and len( client.out_buffer ) == 0 :
+                self.__drop( client )
+
+        sockets  = [ self.__socket ] + [ client.sock for client in self.__clients.values() ]
+        writable = [ client.sock for client in self.__clients.values() if len( client.out_buffer ) > 0 ]
+        try :
+            ( readable, writable, unused ) = select.select( sockets, writable, [], max( 0.0, timeout ) )
+        except ( select.error, socket.error, ValueError ) :
+            return
+
+        for sock in writable :
+            if sock in self.__clients :
+                self.__send( self.__clients[ sock ] )
+
+        for sock in readable :
+            if sock is self.__socket :
+                self.__accept()
+            elif sock in self.__clients :
+                self.__read( self.__clients[ sock ] )
+
+    def __accept( self ) :
+        try :
+            ( sock, address ) = self.__socket.accept()
+        except socket.error :
+            return
+
+        # A slow client must not stall the others : answers it does not
+        # read yet wait in its buffer
+        sock.setblocking( False )
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        self.__clients[ sock ] = _client( sock )
+        with self.__lock :
+            self.__stats["connections"] += 1
+
+    def __drop( self, client ) :
+        self.__clients.pop( client.sock, None )
+        try :
+            client.sock.close()
+        except socket.error :
+            pass
+
+    #-------------------------------------------------------------------
+    # Send what the socket accepts of the buffered answers, the rest is
+    # sent once it is writable again
+    def __send( self, client ) :
+        try :
+            sent = client.sock.send( client.out_buffer )
+        except socket.error as e :
+            if e.args[0] not in ( errno.EAGAIN, errno.EWOULDBLOCK ) :
+                self.__drop( client )
+            return
+
+        client.out_buffer = client.out_buffer[sent:]
+        with self.__lock :
+            self.__stats["bytes_sent"] += sent
+
+    def __read( self, client ) :
+        try :
+            data = client.sock.recv( 65536 )
+        except socket.error as e :
+            if e.args[0] not in ( errno.EAGAIN, errno.EWOULDBLOCK ) :
+                self.__drop( client )
+            return
+
+        if not data :
+            self.__drop( client )
+            return
+
+        client.in_buffer += data
+        while not client.closing :
+            offset = client.in_buffer.find( b"\n" )
+            if offset == -1 :
+                break
+
+            line             = _decode( client.in_buffer[:offset] ).rstrip( "\r" )
+            client.in_buffer = client.in_buffer[offset+1:]
+
+            with self.__lock :
+                self.__stats["requests"] += 1
+                answer = self.__answer( client, protocol.split_line( line ) )
+
+            if self.__loss > 0 and self.__random.random() < self.__loss :
+                # Lost answer : the client has to time out
+                with self.__lock :
+                    self.__stats["dropped"] += 1
+                continue
+
+            client.replies.append( ( time.time() + self.__latency, _encode( answer ) ) )
+
+    #-------------------------------------------------------------------
+    # Build the answer to a command
+    def __answer( self, client, tokens ) :
+        if len( tokens ) == 0 :
+            return( "ERR UNKNOWN-COMMAND\n" )
+
+        command = tokens[0].upper()
+        args    = tokens[1:]
+
+        if command == "LIST" and len( args ) >= 1 :
+            return( self.__answer_list( args ) )
+
+        if command == "GET" and len( args ) >= 3 :
+            device = self.__devices.get( args[1] )
+            if device == None :
+                return( "ERR UNKNOWN-UPS\n" )
+
+            if args[0] == "VAR" :
+                if args[2] not in device.vars :
+                    return( "ERR VAR-NOT-SUPPORTED\n" )
+                return( "VAR %s %s %s\n" % ( device.name, args[2], protocol.quote( device.vars[ args[2] ] ) ) )
+
+            if args[0] == "CMDDESC" :
+                return( "CMDDESC %s %s %s\n" % ( device.name, args[2], protocol.quote( device.commands.get( args[2], "Unavailable" ) ) ) )
+
+            if args[0] == "DESC" :
+                return( "DESC %s %s %s\n" % ( device.name, args[2], protocol.quote( device.rw.get( args[2], "Description unavailable" ) ) ) )
+
+            return( "ERR INVALID-ARGUMENT\n" )
+
+        if command == "GET" and len( args ) == 2 and args[0] == "UPSDESC" :
+            device = self.__devices.get( args[1] )
+            if device == None :
+                return( "ERR UNKNOWN-UPS\n" )
+            return( "UPSDESC %s %s\n" % ( device.name, protocol.quote( device.description ) ) )
+
+        if command == "USERNAME" and len( args ) == 1 :
+            client.login = args[0]
+            return( "OK\n" )
+
+        if command == "PASSWORD" and len( args ) == 1 :
+            client.password = args[0]
+            return( "OK\n" )
+
+        if command in ( "SET", "INSTCMD", "LOGIN" ) :
+            if not self.__authenticated( client ) :
+                if client.login == None :
+                    return( "ERR USERNAME-REQUIRED\n" )
+                return( "ERR ACCESS-DENIED\n" )
+
+        if command == "SET" and len( args ) == 4 and args[0] == "VAR" :
+            device = self.__devices.get( args[1] )
+            if device == None :
+                return( "ERR UNKNOWN-UPS\n" )
+            if args[2] not in device.vars :
+                return( "ERR VAR-NOT-SUPPORTED\n" )
+            if args[2] not in device.rw :
+                return( "ERR READONLY\n" )
+            device.set_var( args[2], args[3] )
+            return( "OK\n" )
+
+        if command == "INSTCMD" and len( args ) == 2 :
+            device = self.__devices.get( args[0] )
+            if device == None :
+                return( "ERR UNKNOWN-UPS\n" )
+            if args[1] not in device.commands :
+                return( "ERR CMD-NOT-SUPPORTED\n" )
+            return( "OK\n" )
+
+        if command == "LOGIN" and len( args ) == 1 :
+            if args[0] not in self.__devices :
+                return( "ERR UNKNOWN-UPS\n" )
+            return( "OK\n" )
+
+        if command == "LOGOUT" :
+            client.closing = True
+            return( "OK Goodbye\n" )
+
+        if command == "VER" :
+            return( "Network UPS Tools upsd 2.7.4 - http://www.networkupstools.org/ (NUT-Monitor fake upsd)\n" )
+
+        return( "ERR UNKNOWN-COMMAND\n" )
+
+    def __answer_list( self, args ) :
+        kind = args[0].upper()
+
+        if kind == "UPS" :
+            rows = [ "UPS %s %s" % ( name, protocol.quote( device.description ) ) for ( name, device ) in sorted( self.__devices.items() ) ]
+            return( self.__list_block( "UPS", rows ) )
+
+        if len( args ) < 2 :
+            return( "ERR INVALID-ARGUMENT\n" )
+
+        device = self.__devices.get( args[1] )
+        if device == None :
+            return( "ERR UNKNOWN-UPS\n" )
+
+        if kind == "VAR" :
+            rows = [ "VAR %s %s %s" % ( device.name, k, protocol.quote( v ) ) for ( k, v ) in sorted( device.vars.items() ) ]
+        elif kind == "RW" :
+            rows = [ "RW %s %s %s" % ( device.name, k, protocol.quote( device.vars.get( k, "" ) ) ) for k in sorted( device.rw ) ]
+        elif kind == "CMD" :
+            rows = [ "CMD %s %s" % ( device.name, k ) for k in sorted( device.commands ) ]
+        else :
+            return( "ERR INVALID-ARGUMENT\n" )
+
+        return( self.__list_block( "%s %s" % ( kind, device.name ), rows ) )
+
+    def __list_block( self, name, rows ) :
+        return( "BEGIN LIST %s\n%s\nEND LIST %s\n" % ( name, "\n".join( rows ), name ) if len( rows ) > 0 else "BEGIN LIST %s\nEND LIST %s\n" % ( name, name ) )
+
+    def __authenticated( self, client ) :
+        if self.__login == None :
+            return( client.login != None )
+        return( client.login == self.__login and client.password == self.__password )
+
+#-----------------------------------------------------------------------
+# Standalone server
+def main() :
+    opt_parser = optparse.OptionParser( usage="python -m nutmonitor.fakeupsd [options]" )
+    opt_parser.add_option( "--host", default="127.0.0.1", help="Address to listen on (default: %default)" )
+    opt_parser.add_option( "--port", type="int", default=3493, help="Port to listen on (default: %default)" )
+    opt_parser.add_option( "--devices", type="int", default=1, help="Number of simulated UPSes (default: %default)" )
+    opt_parser.add_option( "--scenario", default="steady", choices=sorted( SCENARIOS.keys() ), help="Power event scenario: %s (default: %%default)" % ", ".join( sorted( SCENARIOS.keys() ) ) )
+    opt_parser.add_option( "--spread", type="float", default=0.0, help="Shift the scenario of each device by up to this many seconds" )
+    opt_parser.add_option( "--extra-vars", type="int", default=0, dest="extra_vars", help="Additional variables per device" )
+    opt_parser.add_option( "--latency", type="float", default=0.0, help="Delay of each answer, in seconds" )
+    opt_parser.add_option( "--loss", type="float", default=0.0, help="Probability of dropping an answer (0-1)" )
+    opt_parser.add_option( "--login", default=None, help="Login required for SET, INSTCMD and LOGIN (default: any login)" )
+    opt_parser.add_option( "--password", default=None, help="Password going with --login" )
+
+    ( opts, args ) = opt_parser.parse_args()
+
+    devices = make_devices( opts.devices, opts.scenario, extra_vars=opts.extra_vars, spread=opts.spread )
+    server  = fake_upsd( devices, opts.host, opts.port, opts.latency, opts.loss, opts.login, opts.password )
+    print( "Fake upsd serving %d devices on %s:%d" % ( len( devices ), opts.host, server.get_port() ) )
+
+    try :
+        server.serve_forever()
+    except KeyboardInterrupt :
+        pass
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+
+# Favorites file (favorites.ini) handling, shared by the GUI and the daemon
+#
+# favorites_store keeps the favorites indexed by name, by group (site, or
+# host when no site is given) and by device, and writes favorites.ini
+# atomically : the new file is written aside and renamed over the old one,
+# so a crash never leaves a truncated file. Favorites can be imported from
+# and exported to CSV or JSON, e.g. from an inventory :
+#
+#   python -m nutmonitor.favorites import inventory.csv
+#   python -m nutmonitor.favorites export favorites.json
+#
+# CSV files have a header line with the columns name, group, host, port,
+# ups, login and password. JSON files hold a list of objects with the same
+# keys. Only host and ups are mandatory.
+
+import os
+import os.path
+import sys
+import platform
+import base64
+import bisect
+import tempfile
+from gettext import gettext as _
+
+try :
+    import ConfigParser as configparser
+except ImportError :
+    import configparser
+
+try :
+    from StringIO import StringIO
+except ImportError :
+    from io import StringIO
+
+
+# Columns of the CSV files, keys of the JSON objects
+RECORD_FIELDS = ( "name", "group", "host", "port", "ups", "login", "password" )
+
+
+#-----------------------------------------------------------------------
+# Return the directory holding the favorites and the other user files
+def get_config_path() :
+    if ( platform.system() == "Windows" ) :
+        return( os.path.join( os.environ.get("USERPROFILE"), "Application Data", "NUT-Monitor" ) )
+
+    return( os.path.join( os.environ.get("HOME"), ".nut-monitor" ) )
+
+#-----------------------------------------------------------------------
+# Decode a base64 password into a native string
+def decode_password( value ) :
+    password = base64.b64decode( value )
+    if not isinstance( password, str ) :
+        password = password.decode( "utf-8" )
+    return( password )
+
+#-----------------------------------------------------------------------
+# Encode a password in base64, as stored in favorites.ini
+def encode_password( value ) :
+    if not isinstance( value, bytes ) :
+        value = value.encode( "utf-8" )
+
+    encoded = base64.b64encode( value )
+    if not isinstance( encoded, str ) :
+        encoded = encoded.decode( "ascii" )
+    return( encoded )
+
+#-----------------------------------------------------------------------
+# Load favorites from an ini file. Returns a dict of favorites, each one
+# being a dict with host, port, ups, auth and optionally login/password
+# and group.
+def load( filename ) :
+    favorites = {}
+
+    if ( not os.path.exists( filename ) ) :
+        # There is no favorites files, do nothing
+        return( favorites )
+
+    sections = _read_ini( filename )
+    for current in sections :
+        options = sections[ current ]
+
+        # Check if mandatory fields are present
+        if ( "host" in options and "ups" in options ) :
+            # Valid entry found, add it to the list
+            fav_data = {}
+            fav_data["host"] = options["host"]
+            fav_data["ups"]  = options["ups"]
+            fav_data["port"] = options.get( "port", "3493" )
+
+            if ( "group" in options ) :
+                fav_data["group"] = options["group"]
+
+            # If auth is defined the section must have login and pass defined
+            if ( "auth" in options ) :
+                if ( "login" in options and "password" in options ) :
+                    # Add the entry
+                    fav_data["auth"]     = options["auth"].lower() in ( "1", "yes", "true", "on" )
+                    fav_data["login"]    = options["login"]
+
+                    try :
+                        fav_data["password"] = decode_password( options["password"] )
+
+                    except Exception :
+                        # If the password is not in base64, let the field empty
+                        print( _("Error parsing favorites, password for '%s' is not in base64\nSkipping password for this entry") % current )
+                        fav_data["password"] = ""
+            else :
+                fav_data["auth"] = False
+
+            favorites[current] = fav_data
+
+    return( favorites )
+
+#-----------------------------------------------------------------------
+# Parse an ini file into { section : { option : value } }, the way
+# ConfigParser does without interpolation (passwords may contain '%') :
+# option names are lower case, '#' and ';' start comments, indented lines
+# continue the previous value. ConfigParser takes tens of milliseconds
+# for a thousand favorites, this takes a few.
+def _read_ini( filename ) :
+    sections = {}
+    options  = None
+    option   = None
+
+    with open( filename ) as fh :
+        for line in fh :
+            if line.strip() == "" or line[0] in "#;" :
+                continue
+
+            if line[0] in " \t" :
+                # Continuation of the previous value
+                if option != None :
+                    options[ option ] += "\n" + line.strip()
+                continue
+
+            line = line.rstrip()
+            if line[0] == "[" and line.endswith( "]" ) :
+                options = sections.setdefault( line[1:-1], {} )
+                option  = None
+                continue
+
+            if options == None :
+                continue
+
+            # 'option = value' or 'option: value', whichever comes first
+            index = line.find( "=" )
+            colon = line.find( ":" )
+            if colon >= 0 and ( index < 0 or colon < index ) :
+                index = colon
+            elif index < 0 :
+                index = len( line )
+
+            option = line[:index].strip().lower()
+            options[ option ] = line[index+1:].strip()
+
+    return( sections )
+
+#-----------------------------------------------------------------------
+# Name under which a favorite's device is known : ups@host:port
+def device_name( fav_data ) :
+    return( "%s@%s:%s" % ( fav_data.get("ups",""), fav_data.get("host",""), fav_data.get("port","3493") ) )
+
+#-----------------------------------------------------------------------
+# Return ( login, password ) of a favorite, None if not authenticated
+def credentials( fav_data ) :
+    if fav_data.get( "auth", False ) :
+        return( ( fav_data.get( "login" ), fav_data.get( "password" ) ) )
+    return( ( None, None ) )
+
+#-----------------------------------------------------------------------
+# Group of a favorite in menus : its site if given, its host otherwise
+def group_of( fav_data ) :
+    return( fav_data.get( "group" ) or fav_data.get( "host", "" ) )
+
+#-----------------------------------------------------------------------
+# Write a file atomically : readers see the old file or the whole new one.
+# The file is only readable by the user, it may hold passwords.
+def atomic_write( filename, data ) :
+    if not isinstance( data, bytes ) :
+        data = data.encode( "utf-8" )
+
+    directory = os.path.dirname( os.path.abspath( filename ) )
+    ( fd, temp_name ) = tempfile.mkstemp( prefix=".%s." % os.path.basename( filename ), dir=directory )
+    try :
+        fh = os.fdopen( fd, "wb" )
+        try :
+            fh.write( data )
+            fh.flush()
+            os.fsync( fh.fileno() )
+        finally :
+            fh.close()
+
+        # rename() does not replace an existing file on Windows
+        if ( os.name == "nt" ) and os.path.exists( filename ) :
+            os.remove( filename )
+        os.rename( temp_name, filename )
+
+    except :
+        if os.path.exists( temp_name ) :
+            os.remove( temp_name )
+        raise
+
+#-----------------------------------------------------------------------
+# Read the records of a CSV or JSON file (chosen from the extension)
+def read_records( filename ) :
+    if filename.lower().endswith( ".json" ) :
+        import json
+
+        with open( filename ) as fh :
+            records = json.load( fh )
+
+        # { name : record } is accepted as well
+        if isinstance( records, dict ) :
+            records = [ dict( record, name=name ) for ( name, record ) in records.items() ]
+        return( records )
+
+    import csv
+
+    if sys.version_info[0] < 3 :
+        fh = open( filename, "rb" )
+    else :
+        fh = open( filename, newline="", encoding="utf-8" )
+
+    with fh :
+        return( list( csv.DictReader( fh ) ) )
+
+#-----------------------------------------------------------------------
+# Write records to a CSV or JSON file (chosen from the extension)
+def write_records( filename, records ) :
+    if filename.lower().endswith( ".json" ) :
+        import json
+        atomic_write( filename, json.dumps( records, indent=2, sort_keys=True ) + "\n" )
+        return
+
+    import csv
+
+    text   = StringIO()
+    writer = csv.DictWriter( text, RECORD_FIELDS, extrasaction="ignore", lineterminator="\n" )
+    writer.writerow( dict( ( field, field ) for field in RECORD_FIELDS ) )
+    writer.writerows( records )
+    atomic_write( filename, text.getvalue() )
+
+#-----------------------------------------------------------------------
+# Native string of a value read from a file (unicode from JSON on Python 2)
+def _native( value ) :
+    if isinstance( value, str ) :
+        return( value.strip() )
+    if sys.version_info[0] < 3 and isinstance( value, unicode ) :
+        return( value.encode( "utf-8" ).strip() )
+    return( str( value ).strip() )
+
+#-----------------------------------------------------------------------
+# Remove an item from a sorted list
+def _sorted_remove( items, item ) :
+    index = bisect.bisect_left( items, item )
+    if index < len( items ) and items[ index ] == item :
+        del items[ index ]
+    else :
+        # Not sorted yet (bulk change in progress)
+        items.remove( item )
+
+#-----------------------------------------------------------------------
+# Build a favorite from an imported record, None if it is not valid
+def _from_record( record ) :
+    fields = {}
+    for key in RECORD_FIELDS :
+        if record.get( key ) != None :
+            fields[ key ] = _native( record[ key ] )
+
+    if not fields.get( "host" ) or not fields.get( "ups" ) :
+        return( None )
+
+    port = fields.get( "port" ) or "3493"
+    if not port.isdigit() :
+        return( None )
+
+    fav_data = { "host" : fields["host"], "ups" : fields["ups"], "port" : port, "auth" : False }
+    if fields.get( "group" ) :
+        fav_data["group"] = fields["group"]
+    if fields.get( "login" ) :
+        fav_data["auth"]     = True
+        fav_data["login"]    = fields["login"]
+        fav_data["password"] = fields.get( "password", "" )
+
+    return( fav_data )
+
+
+#-----------------------------------------------------------------------
+# The favorites of the user, indexed by name, group and device. Listeners
+# are called with ( name, old, new ) after each change : old is None for
+# an added favorite, new is None for a removed one. They are called with
+# ( None, None, None ) when everything changed (load, import).
+class favorites_store :
+
+    def __init__( self, filename ) :
+        self.__filename  = filename
+        self.__listeners = []
+        self.__clear()
+
+    def __clear( self ) :
+        self.__favorites = {}
+        self.__names     = []
+        self.__groups    = {}
+        self.__devices   = {}
+        self.__search    = {}
+
+    def get_filename( self ) :
+        return( self.__filename )
+
+    def add_listener( self, listener ) :
+        self.__listeners.append( listener )
+
+    def __notify( self, name, old, new ) :
+        for listener in self.__listeners :
+            listener( name, old, new )
+
+    #-------------------------------------------------------------------
+    # Index a favorite. The sorted lists are only kept sorted if 'sort' is
+    # set, bulk changes sort them once at the end.
+    def __insert( self, name, fav_data, sort=True ) :
+        self.__favorites[ name ] = fav_data
+        self.__devices[ device_name( fav_data ) ] = name
+        self.__search[ name ]    = "\n".join( ( name, group_of( fav_data ), fav_data.get( "host", "" ), fav_data.get( "ups", "" ) ) ).lower()
+
+        names = self.__groups.setdefault( group_of( fav_data ), [] )
+        if sort :
+            bisect.insort( self.__names, name )
+            bisect.insort( names, name )
+        else :
+            self.__names.append( name )
+            names.append( name )
+
+    def __remove( self, name ) :
+        fav_data = self.__favorites.pop( name )
+        del self.__search[ name ]
+        if self.__devices.get( device_name( fav_data ) ) == name :
+            del self.__devices[ device_name( fav_data ) ]
+
+        _sorted_remove( self.__names, name )
+
+        group = group_of( fav_data )
+        names = self.__groups[ group ]
+        _sorted_remove( names, name )
+        if len( names ) == 0 :
+            del self.__groups[ group ]
+
+        return( fav_data )
+
+    def __sort( self ) :
+        self.__names.sort()
+        for names in self.__groups.values() :
+            names.sort()
+
+    #-------------------------------------------------------------------
+    # (Re)load the favorites file
+    def load( self ) :
+        favorites = load( self.__filename )
+
+        self.__clear()
+        for ( name, fav_data ) in favorites.items() :
+            self.__insert( name, fav_data, sort=False )
+        self.__sort()
+
+        self.__notify( None, None, None )
+
+    #-------------------------------------------------------------------
+    # Write the favorites file, atomically
+    def save( self ) :
+        conf = configparser.RawConfigParser()
+        for name in self.__names :
+            fav_data = self.__favorites[ name ]
+            conf.add_section( name )
+            conf.set( name, "host", fav_data.get( "host", "" ) )
+            conf.set( name, "port", fav_data.get( "port", "3493" ) )
+            conf.set( name, "ups", fav_data.get( "ups", "" ) )
+            if fav_data.get( "group" ) :
+                conf.set( name, "group", fav_data["group"] )
+
+            conf.set( name, "auth", str( bool( fav_data.get( "auth", False ) ) ) )
+            if fav_data.get( "auth", False ) :
+                conf.set( name, "login", fav_data.get( "login", "" ) )
+                conf.set( name, "password", encode_password( fav_data.get( "password", "" ) ) )
+
+        text = StringIO()
+        conf.write( text )
+        atomic_write( self.__filename, text.getvalue() )
+
+    def __len__( self ) :
+        return( len( self.__favorites ) )
+
+    def __contains__( self, name ) :
+        return( name in self.__favorites )
+
+    def __getitem__( self, name ) :
+        return( self.__favorites[ name ] )
+
+    def get( self, name, default=None ) :
+        return( self.__favorites.get( name, default ) )
+
+    #-------------------------------------------------------------------
+    # Sorted names of all the favorites, or of the favorites of a group
+    def names( self, group=None ) :
+        if group != None :
+            return( list( self.__groups.get( group, [] ) ) )
+        return( list( self.__names ) )
+
+    #-------------------------------------------------------------------
+    # Sorted names of the groups
+    def groups( self ) :
+        return( sorted( self.__groups.keys() ) )
+
+    def has_group( self, group ) :
+        return( group in self.__groups )
+
+    #-------------------------------------------------------------------
+    # Name of the favorite of a device (ups@host:port), None if none
+    def find_device( self, device ) :
+        return( self.__devices.get( device ) )
+
+    #-------------------------------------------------------------------
+    # Sorted names of the favorites whose name, group, host or UPS name
+    # contain 'text', case insensitive. At most 'limit' names if given.
+    def search( self, text, limit=None ) :
+        text    = text.lower()
+        matches = []
+        for name in self.__names :
+            if text in self.__search[ name ] :
+                matches.append( name )
+                if limit != None and len( matches ) >= limit :
+                    break
+
+        return( matches )
+
+    #-------------------------------------------------------------------
+    # Add a favorite, or replace the one with the same name
+    def set( self, name, fav_data ) :
+        old = None
+        if name in self.__favorites :
+            old = self.__remove( name )
+
+        self.__insert( name, fav_data )
+        self.__notify( name, old, fav_data )
+
+    def remove( self, name ) :
+        old = self.__remove( name )
+        self.__notify( name, old, None )
+
+    #-------------------------------------------------------------------
+    # Add favorites from records (dicts with the RECORD_FIELDS keys). A
+    # record without name is named after its device. Existing favorites
+    # are only replaced if 'replace' is set. Returns the number of added,
+    # replaced and skipped records.
+    def import_records( self, records, replace=False ) :
+        ( added, replaced, skipped ) = ( 0, 0, 0 )
+
+        for record in records :
+            fav_data = _from_record( record )
+            if fav_data == None :
+                skipped += 1
+                continue
+
+            name = _native( record.get( "name" ) or "" ) or device_name( fav_data )
+            if name in self.__favorites :
+                if not replace :
+                    skipped += 1
+                    continue
+                self.__remove( name )
+                replaced += 1
+            else :
+                added += 1
+
+            self.__insert( name, fav_data, sort=False )
+
+        self.__sort()
+        self.__notify( None, None, None )
+
+        return( ( added, replaced, skipped ) )
+
+    #-------------------------------------------------------------------
+    # Return the favorites as records, passwords left out unless
+    # 'passwords' is set
+    def export_records( self, passwords=False ) :
+        records = []
+        for name in self.__names :
+            fav_data = self.__favorites[ name ]
+            record   = { "name" : name, "group" : fav_data.get( "group", "" ), "host" : fav_data.get( "host", "" ),
+                         "port" : fav_data.get( "port", "3493" ), "ups" : fav_data.get( "ups", "" ), "login" : "" }
+            if fav_data.get( "auth", False ) :
+                record["login"] = fav_data.get( "login", "" )
+                if passwords :
+                    record["password"] = fav_data.get( "password", "" )
+            records.append( record )
+
+        return( records )
+
+    def import_file( self, filename, replace=False ) :
+        return( self.import_records( read_records( filename ), replace ) )
+
+    def export_file( self, filename, passwords=False ) :
+        write_records( filename, self.export_records( passwords ) )
+
+#-----------------------------------------------------------------------
+# Command line tool : import / export / list the favorites
+def main( args=None ) :
+    import optparse
+
+    opt_parser = optparse.OptionParser( usage="python -m nutmonitor.favorites [options] import|export FILE | list [TEXT]" )
+    opt_parser.add_option( "--file", default=None, help="Favorites file (default: favorites.ini in the configuration folder)" )
+    opt_parser.add_option( "--replace", action="store_true", default=False, help="import: replace the favorites with the same name" )
+    opt_parser.add_option( "--passwords", action="store_true", default=False, help="export: include the passwords" )
+
+    ( opts, args ) = opt_parser.parse_args( args )
+    if len( args ) == 0 or args[0] not in ( "import", "export", "list" ) or ( args[0] != "list" and len( args ) != 2 ) :
+        opt_parser.error( "expected import FILE, export FILE or list [TEXT]" )
+
+    if opts.file == None :
+        opts.file = os.path.join( get_config_path(), "favorites.ini" )
+
+    store = favorites_store( opts.file )
+    store.load()
+
+    if args[0] == "import" :
+        ( added, replaced, skipped ) = store.import_file( args[1], opts.replace )
+        if not os.path.exists( os.path.dirname( os.path.abspath( opts.file ) ) ) :
+            os.makedirs( os.path.dirname( os.path.abspath( opts.file ) ), 0o700 )
+        store.save()
+        print( "%d added, %d replaced, %d skipped" % ( added, replaced, skipped ) )
+
+    elif args[0] == "export" :
+        store.export_file( args[1], opts.passwords )
+        print( "%d favorites exported" % len( store ) )
+
+    else :
+        for name in store.search( args[1] if len( args ) > 1 else "" ) :
+            print( "%-30s %s" % ( name, device_name( store[ name ] ) ) )
+
+    return( 0 )
+
+if __name__ == "__main__" :
+    sys.exit( main() )
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Fleet summary
+#
+# Aggregated state of many monitored devices, for a single tray icon : the
+# worst state, how many devices run on battery and the lowest battery
+# runtime. The polling threads feed the changes of each device, the GUI
+# reads the summary. A summary is never modified once built, and is only
+# computed again after a change that matters to it : until then the same
+# object is returned, so the front end redraws the icon and its tooltip
+# only when the summary is a new one.
+
+import threading
+
+from nutmonitor import state as state_mod
+from nutmonitor import status
+
+
+# Device states, from the best to the worst
+ONLINE          = 0
+REPLACE_BATTERY = 1
+UNREACHABLE     = 2
+ON_BATTERY      = 3
+LOW_BATTERY     = 4
+
+STATE_NAMES     = ( "online", "replace_battery", "unreachable", "on_battery", "low_battery" )
+
+
+#-----------------------------------------------------------------------
+# State of a device from its status flags and its polling error
+def device_state( flags, error=None ) :
+    if error != None :
+        return( UNREACHABLE )
+    if flags & ( status.LB | status.FSD ) :
+        return( LOW_BATTERY )
+    if flags & status.OB :
+        return( ON_BATTERY )
+    if flags & status.RB :
+        return( REPLACE_BATTERY )
+    return( ONLINE )
+
+#-----------------------------------------------------------------------
+# Summary of the fleet. 'device' is the device to look at first : the one
+# in the worst state, with the lowest runtime among them. It is None when
+# all the devices are online. 'counts' gives the number of devices in each
+# state, 'waiting' the number of devices which did not report yet : they
+# are counted in 'total' only.
+class fleet_summary( object ) :
+
+    __slots__ = ( "total", "waiting", "state", "device", "counts", "on_battery", "lowest_runtime", "lowest_runtime_device" )
+
+    def __init__( self, devices, waiting=0 ) :
+        self.total                 = len( devices ) + waiting
+        self.waiting               = waiting
+        self.state                 = ONLINE
+        self.device                = None
+        self.on_battery            = 0
+        self.lowest_runtime        = None
+        self.lowest_runtime_device = None
+
+        counts = [ 0 ] * len( STATE_NAMES )
+        worst  = None
+
+        for device_id in sorted( devices ) :
+            ( flags, runtime, error ) = devices[ device_id ]
+            state = device_state( flags, error )
+            counts[ state ] += 1
+
+            if flags & status.OB and error == None :
+                self.on_battery += 1
+
+            if runtime != None and error == None and ( self.lowest_runtime == None or runtime < self.lowest_runtime ) :
+                self.lowest_runtime        = runtime
+                self.lowest_runtime_device = device_id
+
+            # Unknown runtimes come after the known ones
+            if runtime != None and error == None :
+                rank = ( state, -runtime )
+            else :
+                rank = ( state, float( "-inf" ) )
+
+            if state != ONLINE and ( worst == None or rank > worst ) :
+                worst       = rank
+                self.state  = state
+                self.device = device_id
+
+        self.counts = tuple( counts )
+
+#-----------------------------------------------------------------------
+# State of the devices of a fleet. update() can be called from any thread.
+class fleet_status :
+
+    def __init__( self ) :
+        self.__lock    = threading.Lock()
+        self.__devices = {}
+        self.__waiting = set()
+        self.__summary = None
+
+    #-------------------------------------------------------------------
+    # Count a device in the fleet before it reports its state
+    def add_device( self, device_id ) :
+        with self.__lock :
+            if device_id not in self.__devices and device_id not in self.__waiting :
+                self.__waiting.add( device_id )
+                self.__summary = None
+
+    #-------------------------------------------------------------------
+    # Take the changes reported for a device into account (same arguments
+    # as the callback of the polling engine). Return True if the summary
+    # may have changed.
+    def update( self, device_id, changes, error=None ) :
+        with self.__lock :
+            old = self.__devices.get( device_id )
+            ( flags, runtime, unused ) = old or ( 0, None, None )
+
+            if "ups.status" in changes :
+                flags = status.parse( changes["ups.status"] )
+            if "battery.runtime" in changes :
+                runtime = state_mod.parse_number( changes["battery.runtime"], int )
+
+            # Errors are only reported once : any report without error
+            # means the device answers again
+            new = ( flags, runtime, error )
+            if new == old :
+                return( False )
+
+            self.__devices[ device_id ] = new
+            self.__waiting.discard( device_id )
+            self.__summary = None
+            return( True )
+
+    def remove_device( self, device_id ) :
+        with self.__lock :
+            if self.__devices.pop( device_id, None ) != None or device_id in self.__waiting :
+                self.__waiting.discard( device_id )
+                self.__summary = None
+
+    def summary( self ) :
+        with self.__lock :
+            if self.__summary == None :
+                self.__summary = fleet_summary( self.__devices, len( self.__waiting ) )
+            return( self.__summary )
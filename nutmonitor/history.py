@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+# On-disk time-series store for UPS metrics
+#
+# Each ( UPS, metric ) series is stored in three tiers : raw values, one
+# minute averages and one hour averages. A tier is an append-only file of
+# fixed-width records ( uint32 timestamp, float32 value ), so it can be
+# read with mmap and searched with a bisection on the timestamps.
+#
+# Values are kept in memory and written in batches (every flush_interval
+# seconds or when max_buffered records are waiting), which bounds both
+# the disk I/O and the memory used. Each tier has a retention : when a
+# file grows past it, it is rewritten with only the most recent records.
+#
+# Callers usually only record the values that changed. The last value of
+# each series is repeated every 'heartbeat' seconds so that the
+# downsampled tiers stay filled while a value is steady. Callers must
+# forget() the series they stop polling (disconnection, unreachable
+# device), a var recorded as None is forgotten : nothing is repeated for
+# values which are not measured any more.
+#
+# The averages of the downsampled tiers are weighted by time : each value
+# counts for as long as it was held, until the next value (at most two
+# heartbeats, or until it is forgotten). close() writes the bucket still
+# open, so that stopping the program does not lose the current minute
+# and hour.
+
+import os
+import os.path
+import struct
+import mmap
+import array
+import threading
+import time
+
+
+RECORD        = struct.Struct( "<If" )
+RECORD_SIZE   = RECORD.size
+
+# ( name, bucket size in seconds, retention in seconds )
+TIERS         = ( ( "raw", 0,    2 * 86400 ),
+                  ( "1m",  60,   60 * 86400 ),
+                  ( "1h",  3600, 5 * 365 * 86400 ) )
+
+METRICS       = ( "battery.charge", "ups.load", "battery.voltage", "ups.temperature", "battery.runtime", "input.voltage", "output.voltage" )
+
+DIRECTORY_MODE = 0o700
+
+
+#-----------------------------------------------------------------------
+# One tier of a series : pending records and the running time weighted
+# average of the current bucket
+class _tier :
+
+    __slots__ = ( "path", "bucket", "retention", "max_hold", "times", "values", "bucket_start", "bucket_sum", "bucket_weight",
+                  "bucket_last", "last_time", "last_value" )
+
+    def __init__( self, path, bucket, retention, max_hold ) :
+        self.path          = path
+        self.bucket        = bucket
+        self.retention     = retention
+        self.max_hold      = max_hold
+        self.times         = array.array( "I" )
+        self.values        = array.array( "f" )
+        self.bucket_start  = None
+        self.bucket_sum    = 0.0
+        self.bucket_weight = 0
+        self.bucket_last   = None
+        self.last_time     = None
+        self.last_value    = None
+
+    #-------------------------------------------------------------------
+    # Add a value. The previous value counts in the buckets it was held
+    # in, a bucket is emitted once the values reach the next one.
+    def add( self, timestamp, value ) :
+        if self.bucket == 0 :
+            self.times.append( timestamp )
+            self.values.append( value )
+            return
+
+        if self.last_time != None :
+            self.__hold( timestamp )
+
+        start = timestamp - ( timestamp % self.bucket )
+        if start != self.bucket_start :
+            self.__emit()
+            self.bucket_start = start
+
+        self.bucket_last = value
+        self.last_time   = timestamp
+        self.last_value  = value
+
+    #-------------------------------------------------------------------
+    # The last value is not measured any more : it only counts until now
+    def interrupt( self, timestamp ) :
+        if self.bucket != 0 and self.last_time != None :
+            self.__hold( timestamp )
+            self.last_time = None
+
+    #-------------------------------------------------------------------
+    # Emit the bucket still open, with what it holds until now
+    def close( self, timestamp ) :
+        self.interrupt( timestamp )
+        self.__emit()
+        self.bucket_start = None
+
+    # Count the last value from the time it was added until 'timestamp'
+    # (at most max_hold seconds), bucket by bucket
+    def __hold( self, timestamp ) :
+        current = self.last_time
+        end     = min( timestamp, current + self.max_hold )
+        while current < end :
+            start = current - ( current % self.bucket )
+            if start != self.bucket_start :
+                self.__emit()
+                self.bucket_start = start
+
+            until               = min( end, start + self.bucket )
+            self.bucket_sum    += self.last_value * ( until - current )
+            self.bucket_weight += until - current
+            self.bucket_last    = self.last_value
+            current             = until
+
+    def __emit( self ) :
+        if self.bucket_start != None and self.bucket_last != None :
+            self.times.append( self.bucket_start )
+            if self.bucket_weight > 0 :
+                self.values.append( self.bucket_sum / self.bucket_weight )
+            else :
+                # Only added at the very end of the bucket
+                self.values.append( self.bucket_last )
+
+        self.bucket_sum    = 0.0
+        self.bucket_weight = 0
+        self.bucket_last   = None
+
+    def pending( self ) :
+        return( len( self.times ) )
+
+    #-------------------------------------------------------------------
+    # Append the pending records to the file, then apply the retention
+    def flush( self ) :
+        if len( self.times ) == 0 :
+            return
+
+        data = b"".join( RECORD.pack( t, v ) for ( t, v ) in zip( self.times, self.values ) )
+        with open( self.path, "ab" ) as fh :
+            fh.write( data )
+
+        self.times  = array.array( "I" )
+        self.values = array.array( "f" )
+
+        # Rewrite the file once it holds 25% more than the retention
+        step        = max( 1, self.bucket )
+        max_records = self.retention // step
+        if os.path.getsize( self.path ) > ( max_records + max_records // 4 ) * RECORD_SIZE :
+            self.__truncate( time.time() - self.retention )
+
+    def __truncate( self, oldest ) :
+        with open( self.path, "rb" ) as fh :
+            data = fh.read()
+
+        offset = _bisect( data, oldest ) * RECORD_SIZE
+        temp   = self.path + ".tmp"
+        with open( temp, "wb" ) as fh :
+            fh.write( data[offset:] )
+
+        if os.name == "nt" and os.path.exists( self.path ) :
+            os.remove( self.path )
+        os.rename( temp, self.path )
+
+    #-------------------------------------------------------------------
+    # Return the pending records between start and end
+    def pending_records( self, start, end ) :
+        return( [ ( t, v ) for ( t, v ) in zip( self.times, self.values ) if start <= t <= end ] )
+
+#-----------------------------------------------------------------------
+# Return the records of a tier file between start and end. Only the
+# first 'size' bytes are read : records written after are still pending.
+def _read_file( path, start, end, size ) :
+    result = []
+
+    try :
+        fh = open( path, "rb" )
+    except IOError :
+        return( result )
+
+    with fh :
+        if os.fstat( fh.fileno() ).st_size < RECORD_SIZE :
+            return( result )
+
+        data = mmap.mmap( fh.fileno(), 0, access=mmap.ACCESS_READ )
+        try :
+            count = min( len( data ), size ) // RECORD_SIZE
+            first = _bisect( data, start, count )
+            for index in range( first, count ) :
+                ( t, v ) = RECORD.unpack_from( data, index * RECORD_SIZE )
+                if t > end :
+                    break
+                result.append( ( t, v ) )
+        finally :
+            data.close()
+
+    return( result )
+
+#-----------------------------------------------------------------------
+# Index of the first record whose timestamp is >= timestamp
+def _bisect( data, timestamp, count=None ) :
+    low  = 0
+    high = len( data ) // RECORD_SIZE
+    if count != None :
+        high = min( high, count )
+    while low < high :
+        middle = ( low + high ) // 2
+        if RECORD.unpack_from( data, middle * RECORD_SIZE )[0] < timestamp :
+            low = middle + 1
+        else :
+            high = middle
+    return( low )
+
+#-----------------------------------------------------------------------
+# Turn a device name (ups@host:port) into a directory name
+def _safe_name( name ) :
+    return( "".join( c if ( c.isalnum() or c in "@.-_" ) else "_" for c in name ) )
+
+#-----------------------------------------------------------------------
+# The store. All methods can be called from any thread.
+class history_store :
+
+    def __init__( self, directory, flush_interval=30, max_buffered=4096, heartbeat=60 ) :
+        self.__directory      = directory
+        self.__flush_interval = flush_interval
+        self.__max_buffered   = max_buffered
+        self.__heartbeat      = heartbeat
+        self.__series         = {}
+        self.__last_values    = {}
+        self.__buffered       = 0
+        self.__last_flush     = time.time()
+        self.__last_heartbeat = time.time()
+        self.__lock           = threading.Lock()
+
+    def __get_path( self, device, metric, tier ) :
+        return( os.path.join( self.__directory, _safe_name( device ), "%s.%s" % ( metric, tier ) ) )
+
+    #-------------------------------------------------------------------
+    # Return the tiers of a series, created for writing
+    def __get_series( self, device, metric ) :
+        key    = ( device, metric )
+        series = self.__series.get( key )
+        if series == None :
+            path = os.path.join( self.__directory, _safe_name( device ) )
+            if not os.path.isdir( path ) :
+                os.makedirs( path, DIRECTORY_MODE )
+
+            series = [ _tier( self.__get_path( device, metric, name ), bucket, retention, 2 * self.__heartbeat ) for ( name, bucket, retention ) in TIERS ]
+            self.__series[ key ] = series
+
+        return( series )
+
+    #-------------------------------------------------------------------
+    # Record the metrics found in 'values' (a dict of UPS vars, usually
+    # only the changed ones). Other vars are ignored.
+    def record( self, device, values, now=None ) :
+        if now == None :
+            now = time.time()
+        timestamp = int( now )
+
+        with self.__lock :
+            for metric in METRICS :
+                value = values.get( metric )
+                if value == None :
+                    # The var disappeared : stop repeating its last value
+                    if metric in values and self.__last_values.pop( ( device, metric ), None ) != None :
+                        for current in self.__series.get( ( device, metric ), () ) :
+                            current.interrupt( timestamp )
+                    continue
+                try :
+                    value = float( value )
+                except ValueError :
+                    continue
+
+                self.__add( device, metric, timestamp, value )
+
+            self.__maybe_flush( now )
+
+    def __add( self, device, metric, timestamp, value ) :
+        for current in self.__get_series( device, metric ) :
+            current.add( timestamp, value )
+
+        self.__last_values[ ( device, metric ) ] = ( timestamp, value )
+        self.__buffered += 1
+
+    #-------------------------------------------------------------------
+    # Stop repeating the last values of a device (or of one of its
+    # metrics) : it is not polled any more, or is unreachable. Recording a
+    # new value starts the heartbeat again.
+    def forget( self, device, metric=None, now=None ) :
+        if now == None :
+            now = time.time()
+
+        with self.__lock :
+            for key in list( self.__last_values ) :
+                if key[0] == device and ( metric == None or key[1] == metric ) :
+                    del self.__last_values[ key ]
+                    for current in self.__series.get( key, () ) :
+                        current.interrupt( int( now ) )
+
+    #-------------------------------------------------------------------
+    # Repeat the values that did not change for 'heartbeat' seconds, and
+    # write the pending records when it is time to
+    def __maybe_flush( self, now ) :
+        if ( now - self.__last_heartbeat ) >= min( 10, self.__heartbeat ) :
+            self.__last_heartbeat = now
+            timestamp = int( now )
+            for ( ( device, metric ), ( last, value ) ) in list( self.__last_values.items() ) :
+                if ( timestamp - last ) >= self.__heartbeat :
+                    self.__add( device, metric, timestamp, value )
+
+        if self.__buffered >= self.__max_buffered or ( now - self.__last_flush ) >= self.__flush_interval :
+            self.__flush()
+
+    #-------------------------------------------------------------------
+    # Called periodically by the front end, so that steady values are
+    # still recorded and written when no new value comes in
+    def tick( self, now=None ) :
+        if now == None :
+            now = time.time()
+
+        with self.__lock :
+            self.__maybe_flush( now )
+
+    #-------------------------------------------------------------------
+    # Write all the pending records
+    def flush( self ) :
+        with self.__lock :
+            self.__flush()
+
+    #-------------------------------------------------------------------
+    # Write everything at shutdown, including the buckets still open of
+    # the downsampled tiers
+    def close( self, now=None ) :
+        if now == None :
+            now = time.time()
+
+        with self.__lock :
+            for series in self.__series.values() :
+                for current in series :
+                    current.close( int( now ) )
+            self.__last_values = {}
+            self.__flush()
+
+    def __flush( self ) :
+        for series in self.__series.values() :
+            for current in series :
+                current.flush()
+        self.__buffered   = 0
+        self.__last_flush = time.time()
+
+    #-------------------------------------------------------------------
+    # Return [ ( timestamp, value ), ... ] for a metric between start and
+    # end. The tier is chosen from the requested span unless given. Reads
+    # have no side effect, unknown series are empty. The lock is only held
+    # to look the series up, the file is read without it.
+    def query( self, device, metric, start, end=None, tier=None ) :
+        if end == None :
+            end = time.time()
+
+        if tier == None :
+            span = end - start
+            if span <= 6 * 3600 :
+                tier = "raw"
+            elif span <= 14 * 86400 :
+                tier = "1m"
+            else :
+                tier = "1h"
+
+        names = [ name for ( name, bucket, retention ) in TIERS ]
+        if metric not in METRICS or tier not in names :
+            return( [] )
+
+        ( start, end ) = ( int( start ), int( end ) )
+        path = self.__get_path( device, metric, tier )
+
+        # The records written after the size is taken are in 'pending'
+        with self.__lock :
+            series = self.__series.get( ( device, metric ) )
+            try :
+                size = os.path.getsize( path )
+            except OSError :
+                size = 0
+
+            if series != None :
+                pending = series[ names.index( tier ) ].pending_records( start, end )
+            else :
+                pending = []
+
+        return( _read_file( path, start, end, size ) + pending )
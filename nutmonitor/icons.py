@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Process-wide icon cache
+#
+# Each pixmap is decoded once, and each scaled variant (tray sizes...) is
+# computed once, as are the composited ones (tray overlays...). The cache
+# is toolkit agnostic : the front end gives the function decoding a file
+# and the one scaling a decoded image.
+
+import os.path
+import threading
+
+from nutmonitor import metrics
+
+
+class icon_cache :
+
+    def __init__( self, directory, loader, scaler=None, extension=".png" ) :
+        self.__directory = directory
+        self.__loader    = loader
+        self.__scaler    = scaler
+        self.__extension = extension
+        self.__icons     = {}
+        self.__lock      = threading.Lock()
+        self.__hits      = 0
+        self.__misses    = 0
+
+    #-------------------------------------------------------------------
+    # Path of the file of an icon, for APIs that want a file
+    def path( self, name ) :
+        return( os.path.abspath( os.path.join( self.__directory, name + self.__extension ) ) )
+
+    #-------------------------------------------------------------------
+    # Return the decoded icon 'name', scaled to 'size' pixels if set
+    def get( self, name, size=None ) :
+        size = self.__check_size( size )
+
+        key  = ( name, size )
+        icon = self.__lookup( key )
+        if icon != None :
+            return( icon )
+
+        start = metrics.clock()
+        if size == None :
+            icon = self.__loader( self.path( name ) )
+            metrics.observe_since( "icon_load_seconds", start, { "operation" : "decode" } )
+        else :
+            icon = self.__scaler( self.get( name ), size )
+            metrics.observe_since( "icon_load_seconds", start, { "operation" : "scale" } )
+
+        with self.__lock :
+            self.__icons[ key ] = icon
+
+        return( icon )
+
+    #-------------------------------------------------------------------
+    # Return a variant of icon 'name' scaled to 'size' (with overlays...)
+    # builder( icon ) is only called the first time 'variant' is asked
+    # for, the icon it returns is cached
+    def get_variant( self, name, size, variant, builder ) :
+        size = self.__check_size( size )
+
+        key  = ( name, size, variant )
+        icon = self.__lookup( key )
+        if icon != None :
+            return( icon )
+
+        start = metrics.clock()
+        icon  = builder( self.get( name, size ) )
+        metrics.observe_since( "icon_load_seconds", start, { "operation" : "composite" } )
+
+        with self.__lock :
+            self.__icons[ key ] = icon
+
+        return( icon )
+
+    def __check_size( self, size ) :
+        if size != None and ( size <= 0 or self.__scaler == None ) :
+            return( None )
+        return( size )
+
+    def __lookup( self, key ) :
+        with self.__lock :
+            icon = self.__icons.get( key )
+            if icon != None :
+                self.__hits += 1
+            else :
+                self.__misses += 1
+            return( icon )
+
+    #-------------------------------------------------------------------
+    # Decode icons ahead of time, for each of the given sizes
+    def preload( self, names, sizes=( None, ) ) :
+        for name in names :
+            for size in sizes :
+                self.get( name, size )
+
+    #-------------------------------------------------------------------
+    # Hit / miss counters
+    def stats( self ) :
+        with self.__lock :
+            return( { "hits" : self.__hits, "misses" : self.__misses, "entries" : len( self.__icons ) } )
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# Instrumentation of the hot paths
+#
+# Counters and latency histograms for the upsd calls, the GUI updates,
+# the reconnections... Metrics are off until enable() is called : the
+# instrumented code then only checks a global, no clock is read and
+# nothing is stored.
+#
+#   start = metrics.clock()
+#   ...
+#   metrics.observe_since( "upsd_call_seconds", start, { "call" : "GetUPSVars" } )
+#   metrics.count( "upsd_reconnects_total" )
+#
+# Collectors expose counters owned by other objects (icon cache hits,
+# notifications shown...) : they are only called when the metrics are
+# read. The metrics can be exported in the Prometheus text format or as
+# JSON lines.
+
+import bisect
+import json
+import threading
+import time
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 )
+
+# Prefix of the exported names
+PREFIX  = "nutmonitor_"
+
+# The registry, None while metrics are off
+_registry   = None
+
+# ( prefix, function returning a dict of values ), see add_collector()
+_collectors = []
+
+
+#-----------------------------------------------------------------------
+# Latency histogram. counts[i] is the number of values up to BUCKETS[i],
+# the last one counts the values above the last bucket.
+class histogram :
+
+    __slots__ = ( "counts", "count", "sum", "max" )
+
+    def __init__( self ) :
+        self.counts = [ 0 ] * ( len( BUCKETS ) + 1 )
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = 0.0
+
+    def add( self, value ) :
+        self.counts[ bisect.bisect_left( BUCKETS, value ) ] += 1
+        self.count += 1
+        self.sum   += value
+        if value > self.max :
+            self.max = value
+
+    #-------------------------------------------------------------------
+    # Estimate of the 'q' quantile : the upper bound of its bucket
+    def quantile( self, q ) :
+        if self.count == 0 :
+            return( 0.0 )
+
+        rank  = q * self.count
+        total = 0
+        for ( index, count ) in enumerate( self.counts ) :
+            total += count
+            if total >= rank and count > 0 :
+                if index < len( BUCKETS ) :
+                    return( min( BUCKETS[ index ], self.max ) )
+                break
+
+        return( self.max )
+
+class registry :
+
+    def __init__( self ) :
+        self.__lock       = threading.Lock()
+        self.__counters   = {}
+        self.__histograms = {}
+        self.__started    = time.time()
+
+    def count( self, key, value ) :
+        with self.__lock :
+            self.__counters[ key ] = self.__counters.get( key, 0 ) + value
+
+    def observe( self, key, value ) :
+        with self.__lock :
+            values = self.__histograms.get( key )
+            if values == None :
+                values = self.__histograms[ key ] = histogram()
+            values.add( value )
+
+    #-------------------------------------------------------------------
+    # Return the metrics as a list of dicts, sorted by name and labels
+    def snapshot( self ) :
+        metrics = []
+
+        with self.__lock :
+            for ( ( name, labels ), value ) in self.__counters.items() :
+                metrics.append( { "name" : name, "labels" : dict( labels ), "type" : "counter", "value" : value } )
+
+            for ( ( name, labels ), values ) in self.__histograms.items() :
+                cumulative = []
+                total      = 0
+                for ( bound, count ) in zip( BUCKETS, values.counts ) :
+                    total += count
+                    cumulative.append( [ bound, total ] )
+
+                metrics.append( { "name" : name, "labels" : dict( labels ), "type" : "histogram",
+                                  "count" : values.count, "sum" : values.sum, "max" : values.max,
+                                  "p50" : values.quantile( 0.5 ), "p95" : values.quantile( 0.95 ),
+                                  "buckets" : cumulative } )
+
+        for ( prefix, function ) in list( _collectors ) :
+            try :
+                values = function() or {}
+            except Exception :
+                continue
+            for ( name, value ) in values.items() :
+                metrics.append( { "name" : "%s_%s" % ( prefix, name ), "labels" : {}, "type" : "gauge", "value" : value } )
+
+        metrics.append( { "name" : "uptime_seconds", "labels" : {}, "type" : "gauge", "value" : time.time() - self.__started } )
+
+        metrics.sort( key=lambda metric : ( metric["name"], sorted( metric["labels"].items() ) ) )
+        return( metrics )
+
+#-----------------------------------------------------------------------
+# Turn the metrics on or off. Turning them off drops what was measured.
+def enable() :
+    global _registry
+    if _registry == None :
+        _registry = registry()
+
+def disable() :
+    global _registry
+    _registry = None
+
+def is_enabled() :
+    return( _registry != None )
+
+def _key( name, labels ) :
+    if labels :
+        return( ( name, tuple( sorted( labels.items() ) ) ) )
+    return( ( name, () ) )
+
+#-----------------------------------------------------------------------
+# Start of a measure, None while metrics are off
+def clock() :
+    if _registry == None :
+        return( None )
+    return( time.time() )
+
+#-----------------------------------------------------------------------
+# Add the time elapsed since 'start' (see clock()) to a histogram
+def observe_since( name, start, labels=None ) :
+    current = _registry
+    if start != None and current != None :
+        current.observe( _key( name, labels ), time.time() - start )
+
+def observe( name, value, labels=None ) :
+    current = _registry
+    if current != None :
+        current.observe( _key( name, labels ), value )
+
+def count( name, labels=None, value=1 ) :
+    current = _registry
+    if current != None :
+        current.count( _key( name, labels ), value )
+
+#-----------------------------------------------------------------------
+# Expose the values of function() (a dict) as '<prefix>_<key>' gauges
+def add_collector( prefix, function ) :
+    _collectors.append( ( prefix, function ) )
+
+def snapshot() :
+    current = _registry
+    if current == None :
+        return( [] )
+    return( current.snapshot() )
+
+#-----------------------------------------------------------------------
+# Prometheus text exposition format
+def _prometheus_labels( labels, extra=None ) :
+    items = sorted( labels.items() )
+    if extra != None :
+        items.append( extra )
+    if len( items ) == 0 :
+        return( "" )
+
+    escaped = [ "%s=\"%s\"" % ( key, str( value ).replace( "\\", "\\\\" ).replace( "\"", "\\\"" ).replace( "\n", "\\n" ) ) for ( key, value ) in items ]
+    return( "{%s}" % ",".join( escaped ) )
+
+def to_prometheus( metrics=None ) :
+    if metrics == None :
+        metrics = snapshot()
+
+    lines = []
+    typed = set()
+    for metric in metrics :
+        name = PREFIX + metric["name"]
+        if name not in typed :
+            typed.add( name )
+            lines.append( "# TYPE %s %s" % ( name, metric["type"] ) )
+
+        if metric["type"] != "histogram" :
+            lines.append( "%s%s %s" % ( name, _prometheus_labels( metric["labels"] ), repr( metric["value"] ) ) )
+            continue
+
+        for ( bound, total ) in metric["buckets"] :
+            lines.append( "%s_bucket%s %d" % ( name, _prometheus_labels( metric["labels"], ( "le", repr( bound ) ) ), total ) )
+        lines.append( "%s_bucket%s %d" % ( name, _prometheus_labels( metric["labels"], ( "le", "+Inf" ) ), metric["count"] ) )
+        lines.append( "%s_sum%s %s" % ( name, _prometheus_labels( metric["labels"] ), repr( metric["sum"] ) ) )
+        lines.append( "%s_count%s %d" % ( name, _prometheus_labels( metric["labels"] ), metric["count"] ) )
+
+    return( "\n".join( lines ) + "\n" )
+
+#-----------------------------------------------------------------------
+# One JSON object per metric, stamped with the export time
+def to_json_lines( metrics=None ) :
+    if metrics == None :
+        metrics = snapshot()
+
+    now = time.time()
+    return( "".join( json.dumps( dict( metric, time=now ), sort_keys=True ) + "\n" for metric in metrics ) )
+
+#-----------------------------------------------------------------------
+# Write the metrics to a file : JSON lines for .jsonl / .json files, the
+# Prometheus text format otherwise
+def export( filename ) :
+    if filename.lower().endswith( ( ".jsonl", ".json" ) ) :
+        data = to_json_lines()
+    else :
+        data = to_prometheus()
+
+    with open( filename, "w" ) as fh :
+        fh.write( data )
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Desktop notifications, coalesced and rate limited
+#
+# Every notification is tied to a source (a UPS, a upsd server) and an
+# event ("on_battery", "connection"...). The notification center :
+#
+#  - drops a notification repeating the last one of the same source and
+#    event, unless 'repeat_interval' seconds passed
+#  - keeps one notification per source on the desktop : a new event of a
+#    source replaces its notification instead of stacking a new one
+#  - waits 'batch_delay' seconds before showing anything, so that the
+#    notifications of many sources changing at once (site wide outage)
+#    are merged into a single summary
+#  - shows at most 'rate' notifications per 'period' seconds, the others
+#    are merged into the next summary
+#
+# The center is toolkit agnostic. The front end gives :
+#
+#  - a backend with a show( handle, title, message, icon ) method, which
+#    creates a notification when handle is None or updates 'handle'
+#    otherwise, and returns the handle of the notification
+#  - a schedule( delay, func ) function calling func() after 'delay'
+#    seconds from the GUI main loop
+#
+# All the methods must be called from the GUI main loop.
+
+import collections
+import time
+
+from gettext import gettext as _
+
+
+# Handle of the summary notification
+_SUMMARY = object()
+
+
+class notification_center :
+
+    def __init__( self, backend, schedule, title="NUT Monitor", batch_delay=1.0, summary_threshold=3, rate=4, period=10.0, repeat_interval=60.0, summary_lines=5 ) :
+        self.__backend           = backend
+        self.__schedule          = schedule
+        self.__title             = title
+        self.__batch_delay       = batch_delay
+        self.__summary_threshold = summary_threshold
+        self.__rate              = rate
+        self.__period            = period
+        self.__repeat_interval   = repeat_interval
+        self.__summary_lines     = summary_lines
+
+        self.__pending           = collections.OrderedDict()
+        self.__flush_scheduled   = False
+        self.__handles           = {}
+        self.__last              = {}
+        self.__shown             = collections.deque()
+        self.__stats             = { "requested" : 0, "shown" : 0, "deduplicated" : 0, "summarized" : 0 }
+
+    #-------------------------------------------------------------------
+    # Request a notification. 'icon' is given as is to the backend.
+    def notify( self, source, event, message, icon=None ) :
+        now = time.time()
+        self.__stats["requested"] += 1
+
+        last = self.__last.get( ( source, event ) )
+        if last != None and last[0] == message and ( now - last[1] ) < self.__repeat_interval :
+            self.__stats["deduplicated"] += 1
+            return
+        self.__last[ ( source, event ) ] = ( message, now )
+
+        # Only the latest event of a source is worth showing
+        self.__pending.pop( source, None )
+        self.__pending[ source ] = ( message, icon )
+
+        self.__schedule_flush( self.__batch_delay )
+
+    #-------------------------------------------------------------------
+    # Forget the notification state of a source (device disconnected...)
+    def forget( self, source ) :
+        self.__handles.pop( source, None )
+        self.__pending.pop( source, None )
+        for key in [ key for key in self.__last if key[0] == source ] :
+            del self.__last[ key ]
+
+    #-------------------------------------------------------------------
+    # Counters : requested, shown, deduplicated, summarized
+    def stats( self ) :
+        return( dict( self.__stats ) )
+
+    def __schedule_flush( self, delay ) :
+        if not self.__flush_scheduled :
+            self.__flush_scheduled = True
+            self.__schedule( delay, self.__flush )
+
+    #-------------------------------------------------------------------
+    # Show the pending notifications, or a summary of them
+    def __flush( self ) :
+        self.__flush_scheduled = False
+        if len( self.__pending ) == 0 :
+            return
+
+        now = time.time()
+        while len( self.__shown ) > 0 and ( now - self.__shown[0] ) >= self.__period :
+            self.__shown.popleft()
+
+        allowed = self.__rate - len( self.__shown )
+        if allowed <= 0 :
+            # Over the rate : try again once the oldest notification expires
+            self.__schedule_flush( self.__period - ( now - self.__shown[0] ) )
+            return
+
+        pending        = list( self.__pending.items() )
+        self.__pending = collections.OrderedDict()
+
+        if len( pending ) >= self.__summary_threshold or len( pending ) > allowed :
+            self.__show_summary( pending )
+            return
+
+        for ( source, ( message, icon ) ) in pending :
+            self.__show( source, message, icon )
+
+    def __show_summary( self, pending ) :
+        lines = [ message.split( "\n" )[0] for ( source, ( message, icon ) ) in pending[:self.__summary_lines] ]
+        if len( pending ) > self.__summary_lines :
+            lines.append( _("... and %d more") % ( len( pending ) - self.__summary_lines ) )
+
+        self.__stats["summarized"] += len( pending )
+        self.__show( _SUMMARY, "\n".join( lines ), pending[0][1][1], _("NUT Monitor - %d events") % len( pending ) )
+
+    def __show( self, source, message, icon, title=None ) :
+        if title == None :
+            title = self.__title
+
+        try :
+            self.__handles[ source ] = self.__backend.show( self.__handles.get( source ), title, message, icon )
+        except Exception :
+            # Notifications are best effort, a broken daemon must not
+            # break the monitoring
+            return
+
+        self.__shown.append( time.time() )
+        self.__stats["shown"] += 1
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+# Pool of persistent upsd connections
+#
+# Connections are keyed by ( host, port, login ) so that the UPS list,
+# commands, RW vars and polling all reuse the same authenticated session
+# instead of opening a new one for each action.
+#
+# When a session breaks, the pool reconnects with an exponential backoff
+# (with jitter, so that many clients do not reconnect all at once). While
+# the server is unreachable, calls fail immediately without touching the
+# network. Listeners are only told about a lost session (up -> down) and
+# its recovery (down -> up), not about every failed call nor about the
+# first connection.
+
+import threading
+import random
+import time
+
+import PyNUT
+
+from nutmonitor import metrics
+from nutmonitor import protocol
+
+
+STATE_UP   = "up"
+STATE_DOWN = "down"
+
+
+#-----------------------------------------------------------------------
+# Raised when the server cannot be reached, or while waiting for the
+# next reconnection attempt
+class connection_error( Exception ) :
+    pass
+
+#-----------------------------------------------------------------------
+# PyNUTClient able to fetch a subset of the UPS variables. PyNUTClient can
+# only download the whole LIST VAR : here one GET VAR per variable is
+# written at once and the answers are read after, in one round trip.
+# PyNUTClient does not expose its session : if the PyNUT version in use
+# does not keep it where expected, the whole LIST VAR is downloaded and
+# filtered instead.
+class nut_client( PyNUT.PyNUTClient ) :
+
+    def GetUPSVarsSubset( self, ups, names ) :
+        handler = getattr( self, "_PyNUTClient__srv_handler", None )
+        if handler == None or not hasattr( handler, "read_until" ) :
+            vars = self.GetUPSVars( ups )
+            return( dict( ( name, vars[ name ] ) for name in names if name in vars ) )
+
+        timeout = getattr( self, "_PyNUTClient__timeout", 5 )
+
+        commands = "".join( "GET VAR %s %s\n" % ( ups, name ) for name in names )
+        if bytes is not str :
+            commands = commands.encode( "utf-8" )
+        handler.write( commands )
+
+        result = {}
+        error  = None
+        for name in names :
+            line = handler.read_until( b"\n", timeout )
+            if not line.endswith( b"\n" ) :
+                # Answers are now out of sync, the session must be dropped
+                raise IOError( "Timeout while waiting for GET VAR answers" )
+            if bytes is not str :
+                line = line.decode( "utf-8", "replace" )
+
+            line = line.rstrip( "\r\n" )
+            if line.startswith( "ERR " ) :
+                if not line.startswith( "ERR VAR-NOT-SUPPORTED" ) and error == None :
+                    error = line
+                continue
+
+            tokens = protocol.split_line( line )
+            if len( tokens ) >= 4 and tokens[0] == "VAR" :
+                result[ tokens[2] ] = tokens[3]
+
+        if error != None :
+            raise PyNUT.PyNUTError( error )
+
+        return( result )
+
+#-----------------------------------------------------------------------
+# A pooled session. It behaves like a PyNUTClient : any PyNUTClient method
+# can be called on it. Calls are serialised since PyNUTClient is not
+# thread safe.
+class pooled_client :
+
+    __base_delay = 1.0
+    __max_delay  = 60.0
+
+    def __init__( self, pool, key, password ) :
+        self.__pool         = pool
+        self.__key          = key
+        self.__password     = password
+        self.__client       = None
+        self.__lock         = threading.RLock()
+        self.__state        = None
+        self.__reported     = False
+        self.__failures     = 0
+        self.__next_attempt = 0.0
+
+    def get_key( self ) :
+        return( self.__key )
+
+    def get_state( self ) :
+        return( self.__state )
+
+    def set_password( self, password ) :
+        with self.__lock :
+            if password != self.__password :
+                self.__password = password
+                self.__client   = None
+
+    #-------------------------------------------------------------------
+    # Open the session if needed. While in backoff, fail without trying.
+    def __get_client( self ) :
+        if self.__client != None :
+            return( self.__client )
+
+        if time.time() < self.__next_attempt :
+            raise connection_error( "Waiting %d seconds before reconnecting to '%s'" % ( self.__next_attempt - time.time() + 1, self.__key[0] ) )
+
+        ( host, port, login ) = self.__key
+        try :
+            self.__client = nut_client( host=host, port=port, login=login, password=self.__password )
+        except PyNUT.PyNUTError :
+            # Authentication refused, the server itself is fine
+            self.__set_state( STATE_UP )
+            raise
+        except Exception as e :
+            self.__failed( e )
+
+        return( self.__client )
+
+    #-------------------------------------------------------------------
+    # Drop the broken session and schedule the next reconnection attempt
+    def __failed( self, error ) :
+        self.__client        = None
+        delay                = min( self.__max_delay, self.__base_delay * ( 2 ** self.__failures ) )
+        self.__failures     += 1
+        self.__next_attempt  = time.time() + random.uniform( delay / 2.0, delay )
+        metrics.count( "upsd_connection_failures_total" )
+        self.__set_state( STATE_DOWN, error )
+        raise connection_error( str( error ) )
+
+    def __set_state( self, state, error=None ) :
+        if state == STATE_UP :
+            self.__failures     = 0
+            self.__next_attempt = 0.0
+
+        if state != self.__state :
+            if self.__state == STATE_DOWN :
+                metrics.count( "upsd_reconnects_total" )
+
+            previous     = self.__state
+            self.__state = state
+
+            # The first connection is not a state change worth reporting,
+            # whether it works or not (no upsd on localhost at startup...).
+            # Only a lost session is, and then its recovery.
+            if previous == STATE_UP and state == STATE_DOWN :
+                self.__reported = True
+                self.__pool._notify( self.__key, state, error )
+            elif state == STATE_UP and self.__reported :
+                self.__reported = False
+                self.__pool._notify( self.__key, state, error )
+
+    #-------------------------------------------------------------------
+    # Call a PyNUTClient method. A session that was working is retried
+    # once with a new connection, since upsd may have been restarted.
+    # The time measured includes waiting for the calls of other threads.
+    def call( self, method, *args, **kwargs ) :
+        start = metrics.clock()
+        try :
+            return( self.__call( method, *args, **kwargs ) )
+        except Exception :
+            metrics.count( "upsd_call_errors_total", { "call" : method } )
+            raise
+        finally :
+            metrics.observe_since( "upsd_call_seconds", start, { "call" : method } )
+
+    def __call( self, method, *args, **kwargs ) :
+        with self.__lock :
+            retry = self.__client != None
+
+            while True :
+                client = self.__get_client()
+                try :
+                    result = getattr( client, method )( *args, **kwargs )
+                    self.__set_state( STATE_UP )
+                    return( result )
+
+                except PyNUT.PyNUTError :
+                    # upsd answered with an error, the session is still valid
+                    self.__set_state( STATE_UP )
+                    raise
+
+                except Exception as e :
+                    self.__client = None
+                    if not retry :
+                        self.__failed( e )
+                    retry = False
+
+    def close( self ) :
+        with self.__lock :
+            self.__client = None
+
+    def __getattr__( self, name ) :
+        if name.startswith( "_" ) :
+            raise AttributeError( name )
+        return( lambda *args, **kwargs : self.call( name, *args, **kwargs ) )
+
+#-----------------------------------------------------------------------
+# The pool itself
+class connection_pool :
+
+    def __init__( self ) :
+        self.__clients   = {}
+        self.__listeners = []
+        self.__lock      = threading.Lock()
+
+    #-------------------------------------------------------------------
+    # Return the session for ( host, port, login ). No network activity
+    # happens until a method is called on the returned object.
+    def get( self, host, port=3493, login=None, password=None ) :
+        key = ( host, int( port ), login )
+
+        with self.__lock :
+            client = self.__clients.get( key )
+            if client == None :
+                client = pooled_client( self, key, password )
+                self.__clients[ key ] = client
+
+        client.set_password( password )
+        return( client )
+
+    #-------------------------------------------------------------------
+    # Register a callback( key, state, error ) called when a session goes
+    # up or down. It is called from the thread that made the call.
+    def add_listener( self, callback ) :
+        self.__listeners.append( callback )
+
+    def _notify( self, key, state, error ) :
+        for callback in self.__listeners :
+            callback( key, state, error )
+
+    def close_all( self ) :
+        with self.__lock :
+            clients        = list( self.__clients.values() )
+            self.__clients = {}
+
+        for client in clients :
+            client.close()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Startup profiling
+#
+# Python 2 has no '-X importtime' : the import profiler wraps __import__
+# to measure how long each module takes to load, the modules it imports
+# included ('cumulative') or not ('self'). Only imports loading new
+# modules are recorded, imports of already loaded modules cost nothing.
+#
+# report() prints the imports recorded since the previous report, in the
+# '-X importtime' format, so that a front end can print the imports done
+# between two steps of its startup.
+
+import sys
+import threading
+import time
+
+try :
+    import builtins
+except ImportError :
+    import __builtin__ as builtins
+
+
+class import_profiler :
+
+    def __init__( self ) :
+        self.__original = None
+        self.__records  = []
+        self.__lock     = threading.Lock()
+        self.__local    = threading.local()
+
+    #-------------------------------------------------------------------
+    # Start measuring the imports. This must be done before the imports
+    # to measure, i.e. at the very top of the program.
+    def install( self ) :
+        if self.__original == None :
+            self.__original     = builtins.__import__
+            builtins.__import__ = self.__import
+
+    def uninstall( self ) :
+        if self.__original != None :
+            builtins.__import__ = self.__original
+            self.__original     = None
+
+    def __import( self, name, *args, **kwargs ) :
+        # Time spent in the nested imports and modules they loaded, per thread
+        stack = getattr( self.__local, "stack", None )
+        if stack == None :
+            stack = self.__local.stack = []
+
+        loaded = _loaded_modules()
+        stack.append( [ 0.0, set() ] )
+        start  = time.time()
+        try :
+            return( self.__original( name, *args, **kwargs ) )
+        finally :
+            cumulative = time.time() - start
+            ( nested, nested_modules ) = stack.pop()
+
+            new = _loaded_modules() - loaded
+            if len( new ) > 0 :
+                if len( stack ) > 0 :
+                    stack[-1][0] += cumulative
+                    stack[-1][1].update( new )
+
+                # Name the modules this import loaded itself ('from x import y'
+                # and relative imports do not give them)
+                modules = sorted( new - nested_modules ) or [ name ]
+                with self.__lock :
+                    self.__records.append( ( len( stack ), ", ".join( modules ), cumulative - nested, cumulative ) )
+
+    #-------------------------------------------------------------------
+    # Return the recorded imports as ( depth, name, self, cumulative )
+    # tuples, times in seconds. Nested imports come before the import
+    # that needed them.
+    def get_records( self ) :
+        with self.__lock :
+            return( list( self.__records ) )
+
+    #-------------------------------------------------------------------
+    # Write the imports recorded since the previous report to 'out'
+    def report( self, out=None ) :
+        if out == None :
+            out = sys.stderr
+
+        with self.__lock :
+            records        = self.__records
+            self.__records = []
+
+        if len( records ) == 0 :
+            return
+
+        out.write( "import time: self [us] | cumulative | imported package\n" )
+        for ( depth, name, self_time, cumulative ) in records :
+            out.write( "import time: %9d | %10d | %s%s\n" % ( self_time * 1000000, cumulative * 1000000, "  " * depth, name ) )
+
+#-----------------------------------------------------------------------
+# Names of the modules really loaded. Python 2 adds None entries to
+# sys.modules for failed implicit relative imports, they are left out.
+def _loaded_modules() :
+    return( set( name for ( name, module ) in list( sys.modules.items() ) if module != None ) )
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+# Non-blocking implementation of the NUT network protocol.
+#
+# A nut_connection never blocks : the owner (see engine.py) waits on its
+# socket with select() and calls handle_read() / handle_write() when the
+# socket is ready. Requests are pipelined, upsd answers them in order so
+# each response is matched with the oldest pending request.
+
+import socket
+import errno
+import time
+import collections
+
+
+# Python 2 sockets return str, Python 3 sockets return bytes
+if bytes is str :
+    def _decode( data ) :
+        return( data )
+
+    def _encode( text ) :
+        return( text )
+else :
+    def _decode( data ) :
+        return( data.decode( "utf-8", "replace" ) )
+
+    def _encode( text ) :
+        return( text.encode( "utf-8" ) )
+
+_CONNECT_IN_PROGRESS = ( 0, errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK, getattr( errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK ) )
+
+
+class nut_error( Exception ) :
+    pass
+
+#-----------------------------------------------------------------------
+# Split a line received from upsd into tokens. Values may be quoted and
+# contain escaped quotes / backslashes.
+def split_line( line ) :
+    tokens   = []
+    current  = []
+    quoted   = False
+    escaped  = False
+    in_token = False
+
+    for char in line :
+        if escaped :
+            current.append( char )
+            escaped = False
+        elif char == "\\" :
+            escaped  = True
+            in_token = True
+        elif char == "\"" :
+            quoted   = not quoted
+            in_token = True
+        elif char == " " and not quoted :
+            if in_token :
+                tokens.append( "".join( current ) )
+                current  = []
+                in_token = False
+        else :
+            current.append( char )
+            in_token = True
+
+    if in_token :
+        tokens.append( "".join( current ) )
+
+    return( tokens )
+
+#-----------------------------------------------------------------------
+# Quote a value before sending it to upsd
+def quote( value ) :
+    return( "\"%s\"" % value.replace( "\\", "\\\\" ).replace( "\"", "\\\"" ) )
+
+#-----------------------------------------------------------------------
+# Resolve the address of an upsd server for nut_connection.open(). Blocks
+# on a DNS lookup unless 'numeric_only' is set : then only numeric
+# addresses are accepted and socket.gaierror is raised for host names.
+def resolve( host, port, numeric_only=False ) :
+    flags = socket.AI_NUMERICHOST if numeric_only else 0
+    return( socket.getaddrinfo( host, port, 0, socket.SOCK_STREAM, 0, flags )[0] )
+
+#-----------------------------------------------------------------------
+# Pending request. 'list_name' is set for "LIST xxx" requests, which are
+# answered with a BEGIN LIST ... END LIST block instead of a single line.
+class _request :
+
+    __slots__ = ( "list_name", "callback", "rows", "sent_at" )
+
+    def __init__( self, list_name, callback ) :
+        self.list_name = list_name
+        self.callback  = callback
+        self.rows      = []
+        self.sent_at   = time.time()
+
+#-----------------------------------------------------------------------
+# Non-blocking connection to an upsd server
+class nut_connection :
+
+    def __init__( self, host, port=3493, login=None, password=None, timeout=5 ) :
+        self.host     = host
+        self.port     = port
+        self.login    = login
+        self.password = password
+        self.timeout  = timeout
+
+        self.__socket     = None
+        self.__connecting = False
+        self.__in_buffer  = b""
+        self.__out_buffer = b""
+        self.__pending    = collections.deque()
+
+    #-------------------------------------------------------------------
+    # Start the connection. The TCP handshake completes in the background,
+    # commands queued meanwhile are sent as soon as the socket is writable.
+    # 'address' is an entry returned by resolve(), the host is resolved
+    # here (blocking) when it is None.
+    def open( self, address=None ) :
+        if address == None :
+            address = resolve( self.host, self.port )
+        family, socktype, proto, canonname, address = address
+
+        self.__socket = socket.socket( family, socktype, proto )
+        self.__socket.setblocking( False )
+
+        rc = self.__socket.connect_ex( address )
+        if rc not in _CONNECT_IN_PROGRESS :
+            self.__socket.close()
+            self.__socket = None
+            raise socket.error( rc, errno.errorcode.get( rc, "connection failed" ) )
+
+        self.__connecting = True
+
+        if self.login != None :
+            self.request( "USERNAME %s" % quote( self.login ), self.__check_auth )
+        if self.password != None :
+            self.request( "PASSWORD %s" % quote( self.password ), self.__check_auth )
+
+    def __check_auth( self, result, error ) :
+        if error != None :
+            self.close( error )
+
+    #-------------------------------------------------------------------
+    # Close the connection. All pending requests fail with 'reason'.
+    def close( self, reason="Connection closed" ) :
+        if self.__socket != None :
+            try :
+                self.__socket.close()
+            except socket.error :
+                pass
+
+        self.__socket     = None
+        self.__connecting = False
+        self.__in_buffer  = b""
+        self.__out_buffer = b""
+
+        pending        = self.__pending
+        self.__pending = collections.deque()
+        for current in pending :
+            current.callback( None, reason )
+
+    def is_open( self ) :
+        return( self.__socket != None )
+
+    def fileno( self ) :
+        return( self.__socket.fileno() )
+
+    def wants_write( self ) :
+        return( self.__connecting or len( self.__out_buffer ) > 0 )
+
+    def pending_count( self ) :
+        return( len( self.__pending ) )
+
+    #-------------------------------------------------------------------
+    # Close the connection if the oldest request waits for too long
+    def check_timeout( self, now ) :
+        if len( self.__pending ) > 0 and ( now - self.__pending[0].sent_at ) > self.timeout :
+            self.close( "Timeout while waiting for %s:%s" % ( self.host, self.port ) )
+
+    #-------------------------------------------------------------------
+    # Queue a command. The callback is called with ( result, error ) :
+    # result is the list of tokens of the answer (or the list of rows
+    # for a LIST command), error is None or an error message.
+    def request( self, command, callback ) :
+        list_name = None
+        if command.startswith( "LIST " ) :
+            list_name = command[5:]
+
+        self.__pending.append( _request( list_name, callback ) )
+        self.__out_buffer += _encode( command + "\n" )
+
+    #-------------------------------------------------------------------
+    # Retrieve UPS variables as a dict : callback( vars, error )
+    def list_vars( self, ups, callback ) :
+        def parse( rows, error ) :
+            if error != None :
+                callback( None, error )
+                return
+            callback( dict( ( row[2], row[3] ) for row in rows if len( row ) >= 4 ), None )
+
+        self.request( "LIST VAR %s" % ups, parse )
+
+    #-------------------------------------------------------------------
+    # Retrieve only the listed UPS variables : one GET VAR per variable,
+    # all sent at once so they cost a single round trip. Variables the
+    # UPS does not support are left out. callback( vars, error )
+    def get_vars( self, ups, names, callback ) :
+        if len( names ) == 0 :
+            callback( {}, None )
+            return
+
+        result = {}
+        state  = { "left" : len( names ), "error" : None }
+
+        def parse( tokens, error ) :
+            state["left"] -= 1
+            if error != None :
+                if not error.startswith( "VAR-NOT-SUPPORTED" ) and state["error"] == None :
+                    state["error"] = error
+            elif len( tokens ) >= 4 :
+                result[ tokens[2] ] = tokens[3]
+
+            if state["left"] == 0 :
+                if state["error"] != None :
+                    callback( None, state["error"] )
+                else :
+                    callback( result, None )
+
+        for name in names :
+            self.request( "GET VAR %s %s" % ( ups, name ), parse )
+
+    #-------------------------------------------------------------------
+    # Retrieve the list of UPSes as a dict : callback( upses, error )
+    def list_upses( self, callback ) :
+        def parse( rows, error ) :
+            if error != None :
+                callback( None, error )
+                return
+            callback( dict( ( row[1], row[2] if len( row ) > 2 else "" ) for row in rows if len( row ) >= 2 ), None )
+
+        self.request( "LIST UPS", parse )
+
+    #-------------------------------------------------------------------
+    # Socket is writable : finish connection and flush queued commands
+    def handle_write( self ) :
+        if self.__connecting :
+            rc = self.__socket.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+            if rc != 0 :
+                self.close( "Error connecting to '%s' (%s)" % ( self.host, errno.errorcode.get( rc, rc ) ) )
+                return
+            self.__connecting = False
+
+        if len( self.__out_buffer ) > 0 :
+            try :
+                sent = self.__socket.send( self.__out_buffer )
+                self.__out_buffer = self.__out_buffer[sent:]
+            except socket.error as e :
+                if e.args[0] not in ( errno.EAGAIN, errno.EWOULDBLOCK ) :
+                    self.close( "Error sending to '%s' (%s)" % ( self.host, e ) )
+
+    #-------------------------------------------------------------------
+    # Socket is readable : read and dispatch complete lines
+    def handle_read( self ) :
+        try :
+            data = self.__socket.recv( 65536 )
+        except socket.error as e :
+            if e.args[0] not in ( errno.EAGAIN, errno.EWOULDBLOCK ) :
+                self.close( "Error reading from '%s' (%s)" % ( self.host, e ) )
+            return
+
+        if not data :
+            self.close( "Connection closed by '%s'" % self.host )
+            return
+
+        self.__in_buffer += data
+        while self.__socket != None :
+            offset = self.__in_buffer.find( b"\n" )
+            if offset == -1 :
+                break
+
+            line             = _decode( self.__in_buffer[:offset] ).rstrip( "\r" )
+            self.__in_buffer = self.__in_buffer[offset+1:]
+            self.__handle_line( line )
+
+    def __handle_line( self, line ) :
+        if len( self.__pending ) == 0 :
+            # Unsolicited data, ignore it
+            return
+
+        current = self.__pending[0]
+
+        if line.startswith( "ERR " ) :
+            self.__pending.popleft()
+            current.callback( None, line[4:] )
+            return
+
+        if current.list_name == None :
+            self.__pending.popleft()
+            current.callback( split_line( line ), None )
+            return
+
+        if line == "BEGIN LIST %s" % current.list_name :
+            return
+
+        if line == "END LIST %s" % current.list_name :
+            self.__pending.popleft()
+            current.callback( current.rows, None )
+            return
+
+        current.rows.append( split_line( line ) )
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Frame coalesced rendering
+#
+# Each poll may change the status texts, the progress bars, the tooltip,
+# the rows of a view... Drawing them as they come queues a relayout per
+# widget and per device : when many UPSes report changes in the same
+# second, the main loop spends its time redrawing states nobody sees. The
+# frame renderer gathers the pending updates instead, and draws them all
+# from a single main loop callback per frame :
+#
+#  - an update is keyed by ( view, target ) : a new update of a target
+#    replaces the one not drawn yet, intermediate states are dropped
+#  - at most 'max_fps' frames are drawn per second
+#  - the updates of a hidden view (window iconified to the tray, page not
+#    displayed...) are kept for when it is shown again, see redraw()
+#
+# The renderer is toolkit agnostic. The front end gives a schedule(
+# delay, func ) function calling func() after 'delay' seconds from the GUI
+# main loop, which must be callable from any thread, and registers the
+# views with a function telling if they are visible.
+#
+#   renderer = render.frame_renderer( timeout_dispatch )
+#   renderer.add_view( "main", lambda : window_visible )
+#   renderer.update( "main", "charge", draw_charge )      # any thread
+#
+# update() can be called from any thread, the other methods must be
+# called from the GUI main loop. The draw functions run in the main loop.
+
+import threading
+import time
+
+from nutmonitor import metrics
+
+
+class frame_renderer :
+
+    def __init__( self, schedule, max_fps=20 ) :
+        self.__schedule    = schedule
+        self.__interval    = 1.0 / max_fps
+        self.__views       = {}
+        self.__pending     = {}
+        self.__lock        = threading.Lock()
+        self.__scheduled   = False
+        self.__last_frame  = 0.0
+        self.__stats       = { "frames" : 0, "drawn" : 0, "dropped" : 0, "deferred" : 0 }
+
+    #-------------------------------------------------------------------
+    # Register a view. is_visible() is called from the main loop before
+    # drawing its updates.
+    def add_view( self, view, is_visible ) :
+        self.__views[ view ] = is_visible
+
+    #-------------------------------------------------------------------
+    # Draw function( *args ) at the next frame, in place of the update of
+    # the same target not drawn yet
+    def update( self, view, target, function, *args ) :
+        with self.__lock :
+            if ( view, target ) in self.__pending :
+                self.__stats["dropped"] += 1
+            self.__pending[ ( view, target ) ] = ( function, args )
+            self.__schedule_frame()
+
+    #-------------------------------------------------------------------
+    # Drop the updates not drawn yet of a view (device disconnected...)
+    def discard( self, view ) :
+        with self.__lock :
+            for key in [ key for key in self.__pending if key[0] == view ] :
+                del self.__pending[ key ]
+
+    #-------------------------------------------------------------------
+    # A view was shown : draw the updates kept while it was hidden
+    def redraw( self ) :
+        with self.__lock :
+            if len( self.__pending ) > 0 :
+                self.__schedule_frame()
+
+    def stats( self ) :
+        with self.__lock :
+            return( dict( self.__stats, pending=len( self.__pending ) ) )
+
+    # Called with the lock held
+    def __schedule_frame( self ) :
+        if self.__scheduled :
+            return
+
+        self.__scheduled = True
+        delay = max( 0.0, self.__last_frame + self.__interval - time.time() )
+        self.__schedule( delay, self.__frame )
+
+    #-------------------------------------------------------------------
+    # Runs in the main loop : draw the pending updates of the visible views
+    def __frame( self ) :
+        with self.__lock :
+            pending          = self.__pending
+            self.__pending   = {}
+            self.__scheduled = False
+
+        start   = metrics.clock()
+        visible = {}
+        hidden  = {}
+        drawn   = 0
+
+        for ( key, ( function, args ) ) in pending.items() :
+            view = key[0]
+            if view not in visible :
+                is_visible      = self.__views.get( view )
+                visible[ view ] = is_visible == None or is_visible()
+
+            if not visible[ view ] :
+                hidden[ key ] = ( function, args )
+                continue
+
+            function( *args )
+            drawn += 1
+
+        with self.__lock :
+            # Newer updates arrived while drawing replace the kept ones
+            for ( key, update ) in hidden.items() :
+                self.__pending.setdefault( key, update )
+
+            self.__last_frame         = time.time()
+            self.__stats["frames"]   += 1
+            self.__stats["drawn"]    += drawn
+            self.__stats["deferred"] += len( hidden )
+
+        if start != None and drawn > 0 :
+            metrics.observe_since( "gui_frame_seconds", start )
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# Adaptive polling scheduler
+#
+# Decides when each device must be polled next, from what the last poll
+# returned :
+#
+#  - on battery, low battery, forced shutdown or when the runtime drops,
+#    the device is polled every 'fast' seconds
+#  - after a change, it is polled every 'normal' seconds, and the interval
+#    doubles at each poll returning nothing new, up to 'slow' seconds
+#  - while the front end is hidden, non urgent intervals are multiplied
+#    by 'hidden_factor'
+#  - unreachable devices are retried every 'slow' seconds
+#  - poll_now() (upsmon events...) forces at most one poll per device
+#    every 'forced_interval' seconds
+#
+# Each interval gets a small random jitter and the first polls of the
+# devices are spread over the 'normal' interval, so that many devices do
+# not all hit upsd on the same tick.
+
+import random
+import threading
+
+from nutmonitor import status
+
+
+#-----------------------------------------------------------------------
+# Polling intervals, in seconds
+class polling_policy :
+
+    def __init__( self, fast=1.0, normal=2.0, slow=15.0, hidden_factor=4.0, jitter=0.1, runtime_drop=0.1, forced_interval=1.0 ) :
+        self.fast            = fast
+        self.normal          = normal
+        self.slow            = slow
+        self.hidden_factor   = hidden_factor
+        self.jitter          = jitter
+        self.forced_interval = forced_interval
+
+        # Relative runtime drop considered as a power event
+        self.runtime_drop  = runtime_drop
+
+#-----------------------------------------------------------------------
+# Scheduling state of a device
+class _device_state :
+
+    __slots__ = ( "next_poll", "interval", "urgent", "runtime", "forced" )
+
+    def __init__( self, next_poll, interval ) :
+        self.next_poll = next_poll
+        self.interval  = interval
+        self.urgent    = False
+        self.runtime   = None
+        self.forced    = None
+
+#-----------------------------------------------------------------------
+# The scheduler. All methods can be called from any thread.
+class poll_scheduler :
+
+    def __init__( self, policy=None ) :
+        if policy == None :
+            policy = polling_policy()
+
+        self.__policy  = policy
+        self.__devices = {}
+        self.__hidden  = False
+        self.__lock    = threading.Lock()
+
+    def get_policy( self ) :
+        return( self.__policy )
+
+    #-------------------------------------------------------------------
+    # Start scheduling a device. Its first poll is staggered with the
+    # other devices.
+    def add( self, device_id, now ) :
+        with self.__lock :
+            offset = ( len( self.__devices ) * 0.618034 ) % 1.0 * self.__policy.normal
+            self.__devices[ device_id ] = _device_state( now + offset, self.__policy.normal )
+
+    def remove( self, device_id ) :
+        with self.__lock :
+            self.__devices.pop( device_id, None )
+
+    #-------------------------------------------------------------------
+    # Return True if the device must be polled now
+    def is_due( self, device_id, now ) :
+        with self.__lock :
+            state = self.__devices.get( device_id )
+            return( state != None and state.next_poll <= now )
+
+    #-------------------------------------------------------------------
+    # Return the time of the next poll of a device, or of the first due
+    # device if device_id is None
+    def next_poll( self, device_id=None ) :
+        with self.__lock :
+            if device_id != None :
+                state = self.__devices.get( device_id )
+                return( state.next_poll if state != None else None )
+
+            if len( self.__devices ) == 0 :
+                return( None )
+            return( min( state.next_poll for state in self.__devices.values() ) )
+
+    #-------------------------------------------------------------------
+    # A poll was sent : until it completes, the device is due again after
+    # its current interval, so callers waiting for the next poll do not spin
+    def started( self, device_id, now ) :
+        with self.__lock :
+            state = self.__devices.get( device_id )
+            if state != None :
+                state.next_poll = now + state.interval
+
+    #-------------------------------------------------------------------
+    # Schedule the next poll of a device from the vars it returned and
+    # the changes since the previous poll. Returns the next poll time.
+    def polled( self, device_id, vars, changes, now ) :
+        policy = self.__policy
+
+        with self.__lock :
+            state = self.__devices.get( device_id )
+            if state == None :
+                return( None )
+
+            flags  = status.parse( vars.get( "ups.status" ) )
+            urgent = ( flags & ( status.OB | status.LB | status.FSD ) ) != 0
+
+            runtime = _to_float( vars.get( "battery.runtime" ) )
+            if runtime != None and state.runtime != None and runtime < state.runtime * ( 1.0 - policy.runtime_drop ) :
+                urgent = True
+            state.runtime = runtime
+
+            if urgent :
+                state.interval = policy.fast
+            elif len( changes ) > 0 or state.urgent :
+                state.interval = policy.normal
+            else :
+                state.interval = min( state.interval * 2, policy.slow )
+
+            state.urgent = urgent
+            return( self.__schedule( state, now ) )
+
+    #-------------------------------------------------------------------
+    # Schedule the next try of an unreachable device
+    def failed( self, device_id, now ) :
+        with self.__lock :
+            state = self.__devices.get( device_id )
+            if state == None :
+                return( None )
+
+            state.urgent   = False
+            state.runtime  = None
+            state.interval = self.__policy.slow
+            return( self.__schedule( state, now ) )
+
+    def __schedule( self, state, now ) :
+        interval = state.interval
+        if self.__hidden and not state.urgent :
+            interval *= self.__policy.hidden_factor
+
+        interval *= random.uniform( 1.0 - self.__policy.jitter, 1.0 + self.__policy.jitter )
+        state.next_poll = now + interval
+        return( state.next_poll )
+
+    #-------------------------------------------------------------------
+    # Poll a device (all devices if device_id is None) as soon as possible.
+    # Anybody may send events : a device forced less than 'forced_interval'
+    # seconds ago keeps its schedule, so a flood of events cannot make the
+    # engine poll continuously.
+    def poll_now( self, device_id, now ) :
+        with self.__lock :
+            if device_id != None :
+                states = [ self.__devices.get( device_id ) ]
+            else :
+                states = self.__devices.values()
+
+            for state in states :
+                if state == None :
+                    continue
+                if state.forced != None and ( now - state.forced ) < self.__policy.forced_interval :
+                    continue
+
+                state.forced    = now
+                state.interval  = self.__policy.normal
+                state.next_poll = min( state.next_poll, now )
+
+    #-------------------------------------------------------------------
+    # The front end is hidden (iconified in tray...) : poll steady devices
+    # less often. Devices are polled soon after the front end is shown.
+    def set_hidden( self, hidden, now ) :
+        with self.__lock :
+            was_hidden    = self.__hidden
+            self.__hidden = hidden
+
+            if was_hidden and not hidden :
+                for state in self.__devices.values() :
+                    state.next_poll = min( state.next_poll, now + self.__policy.fast )
+
+    def is_hidden( self ) :
+        return( self.__hidden )
+
+#-----------------------------------------------------------------------
+# float() that returns None for missing or malformed values
+def _to_float( value ) :
+    if value == None :
+        return( None )
+    try :
+        return( float( value ) )
+    except ValueError :
+        return( None )
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Per device state
+#
+# ups_state holds what a front end knows about a device it is connected
+# to : upsd session, UPS name, instant commands, RW vars, and the latest
+# snapshot of its variables. The polling thread publishes a new snapshot
+# after each poll and the GUI thread reads the current one. Snapshots are
+# never modified once built, so reading them needs no lock : a reader
+# takes the reference once and works on a consistent set of values.
+#
+# Numeric variables are parsed once, when their value changes, into typed
+# attributes of the snapshot (charge, load, runtime...) instead of being
+# converted by each widget at each update.
+
+import threading
+import time
+
+from nutmonitor import status
+
+
+# Parsed variables : ( variable, snapshot attribute, type )
+NUMERIC_VARS = ( ( "battery.charge", "charge", float ),
+                 ( "ups.load", "load", float ),
+                 ( "battery.runtime", "runtime", int ),
+                 ( "ups.temperature", "temperature", float ),
+                 ( "battery.voltage", "battery_voltage", float ),
+                 ( "input.voltage", "input_voltage", float ),
+                 ( "output.voltage", "output_voltage", float ) )
+
+
+#-----------------------------------------------------------------------
+# Parse a numeric variable, None when missing or not a number
+def parse_number( value, kind=float ) :
+    if value == None :
+        return( None )
+
+    try :
+        number = float( value )
+    except ( TypeError, ValueError ) :
+        return( None )
+
+    if kind is int :
+        return( int( number ) )
+    return( number )
+
+#-----------------------------------------------------------------------
+# Immutable view of the variables of a device after a poll. 'vars' must
+# not be modified either : build a new dict and a new snapshot instead.
+class ups_snapshot( object ) :
+
+    __slots__ = ( "vars", "flags", "time" ) + tuple( attribute for ( name, attribute, kind ) in NUMERIC_VARS )
+
+    #-------------------------------------------------------------------
+    # Only the variables in 'changes' are parsed again, the others are
+    # taken from the previous snapshot
+    def __init__( self, vars, previous=None, changes=None, now=None ) :
+        init = object.__setattr__
+
+        if previous == None or changes == None :
+            changes = vars
+
+        init( self, "vars", vars )
+        init( self, "time", now or time.time() )
+
+        if previous == None or "ups.status" in changes :
+            init( self, "flags", status.parse( vars.get( "ups.status" ) ) )
+        else :
+            init( self, "flags", previous.flags )
+
+        for ( name, attribute, kind ) in NUMERIC_VARS :
+            if previous == None or name in changes :
+                init( self, attribute, parse_number( vars.get( name ), kind ) )
+            else :
+                init( self, attribute, getattr( previous, attribute ) )
+
+    def __setattr__( self, name, value ) :
+        raise AttributeError( "ups_snapshot is read only" )
+
+    def __delattr__( self, name ) :
+        raise AttributeError( "ups_snapshot is read only" )
+
+    def get( self, name, default=None ) :
+        return( self.vars.get( name, default ) )
+
+    def has_key( self, name ) :
+        return( name in self.vars )
+
+#-----------------------------------------------------------------------
+# State of the device a front end is connected to. The attributes are
+# only replaced, never modified in place, so that other threads can read
+# them without locking.
+class ups_state( object ) :
+
+    __slots__ = ( "device", "host", "ups", "handler", "commands", "rw_vars", "snapshot", "__lock" )
+
+    def __init__( self, device, host, ups, handler, commands, vars, rw_vars ) :
+        self.device   = device
+        self.host     = host
+        self.ups      = ups
+        self.handler  = handler
+        self.commands = tuple( sorted( commands ) )
+        self.rw_vars  = dict( rw_vars )
+        self.snapshot = ups_snapshot( dict( vars ) )
+        self.__lock   = threading.Lock()
+
+    #-------------------------------------------------------------------
+    # Publish the variables of a poll ('vars' now belongs to the state)
+    # and return the new snapshot
+    def publish( self, vars, changes=None ) :
+        with self.__lock :
+            self.snapshot = ups_snapshot( vars, self.snapshot, changes )
+            return( self.snapshot )
+
+    #-------------------------------------------------------------------
+    # upsd accepted a new value for a RW var
+    def set_var( self, name, value ) :
+        with self.__lock :
+            vars = dict( self.snapshot.vars )
+            vars[ name ] = value
+            if name in self.rw_vars :
+                rw_vars         = dict( self.rw_vars )
+                rw_vars[ name ] = value
+                self.rw_vars    = rw_vars
+
+            self.snapshot = ups_snapshot( vars, self.snapshot, { name : value } )
+            return( self.snapshot )
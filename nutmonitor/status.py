@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# ups.status parser
+#
+# ups.status is a space separated list of tokens ("OL CHRG", "OB DISCHRG
+# LB"...). It is parsed once per change into an int bitmask, so that the
+# front ends test flags instead of searching substrings (a substring test
+# finds "CHRG" inside "DISCHRG"). Transitions between two values are
+# computed with a XOR.
+
+OL      = 1 << 0
+OB      = 1 << 1
+LB      = 1 << 2
+HB      = 1 << 3
+RB      = 1 << 4
+CHRG    = 1 << 5
+DISCHRG = 1 << 6
+BYPASS  = 1 << 7
+CAL     = 1 << 8
+OFF     = 1 << 9
+OVER    = 1 << 10
+TRIM    = 1 << 11
+BOOST   = 1 << 12
+FSD     = 1 << 13
+
+TOKENS = { "OL"      : OL,
+           "OB"      : OB,
+           "LB"      : LB,
+           "HB"      : HB,
+           "RB"      : RB,
+           "CHRG"    : CHRG,
+           "DISCHRG" : DISCHRG,
+           "BYPASS"  : BYPASS,
+           "CAL"     : CAL,
+           "OFF"     : OFF,
+           "OVER"    : OVER,
+           "TRIM"    : TRIM,
+           "BOOST"   : BOOST,
+           "FSD"     : FSD
+         }
+
+# A fleet only reports a handful of distinct ups.status values
+_cache          = {}
+_cache_max_size = 256
+
+
+#-----------------------------------------------------------------------
+# Parse a ups.status value into a bitmask. Unknown tokens are ignored.
+def parse( text ) :
+    if text == None :
+        return( 0 )
+
+    flags = _cache.get( text )
+    if flags != None :
+        return( flags )
+
+    flags = 0
+    for token in text.split() :
+        flags |= TOKENS.get( token, 0 )
+
+    if len( _cache ) < _cache_max_size :
+        _cache[ text ] = flags
+
+    return( flags )
+
+#-----------------------------------------------------------------------
+# Return ( raised, cleared ) : the flags set and the flags removed
+# between two status values
+def transitions( old_flags, new_flags ) :
+    changed = old_flags ^ new_flags
+    return( ( changed & new_flags, changed & old_flags ) )
+
+#-----------------------------------------------------------------------
+# Return the token names of a bitmask, for display and debugging
+def names( flags ) :
+    return( [ name for ( name, flag ) in sorted( TOKENS.items(), key=lambda item : item[1] ) if flags & flag ] )
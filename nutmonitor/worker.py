@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Worker threads for blocking network calls
+#
+# The GUI must never wait on upsd : every PyNUT call is submitted to this
+# pool and runs on a worker thread. The result (or the error) is handed
+# back to the GUI main loop through the 'dispatch' function given by the
+# front end, e.g. a wrapper around gobject.idle_add. Callbacks are thus
+# always run on the GUI thread and are the only place touching widgets.
+
+import threading
+import sys
+
+try :
+    import queue
+except ImportError :
+    import Queue as queue
+
+
+class worker_pool :
+
+    def __init__( self, dispatch, size=4 ) :
+        self.__dispatch = dispatch
+        self.__jobs     = queue.Queue()
+        self.__threads  = []
+
+        for i in range( size ) :
+            thread = threading.Thread( target=self.__run )
+            thread.daemon = True
+            thread.start()
+            self.__threads.append( thread )
+
+    #-------------------------------------------------------------------
+    # Run func( *args ) on a worker thread. on_success( result ) or
+    # on_error( exception ) is then dispatched to the GUI main loop.
+    def submit( self, func, args=(), on_success=None, on_error=None ) :
+        self.__jobs.put( ( func, args, on_success, on_error ) )
+
+    #-------------------------------------------------------------------
+    # Ask the workers to exit once the queued jobs are done
+    def stop( self ) :
+        for thread in self.__threads :
+            self.__jobs.put( None )
+
+    def __run( self ) :
+        while True :
+            job = self.__jobs.get()
+            if job == None :
+                return
+
+            ( func, args, on_success, on_error ) = job
+            try :
+                result = func( *args )
+            except Exception :
+                if on_error != None :
+                    self.__dispatch( on_error, sys.exc_info()[1] )
+                continue
+
+            if on_success != None :
+                self.__dispatch( on_success, result )